@@ -1,10 +1,151 @@
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from django.http import HttpResponse
 from django.utils.translation import ugettext_lazy as _
 
-from djpayex.models import InitializedPayment, TransactionStatus, Agreement, AutoPayStatus
+from djpayex.export import FORMATS, export, get_filename
+from djpayex.models import InitializedPayment, TransactionStatus, Agreement, AutoPayStatus, AutoPayAttempt, PolledPayment, CurrentStatus, QueuedCallback
 
 
-class InitializedPaymentAdmin(admin.ModelAdmin):
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the estimated number of objects of large tables, see 
+    `EstimatedCountQuerySet.estimated_count`.
+    """
+    
+    def _get_count(self):
+        if self._count is None:
+            self._count = self.object_list.estimated_count()
+        
+        return self._count
+    
+    count = property(_get_count)
+
+class LargeTableChangeList(ChangeList):
+    """
+    Change list of large tables that searches with exact lookups, and does 
+    not count all the rows of filtered lists.
+    """
+    
+    def get_query_set(self, request):
+        # Searched below with exact lookups instead of icontains, which can use 
+        # the indexes on the search fields
+        search_fields, self.search_fields = self.search_fields, ()
+        try:
+            queryset = super(LargeTableChangeList, self).get_query_set(request)
+        finally:
+            self.search_fields = search_fields
+        
+        # Like the admin, every term has to match one of the fields
+        if self.search_fields and self.query:
+            for bit in self.query.split():
+                q = Q()
+                
+                if bit.isdigit():
+                    q |= Q(pk=bit)
+                
+                for field in self.search_fields:
+                    q |= Q(**{str(field): bit})
+                
+                queryset = queryset.filter(q)
+        
+        return queryset
+    
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        
+        # The total count is the count of the list when it is not filtered, 
+        # and otherwise estimated for the whole table
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = self.root_query_set.estimated_count()
+        
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+class PayexResponseChangeList(LargeTableChangeList):
+    """
+    Change list of responses that does not load the raw responses.
+    """
+    
+    def get_query_set(self, request):
+        return super(PayexResponseChangeList, self).get_query_set(request).defer('raw_response')
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Base admin of large tables, with change lists that stay fast. The model 
+    needs an `EstimatedCountManager` as default manager.
+    
+    Search fields are matched exactly, and numbers also against the id.
+    """
+    
+    ordering = ('-id', )
+    paginator = EstimatedCountPaginator
+    
+    def get_changelist(self, request, **kwargs):
+        return LargeTableChangeList
+
+class PayexResponseAdmin(LargeTableAdmin):
+    """
+    Base admin of responses, with change lists that stay fast on large tables.
+    """
+    
+    actions = ('export_csv', 'export_jsonl', )
+    date_hierarchy = 'created'
+    readonly_fields = ('raw_response', )
+    
+    # Fields of the exports, all but the raw response by default, and whether 
+    # the exports are gzipped
+    export_fields = None
+    export_compress = False
+    
+    def get_changelist(self, request, **kwargs):
+        return PayexResponseChangeList
+    
+    def export_response(self, queryset, format):
+        """
+        Returns a response streaming the objects of a queryset as a download.
+        """
+        
+        content_type = FORMATS[format]
+        if self.export_compress:
+            content_type = 'application/gzip'
+        
+        response = HttpResponse(export(queryset, self.export_fields, format, self.export_compress), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s' % get_filename(self.model, format, self.export_compress)
+        
+        return response
+    
+    def export_csv(self, request, queryset):
+        return self.export_response(queryset, 'csv')
+    export_csv.short_description = _('Export selected %(verbose_name_plural)s as CSV')
+    
+    def export_jsonl(self, request, queryset):
+        return self.export_response(queryset, 'jsonl')
+    export_jsonl.short_description = _('Export selected %(verbose_name_plural)s as JSON lines')
+
+
+class InitializedPaymentAdmin(PayexResponseAdmin):
     fieldsets = (
         (_('Response status'), {
             'fields': ('errorcode', 'description', 'paramname', 'thirdpartyerror', )
@@ -20,15 +161,14 @@ class InitializedPaymentAdmin(admin.ModelAdmin):
             'fields': ('raw_response', )
         }),
     )
-    list_display = ('__unicode__', 'errorcode', 'orderref', 'created', )
-    list_filter = ('created', )
-    search_fields = ('id', 'orderref', )
+    list_display = ('id', 'errorcode', 'orderref', 'created', )
+    search_fields = ('orderref', )
     #readonly_fields = InitializedPayment._meta.get_all_field_names()
 
 admin.site.register(InitializedPayment, InitializedPaymentAdmin)
 
 
-class TransactionStatusAdmin(admin.ModelAdmin):
+class TransactionStatusAdmin(PayexResponseAdmin):
     fieldsets = (
         (_('Response status'), {
             'fields': ('errorcode', 'description', 'paramname', 'thirdpartyerror', )
@@ -53,14 +193,13 @@ class TransactionStatusAdmin(admin.ModelAdmin):
             'fields': ('raw_response', )
         }),
     )
-    list_display = ('__unicode__', 'transactionnumber', 'transactionstatus', 'errorcode', 'alreadycompleted', 'created', )
-    list_filter = ('created', )
-    search_fields = ('id', 'transactionnumber', )
+    list_display = ('id', 'transactionnumber', 'transactionstatus', 'errorcode', 'alreadycompleted', 'created', )
+    search_fields = ('transactionnumber', 'orderref', 'agreementref', )
     #readonly_fields = TransactionStatus._meta.get_all_field_names()
 
 admin.site.register(TransactionStatus, TransactionStatusAdmin)
 
-class AgreementAdmin(admin.ModelAdmin):
+class AgreementAdmin(PayexResponseAdmin):
     fieldsets = (
         (_('Response status'), {
             'fields': ('errorcode', 'description', 'paramname', 'thirdpartyerror', )
@@ -76,14 +215,13 @@ class AgreementAdmin(admin.ModelAdmin):
             'fields': ('raw_response', )
         }),
     )
-    list_display = ('__unicode__', 'errorcode', 'agreementref', 'created', )
-    list_filter = ('created', )
-    search_fields = ('id', 'agreementref', )
+    list_display = ('id', 'errorcode', 'agreementref', 'created', )
+    search_fields = ('agreementref', )
     #readonly_fields = Agreement._meta.get_all_field_names()
 
 admin.site.register(Agreement, AgreementAdmin)
 
-class AutoPayStatusAdmin(admin.ModelAdmin):
+class AutoPayStatusAdmin(PayexResponseAdmin):
     fieldsets = (
         (_('Response status'), {
             'fields': ('errorcode', 'description', 'paramname', 'thirdpartyerror', )
@@ -92,7 +230,7 @@ class AutoPayStatusAdmin(admin.ModelAdmin):
             'fields': ('transactionstatus', 'transactionnumber', 'transactionref', )
         }),
         (_('Payment information'), {
-            'fields': ('paymentmethod', )
+            'fields': ('agreementref', 'paymentmethod', )
         }),
         (_('Timestamps'), {
             'fields': () # 'created', 'updated', 
@@ -102,9 +240,38 @@ class AutoPayStatusAdmin(admin.ModelAdmin):
             'fields': ('raw_response', )
         }),
     )
-    list_display = ('__unicode__', 'errorcode', 'transactionnumber', 'created', )
-    list_filter = ('created', )
-    search_fields = ('id', 'transactionnumber', )
+    list_display = ('id', 'errorcode', 'transactionnumber', 'agreementref', 'created', )
+    search_fields = ('transactionnumber', 'agreementref', )
     #readonly_fields = AutoPayStatus._meta.get_all_field_names()
 
 admin.site.register(AutoPayStatus, AutoPayStatusAdmin)
+
+class AutoPayAttemptAdmin(LargeTableAdmin):
+    list_display = ('id', 'run', 'agreementref', 'amount', 'status', 'created', 'updated', )
+    list_filter = ('run', 'status', )
+    search_fields = ('agreementref', )
+
+admin.site.register(AutoPayAttempt, AutoPayAttemptAdmin)
+
+class PolledPaymentAdmin(LargeTableAdmin):
+    list_display = ('orderref', 'attempts', 'next_poll', 'created', )
+    search_fields = ('orderref', )
+    readonly_fields = ('attempts', )
+
+admin.site.register(PolledPayment, PolledPaymentAdmin)
+
+class CurrentStatusAdmin(LargeTableAdmin):
+    list_display = ('reference_type', 'reference', 'state', 'transactionstatus', 'transactionnumber', 'status_created', )
+    list_filter = ('reference_type', 'state', )
+    search_fields = ('reference', )
+    readonly_fields = ('status_model', 'status_id', 'status_created', )
+
+admin.site.register(CurrentStatus, CurrentStatusAdmin)
+
+class QueuedCallbackAdmin(LargeTableAdmin):
+    list_display = ('id', 'orderref', 'transactionnumber', 'status', 'attempts', 'next_attempt', 'created', )
+    list_filter = ('status', )
+    search_fields = ('orderref', 'transactionnumber', )
+    readonly_fields = ('attempts', 'last_error', )
+
+admin.site.register(QueuedCallback, QueuedCallbackAdmin)
@@ -0,0 +1,246 @@
+"""
+Archival of old responses, run by the `payex_archive` and `payex_restore`
+management commands.
+
+Responses created before a cutoff are written to gzipped JSON-lines files, one
+per model and month of creation (in UTC), named like
+`djpayex.transactionstatus-2013-03-20130401T020000.jsonl.gz`. Each line holds
+the stored values of a row, with `raw_response` as stored, so the rows can be
+restored as they were. A file is read back and checked before the archived
+rows are deleted, in batches by primary key. Statuses that are the current
+status of an order or agreement (see CurrentStatus) are kept, however old.
+Agreements are never archived, as they are used for as long as they are
+valid.
+
+Retention periods are set in days per model with PAYEX_RETENTION_DAYS, and
+models without one are not archived:
+    
+    PAYEX_RETENTION_DAYS = {
+        'transactionstatus': 365,
+        'autopaystatus': 365,
+    }
+"""
+
+import datetime
+import gzip
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import models, router, transaction
+from django.db.models.sql.subqueries import DeleteQuery
+from django.utils import simplejson as json
+from django.utils import timezone
+
+from djpayex.exceptions import ArchiveError
+from djpayex.models import InitializedPayment, TransactionStatus, AutoPayStatus, CurrentStatus
+from djpayex.utils import chunked_values, encode_value
+
+# Models that can be archived
+ARCHIVED_MODELS = (InitializedPayment, TransactionStatus, AutoPayStatus, )
+
+
+def get_retention_days(overrides=None):
+    """
+    Returns a dictionary of model name to retention period in days, from
+    PAYEX_RETENTION_DAYS updated with `overrides`.
+    """
+    
+    days = dict(getattr(settings, 'PAYEX_RETENTION_DAYS', {}))
+    days.update(overrides or {})
+    
+    return days
+
+def get_month_bounds(date):
+    """
+    Returns the start of the month of a date, and of the next month.
+    """
+    
+    start = datetime.datetime(date.year, date.month, 1)
+    end = datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    
+    if settings.USE_TZ:
+        start = start.replace(tzinfo=timezone.utc)
+        end = end.replace(tzinfo=timezone.utc)
+    
+    return start, end
+
+def get_archive_model(path):
+    """
+    Returns the model of the rows in an archive file, from its name.
+    """
+    
+    label = os.path.basename(path).split('-', 1)[0]
+    model = models.get_model(*label.split('.', 1)) if '.' in label else None
+    
+    if model not in ARCHIVED_MODELS:
+        raise ArchiveError('%s is not an archive of responses.' % path)
+    
+    return model
+
+def write_archive(path, rows):
+    """
+    Writes rows to an archive file, and returns the number of rows and a
+    checksum of the lines written.
+    """
+    
+    count = 0
+    checksum = hashlib.sha1()
+    
+    archive = gzip.open(path, 'wb')
+    try:
+        for row in rows:
+            line = json.dumps(row, sort_keys=True, separators=(',', ':'), default=encode_value) + '\n'
+            archive.write(line)
+            checksum.update(line)
+            count += 1
+    finally:
+        archive.close()
+    
+    return count, checksum.hexdigest()
+
+def read_archive(path):
+    """
+    Yields the rows of an archive file.
+    """
+    
+    archive = gzip.open(path, 'rb')
+    try:
+        for line in archive:
+            yield json.loads(line)
+    finally:
+        archive.close()
+
+def verify_archive(path, count, checksum):
+    """
+    Reads an archive file back, and raises ArchiveError unless it has the
+    number of rows and checksum it was written with.
+    """
+    
+    written = 0
+    digest = hashlib.sha1()
+    
+    try:
+        archive = gzip.open(path, 'rb')
+        try:
+            for line in archive:
+                json.loads(line)
+                digest.update(line)
+                written += 1
+        finally:
+            archive.close()
+    except (IOError, ValueError) as e:
+        raise ArchiveError('%s could not be read: %s' % (path, e))
+    
+    if written != count or digest.hexdigest() != checksum:
+        raise ArchiveError('%s does not match the archived rows.' % path)
+
+def delete_archived(model, path, batch_size=500, using=None):
+    """
+    Deletes the rows in an archive file from the database, `batch_size` rows
+    per transaction, and returns the number of rows.
+    """
+    
+    using = using or router.db_for_write(model)
+    pk = model._meta.pk.attname
+    deleted = 0
+    batch = []
+    
+    for row in read_archive(path):
+        batch.append(row[pk])
+        
+        if len(batch) >= batch_size:
+            deleted += delete_batch(model, batch, using)
+            batch = []
+    
+    if batch:
+        deleted += delete_batch(model, batch, using)
+    
+    return deleted
+
+def delete_batch(model, pks, using):
+    """
+    Deletes rows by primary key in a transaction, without loading them.
+    """
+    
+    with transaction.commit_on_success(using=using):
+        DeleteQuery(model).delete_batch(pks, using)
+    
+    return len(pks)
+
+def archive_model(model, cutoff, directory, chunk_size=1000, delete_batch_size=500, delete=True):
+    """
+    Archives the rows of a model created before `cutoff` to files in
+    `directory`, one per month, deleting the rows unless `delete` is False.
+    Rows that are the current status of an order or agreement are skipped.
+    Returns a dictionary with the number of rows 'archived' and 'deleted', and
+    the 'files' written.
+    """
+    
+    run = timezone.now().strftime('%Y%m%dT%H%M%S')
+    queryset = model.objects.filter(created__lt=cutoff)
+    
+    if model.objects.current_status_fields:
+        current = CurrentStatus.objects.filter(status_model=model._meta.module_name).values('status_id')
+        queryset = queryset.exclude(pk__in=current)
+    result = {'archived': 0, 'deleted': 0, 'files': []}
+    
+    for month in queryset.dates('created', 'month'):
+        start, end = get_month_bounds(month)
+        path = os.path.join(directory, '%s.%s-%s-%s.jsonl.gz' % (model._meta.app_label, model._meta.module_name, start.strftime('%Y-%m'), run))
+        
+        # Written under a temporary name, so that only verified files are left
+        # behind if interrupted
+        temp_path = path + '.tmp'
+        rows = chunked_values(queryset.filter(created__gte=start, created__lt=end), [field.attname for field in model._meta.fields], chunk_size)
+        count, checksum = write_archive(temp_path, rows)
+        verify_archive(temp_path, count, checksum)
+        os.rename(temp_path, path)
+        
+        result['archived'] += count
+        result['files'].append(path)
+        
+        if delete:
+            result['deleted'] += delete_archived(model, path, delete_batch_size)
+    
+    return result
+
+def restore_archive(path, batch_size=500):
+    """
+    Saves the rows in an archive file, `batch_size` rows per transaction, and
+    returns the number of rows. Rows that exist already are overwritten.
+    """
+    
+    model = get_archive_model(path)
+    restored = 0
+    batch = []
+    
+    for row in read_archive(path):
+        batch.append(row)
+        
+        if len(batch) >= batch_size:
+            restored += restore_rows(model, batch)
+            batch = []
+    
+    if batch:
+        restored += restore_rows(model, batch)
+    
+    return restored
+
+def restore_rows(model, rows):
+    """
+    Saves rows of a model in a transaction, as they were stored.
+    """
+    
+    fields = model._meta.fields
+    
+    using = router.db_for_write(model)
+    
+    with transaction.commit_on_success(using=using):
+        for row in rows:
+            obj = model(**dict((str(field.attname), field.to_python(row[field.attname])) for field in fields if field.attname in row))
+            
+            # Saved raw, like loaddata does, so the timestamps are kept
+            models.Model.save_base(obj, raw=True, using=using)
+    
+    return len(rows)
@@ -0,0 +1,225 @@
+"""
+Batch autopay of recurring agreements.
+
+Every agreement charged in a run gets an AutoPayAttempt checkpoint, stored
+before PayEx is called. A run that is interrupted can be started again with
+the same name, and agreements with a checkpoint are not charged again. An
+attempt left started (e.g. by a crash during the call) has an unknown outcome
+and is reported rather than retried, to never charge an agreement twice.
+Attempts PayEx was never called for, because the circuit breaker is open, are
+removed, so that the agreements are charged when the run is resumed.
+"""
+
+import logging
+import time
+
+from django.db import router, transaction
+
+from djpayex import states
+from djpayex.client import get_host, get_service
+from djpayex.exceptions import CircuitOpen
+from djpayex.models import AutoPayStatus, AutoPayAttempt
+from djpayex.routers import use_write_db
+from djpayex.utils import RateLimiter, chunked_queryset, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+# Result of an autopay that raised an exception
+UNKNOWN = object()
+
+# Result of an autopay PayEx was not called for
+NOT_ATTEMPTED = object()
+
+
+class AutoPayRunner(object):
+    """
+    Charges agreements with PayEx AutoPay2 concurrently, using a pool of
+    `workers` threads, with calls limited to `rate` per second per PayEx host.
+    
+    `amounts` gives the amount to charge in minor units, as a number for all
+    agreements, a dictionary of agreementRef to amount, or a function called
+    with the agreement. Agreements without an amount are skipped.
+    
+    The service defaults to the one for the PAYEX_* settings, for the thread
+    making the call.
+    """
+    
+    def __init__(self, name, amounts, product_number, description, service=None, workers=4, rate=10, batch_size=500, purchase_operation='SALE', retry_failed=False):
+        self.name = name
+        self.amounts = amounts
+        self.product_number = product_number
+        self.description = description
+        self.service = service
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.purchase_operation = purchase_operation
+        self.retry_failed = retry_failed
+    
+    def get_amount(self, agreement):
+        """
+        Returns the amount to charge for an agreement, or None.
+        """
+        
+        if callable(self.amounts):
+            return self.amounts(agreement)
+        
+        if isinstance(self.amounts, dict):
+            return self.amounts.get(agreement.agreementref)
+        
+        return self.amounts
+    
+    def get_order_id(self, agreement):
+        """
+        Returns the orderId of the autopay of an agreement.
+        """
+        
+        return self.name
+    
+    def autopay(self, item):
+        """
+        Charges an (agreement, amount) pair. Returns the response, or None if
+        PayEx did not return one. Exceptions are raised, the outcome is unknown.
+        """
+        
+        agreement, amount = item
+        
+        service = self.service or get_service()
+        self.limiter.wait(get_host(service.autopay))
+        
+        return service.autopay(
+            agreementRef=agreement.agreementref,
+            price=amount,
+            productNumber=self.product_number,
+            description=self.description,
+            orderId=self.get_order_id(agreement),
+            purchaseOperation=self.purchase_operation,
+        )
+    
+    def autopay_safely(self, item):
+        """
+        Charges an (agreement, amount) pair like `autopay`, returning UNKNOWN 
+        if an exception is raised, or NOT_ATTEMPTED if the circuit breaker is 
+        open.
+        """
+        
+        try:
+            return self.autopay(item)
+        except CircuitOpen:
+            logger.warning('Autopay of agreementRef %s in run %s was not attempted, the circuit breaker is open.', item[0].agreementref, self.name)
+            return NOT_ATTEMPTED
+        except Exception:
+            logger.exception('Autopay of agreementRef %s in run %s failed, the outcome is unknown.', item[0].agreementref, self.name)
+            return UNKNOWN
+    
+    @use_write_db
+    def run(self, agreements):
+        """
+        Charges the agreements in a queryset, and returns a summary dictionary
+        with the number of agreements 'charged' successfully, 'declined' by
+        PayEx, 'failed' requests (or not made, as the circuit breaker is open),
+        'unknown' outcomes and 'skipped' agreements (without an amount or
+        charged earlier in the run), and 'seconds' taken.
+        """
+        
+        summary = dict.fromkeys(('charged', 'declined', 'failed', 'unknown', 'skipped', ), 0)
+        started = time.time()
+        seen = set()
+        
+        for chunk in chunked_queryset(agreements.defer('raw_response'), self.batch_size):
+            batch = []
+            
+            for agreement in chunk:
+                if agreement.agreementref and agreement.agreementref not in seen:
+                    seen.add(agreement.agreementref)
+                    batch.append(agreement)
+            
+            self.run_batch(batch, summary)
+        
+        summary['seconds'] = time.time() - started
+        
+        return summary
+    
+    def run_batch(self, agreements, summary):
+        """
+        Checkpoints, charges and stores the results for a batch of agreements.
+        """
+        
+        items = self.start(agreements, summary)
+        results = run_concurrently(self.autopay_safely, items, workers=self.workers)
+        
+        responses = []
+        done = set()
+        failed = set()
+        not_attempted = set()
+        
+        for (agreement, amount), response in zip(items, results):
+            if response is UNKNOWN:
+                summary['unknown'] += 1
+                continue
+            
+            if response is NOT_ATTEMPTED:
+                not_attempted.add(agreement.agreementref)
+                summary['failed'] += 1
+                continue
+            
+            if response is None or response['status']['errorCode'] != 'OK':
+                failed.add(agreement.agreementref)
+                summary['failed'] += 1
+            else:
+                done.add(agreement.agreementref)
+            
+            if response is not None:
+                responses.append((response, AutoPayStatus(agreementref=agreement.agreementref)))
+        
+        with transaction.commit_on_success(using=router.db_for_write(AutoPayAttempt)):
+            AutoPayStatus.objects.bulk_create_from_responses(responses, batch_size=self.batch_size)
+            
+            attempts = AutoPayAttempt.objects.filter(run=self.name)
+            attempts.filter(agreementref__in=done).update(status=AutoPayAttempt.DONE)
+            attempts.filter(agreementref__in=failed).update(status=AutoPayAttempt.FAILED)
+            attempts.filter(agreementref__in=not_attempted).delete()
+        
+        for response, obj in responses:
+            if obj.agreementref in done:
+                if obj.get_state() == states.SUCCESSFUL:
+                    summary['charged'] += 1
+                else:
+                    summary['declined'] += 1
+    
+    def start(self, agreements, summary):
+        """
+        Stores the started checkpoints of a batch, and returns the (agreement,
+        amount) pairs to charge.
+        """
+        
+        refs = [agreement.agreementref for agreement in agreements]
+        existing = dict(AutoPayAttempt.objects.filter(run=self.name, agreementref__in=refs).values_list('agreementref', 'status'))
+        
+        items = []
+        new = []
+        retried = []
+        
+        for agreement in agreements:
+            status = existing.get(agreement.agreementref)
+            amount = self.get_amount(agreement)
+            
+            if not amount or status == AutoPayAttempt.DONE or (status == AutoPayAttempt.FAILED and not self.retry_failed):
+                summary['skipped'] += 1
+            elif status == AutoPayAttempt.STARTED:
+                summary['unknown'] += 1
+            else:
+                if status is None:
+                    new.append(AutoPayAttempt(run=self.name, agreementref=agreement.agreementref, amount=amount))
+                else:
+                    retried.append(agreement.agreementref)
+                
+                items.append((agreement, amount))
+        
+        with transaction.commit_on_success(using=router.db_for_write(AutoPayAttempt)):
+            AutoPayAttempt.objects.bulk_create(new)
+            
+            if retried:
+                AutoPayAttempt.objects.filter(run=self.name, agreementref__in=retried, status=AutoPayAttempt.FAILED).update(status=AutoPayAttempt.STARTED)
+        
+        return items
@@ -0,0 +1,107 @@
+"""
+Benchmarks of storing responses, run by the `payex_benchmark` management
+command.
+
+Each benchmark is run on synthetic responses from `djpayex.testing`, and
+results are returned as a dictionary, so they can be stored as JSON and
+compared across releases.
+"""
+
+import platform
+import resource
+import time
+
+import django
+from django.db import connection
+
+from djpayex import __version__
+from djpayex.models import TransactionStatus
+from djpayex.testing import generate_complete_responses
+
+
+def measure(func, count):
+    """
+    Calls `func` and returns the number of seconds taken and items per second,
+    for `count` items.
+    """
+    
+    started = time.time()
+    func()
+    seconds = time.time() - started
+    
+    return {
+        'count': count,
+        'seconds': round(seconds, 4),
+        'per_second': round(count / seconds, 1) if seconds else None,
+    }
+
+def get_max_rss():
+    """
+    Returns the peak resident memory of the process in kilobytes.
+    """
+    
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # Bytes on Mac OS X, kilobytes elsewhere
+    if platform.system() == 'Darwin':
+        rss /= 1024
+    
+    return rss
+
+def run_benchmarks(count=10000, batch_size=500):
+    """
+    Runs the benchmarks with `count` responses each, and returns the results.
+    
+    Memory is measured as the growth of the peak resident memory while holding
+    the mapped objects of the `commit=False` benchmark, scaled to 100k rows. It
+    is an estimate, and only meaningful when the benchmark runs first in a
+    fresh process.
+    """
+    
+    manager = TransactionStatus.objects
+    responses = list(generate_complete_responses(count))
+    results = {}
+    
+    # Mapping only
+    objs = []
+    rss = get_max_rss()
+    
+    def create_without_commit():
+        for response in responses:
+            objs.append(manager.create_from_response(response, commit=False))
+    
+    results['create_from_response_no_commit'] = measure(create_without_commit, count)
+    memory = (get_max_rss() - rss) * 100000 / count
+    
+    def get_decimal_amount():
+        for obj in objs:
+            obj.get_decimal_amount()
+    
+    results['get_decimal_amount'] = measure(get_decimal_amount, count)
+    del objs[:]
+    
+    # Single inserts
+    def create():
+        for response in responses:
+            manager.create_from_response(response)
+    
+    results['create_from_response'] = measure(create, count)
+    manager.all().delete()
+    
+    # Bulk inserts
+    def bulk_create():
+        manager.bulk_create_from_responses(responses, batch_size=batch_size)
+    
+    results['bulk_create_from_responses'] = measure(bulk_create, count)
+    manager.all().delete()
+    
+    return {
+        'django_payex': __version__,
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'database': connection.vendor,
+        'count': count,
+        'batch_size': batch_size,
+        'memory_per_100k_rows_kb': memory,
+        'results': results,
+    }
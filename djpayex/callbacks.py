@@ -0,0 +1,304 @@
+"""
+Processing of transaction callbacks from PayEx.
+"""
+
+import datetime
+import logging
+import os
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from djpayex.client import get_service
+from djpayex.exceptions import NoResponse
+from djpayex.models import TransactionStatus, QueuedCallback, ProcessedCallback
+from djpayex.routers import use_write_db
+from djpayex.utils import LRUCache, close_connections, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def complete_order(orderref, service=None):
+    """
+    Completes an order with PayEx, and saves the TransactionStatus. The 
+    service defaults to the one for the PAYEX_* settings.
+    """
+    
+    if service is None:
+        service = get_service()
+    
+    response = service.complete(orderRef=orderref)
+    
+    if response is None:
+        raise NoResponse('No response from PayEx when completing orderRef %s' % orderref)
+    
+    return TransactionStatus.objects.create_from_response(response, obj=TransactionStatus(orderref=orderref))
+
+class CallbackDeduplicator(object):
+    """
+    Keeps track of processed callbacks, so that repeated callbacks for the same 
+    transaction can be answered without contacting PayEx again.
+    
+    Callbacks are identified by orderRef and transactionNumber. Recently seen 
+    callbacks are kept in a bounded in-process LRU cache, in front of the 
+    ProcessedCallback table shared by all processes.
+    """
+    
+    def __init__(self, maxsize=10000):
+        self.cache = LRUCache(maxsize)
+    
+    def is_processed(self, orderref, transactionnumber):
+        """
+        Checks if a callback for the transaction has been processed.
+        """
+        
+        if not transactionnumber:
+            return False
+        
+        key = (orderref, transactionnumber)
+        
+        if key in self.cache:
+            return True
+        
+        if ProcessedCallback.objects.is_processed(orderref, transactionnumber):
+            self.cache.set(key, True)
+            return True
+        
+        return False
+    
+    def mark_processed(self, orderref, transactionnumber):
+        """
+        Records that a callback for the transaction has been processed.
+        """
+        
+        if not transactionnumber:
+            return
+        
+        ProcessedCallback.objects.mark_processed(orderref, transactionnumber)
+        self.cache.set((orderref, transactionnumber), True)
+
+deduplicator = CallbackDeduplicator(getattr(settings, 'PAYEX_CALLBACK_DEDUPLICATION_CACHE_SIZE', 10000))
+
+class CallbackWorker(object):
+    """
+    Processes queued callbacks, completing the orders with PayEx.
+    
+    The service defaults to the one for the PAYEX_* settings, for the thread 
+    processing the callback.
+    
+    Callbacks that fail are retried with exponential backoff, starting at
+    `backoff` seconds and capped at `max_backoff`, until `max_attempts` is
+    reached and the callback is marked as failed.
+    """
+    
+    def __init__(self, service=None, workers=4, batch_size=100, max_attempts=10, backoff=60, max_backoff=3600, stale_after=600):
+        self.service = service
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stale_after = stale_after
+    
+    def get_delay(self, attempts):
+        """
+        Returns the number of seconds to wait before the next attempt.
+        """
+        
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+    
+    @use_write_db
+    def process(self, item):
+        """
+        Processes a claimed callback. Returns True if the order was completed.
+        """
+        
+        # Repeated callbacks for a processed transaction are done already
+        if deduplicator.is_processed(item.orderref, item.transactionnumber):
+            item.status = QueuedCallback.DONE
+            item.save()
+            return True
+        
+        item.attempts += 1
+        
+        try:
+            complete_order(item.orderref, self.service)
+        except Exception as e:
+            logger.exception('Processing of queued callback %s failed (attempt %s).', item.pk, item.attempts)
+            
+            item.last_error = u'%s' % e
+            
+            if item.attempts >= self.max_attempts:
+                item.status = QueuedCallback.FAILED
+            else:
+                item.status = QueuedCallback.PENDING
+                item.next_attempt = timezone.now() + datetime.timedelta(seconds=self.get_delay(item.attempts))
+            
+            item.save()
+            return False
+        
+        deduplicator.mark_processed(item.orderref, item.transactionnumber)
+        
+        item.status = QueuedCallback.DONE
+        item.last_error = u''
+        item.save()
+        
+        return True
+    
+    @use_write_db
+    def process_batch(self):
+        """
+        Claims and processes a batch of due callbacks concurrently.
+        
+        Returns the number of callbacks processed.
+        """
+        
+        items = QueuedCallback.objects.claim(limit=self.batch_size, stale_after=self.stale_after)
+        
+        if items:
+            run_concurrently(self.process, items, workers=self.workers)
+        
+        return len(items)
+    
+    def run(self, once=False, interval=5):
+        """
+        Processes callbacks until the queue is empty if `once` is set, or else
+        forever, polling every `interval` seconds when the queue is empty.
+        """
+        
+        processed = 0
+        
+        while True:
+            count = self.process_batch()
+            processed += count
+            
+            if not count:
+                if once:
+                    return processed
+                
+                time.sleep(interval)
+
+class CallbackExecutor(object):
+    """
+    Runs tasks, such as completing deferred callbacks, with a pool of 
+    `workers` threads started when first needed. At most `backlog` tasks wait 
+    for a thread, further tasks are refused.
+    
+    Without workers, tasks are run right away by the calling thread. A forked 
+    process starts its own threads, with an empty backlog.
+    """
+    
+    def __init__(self, workers=10, backlog=100):
+        self.workers = workers
+        self.backlog = backlog
+        self.reset()
+    
+    def reset(self):
+        """
+        Discards the queued tasks and threads, e.g. the ones inherited from the 
+        parent process after a fork.
+        """
+        
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.backlog)
+        self.threads = []
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """
+        Starts the worker threads that are not running.
+        """
+        
+        with self._lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, name='djpayex-callback')
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+    
+    def run(self):
+        """
+        Runs queued tasks, closing the database connections after each task.
+        """
+        
+        while True:
+            func, args = self.queue.get()
+            
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Callback task %r failed.', func)
+            finally:
+                close_connections()
+                self.queue.task_done()
+    
+    def is_full(self):
+        """
+        Checks if tasks are refused, because the backlog is full.
+        """
+        
+        return bool(self.workers) and self.queue.full()
+    
+    def submit(self, func, *args):
+        """
+        Runs `func` with the arguments in a worker thread. Returns False if the 
+        task is refused.
+        """
+        
+        if not self.workers:
+            func(*args)
+            return True
+        
+        if self.pid != os.getpid():
+            self.reset()
+        
+        if len(self.threads) < self.workers or not all(thread.is_alive() for thread in self.threads):
+            self.start()
+        
+        try:
+            self.queue.put_nowait((func, args))
+        except Queue.Full:
+            return False
+        
+        return True
+
+def get_executor():
+    """
+    Returns the executor of deferred callbacks, with 
+    PAYEX_CALLBACK_EXECUTOR_WORKERS threads (10 by default) and a backlog of 
+    PAYEX_CALLBACK_EXECUTOR_BACKLOG callbacks (100 by default).
+    """
+    
+    global _executor
+    
+    if _executor is None:
+        _executor = CallbackExecutor(
+            getattr(settings, 'PAYEX_CALLBACK_EXECUTOR_WORKERS', 10),
+            getattr(settings, 'PAYEX_CALLBACK_EXECUTOR_BACKLOG', 100)
+        )
+    
+    return _executor
+
+def reset_executor():
+    """
+    Discards the executor, so a new one is created from the settings.
+    """
+    
+    global _executor
+    
+    _executor = None
+
+def complete_deferred(item):
+    """
+    Completes the order of a deferred callback, claimed by the callback view. 
+    Failed callbacks are left for `payex_callback_worker` to retry.
+    """
+    
+    CallbackWorker().process(item)
@@ -0,0 +1,513 @@
+"""
+Shared PayEx service clients.
+
+`pypayex` creates a new SOAP client, fetching and parsing the WSDL, for every
+call it makes. The services returned by `get_service` reuse a parsed client per
+WSDL for the life of the process instead, and keep the HTTP connections to
+PayEx open between calls.
+
+PAYEX_SERVICE_BACKEND can be set to the dotted path of a replacement for the
+`pypayex` service, such as `djpayex.testing.FakePayEx` for load tests. It is
+called with the account and the PAYEX_SERVICE_BACKEND_OPTIONS as arguments.
+
+Calls time out after PAYEX_TIMEOUT seconds (30 by default), and are guarded 
+by a circuit breaker: after PAYEX_CIRCUIT_BREAKER_THRESHOLD consecutive failed 
+calls (5 by default, 0 disables it), calls raise CircuitOpen without 
+contacting PayEx for PAYEX_CIRCUIT_BREAKER_RESET_TIMEOUT seconds (30 by 
+default), after which a single call is let through to test PayEx again.
+
+If PAYEX_WSDL_CACHE_DIR is set, the parsed WSDLs are also cached on disk, so
+new processes can build the clients without fetching the WSDLs. The cache can
+be filled in advance with the `payex_warm_cache` management command.
+"""
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urlparse
+from StringIO import StringIO
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from payex.handlers import BaseHandler
+from payex.service import PayEx
+from suds.cache import ObjectCache
+from suds.client import Client
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
+
+from djpayex import __version__, metrics
+from djpayex.exceptions import CircuitOpen
+
+# The methods of the `pypayex` service
+SERVICE_METHODS = (
+    'create_agreement', 'delete_agreement', 'check_agreement', 'autopay',
+    'initialize', 'complete', 'capture', 'get_transaction_details', 'cancel',
+    'credit', 'check', 'add_single_order_line', 'purchase_invoice_corporate',
+)
+
+# Errors of calls that got no response from PayEx, e.g. when timing out
+TRANSPORT_ERRORS = (socket.error, httplib.HTTPException, TransportError, )
+
+logger = logging.getLogger(__name__)
+
+
+class KeepAliveTransport(HttpTransport):
+    """
+    SOAP transport keeping one persistent HTTP connection per host.
+    
+    Connections idle for more than `max_idle` seconds are reopened rather than
+    reused, since the server may have closed them. Requests through a proxy
+    are sent with the default `urllib2` transport.
+    """
+    
+    max_idle = 15
+    
+    def __init__(self, **kwargs):
+        HttpTransport.__init__(self, **kwargs)
+        self.connections = {}
+    
+    def get_connection(self, scheme, netloc):
+        """
+        Returns an open connection to the host, reusing a recent one if possible.
+        """
+        
+        key = (scheme, netloc)
+        connection, last_used = self.connections.get(key, (None, 0))
+        
+        if connection is not None and time.time() - last_used > self.max_idle:
+            connection.close()
+            connection = None
+        
+        if connection is None:
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc, timeout=self.options.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc, timeout=self.options.timeout)
+        
+        self.connections[key] = (connection, time.time())
+        
+        return connection
+    
+    def close(self):
+        """
+        Closes all connections.
+        """
+        
+        for connection, last_used in self.connections.values():
+            connection.close()
+        
+        self.connections.clear()
+    
+    def send(self, request):
+        if self.options.proxy:
+            return HttpTransport.send(self, request)
+        
+        url = urlparse.urlsplit(request.url)
+        path = url.path or '/'
+        if url.query:
+            path = '%s?%s' % (path, url.query)
+        
+        connection = self.get_connection(url.scheme, url.netloc)
+        
+        try:
+            connection.request('POST', path, request.message, request.headers)
+            response = connection.getresponse()
+            message = response.read()
+        except (httplib.HTTPException, socket.error):
+            # Never resend, the request may have been performed
+            self.connections.pop((url.scheme, url.netloc), None)
+            connection.close()
+            raise
+        
+        if response.status in (202, 204):
+            return None
+        
+        if response.status >= 300:
+            raise TransportError(response.reason, response.status, StringIO(message))
+        
+        return Reply(200, dict(response.getheaders()), message)
+
+class CircuitBreaker(object):
+    """
+    Stops calls to PayEx after `threshold` consecutive failures, for 
+    `reset_timeout` seconds. Calls fail when they raise an exception or return 
+    no response. Thread safe, and shared by all threads of a process.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+    
+    def before_call(self):
+        """
+        Raises CircuitOpen if a call is not allowed now. When open, a single 
+        call is allowed every `reset_timeout` seconds.
+        """
+        
+        if self.state == self.CLOSED:
+            return
+        
+        with self._lock:
+            if self.state != self.CLOSED:
+                if time.time() - self.opened < self.reset_timeout:
+                    raise CircuitOpen('Not calling PayEx after %s failed calls.' % self.failures)
+                
+                self.state = self.HALF_OPEN
+                self.opened = time.time()
+    
+    def record_success(self):
+        """
+        Records a successful call, closing the breaker.
+        """
+        
+        if self.state != self.CLOSED or self.failures:
+            with self._lock:
+                self.state = self.CLOSED
+                self.failures = 0
+                self.opened = None
+    
+    def record_failure(self):
+        """
+        Records a failed call, opening the breaker after `threshold` failures.
+        """
+        
+        with self._lock:
+            self.failures += 1
+            
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.error('Opening the PayEx circuit breaker after %s failed calls.', self.failures)
+                
+                self.state = self.OPEN
+                self.opened = time.time()
+    
+    def record_response(self, response):
+        """
+        Records a call by its response, None being a failure.
+        """
+        
+        if response is None:
+            self.record_failure()
+        else:
+            self.record_success()
+    
+    def get_state(self):
+        """
+        Returns the state, number of consecutive failures and time opened, for 
+        monitoring.
+        """
+        
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+        }
+    
+    def guard(self, func):
+        """
+        Wraps a function calling PayEx with the breaker.
+        """
+        
+        def wrapper(*args, **kwargs):
+            self.before_call()
+            
+            try:
+                response = func(*args, **kwargs)
+            except Exception:
+                self.record_failure()
+                raise
+            
+            self.record_response(response)
+            
+            return response
+        
+        return wrapper
+    
+    def guard_handler(self, handler):
+        """
+        Guards a `pypayex` handler in place. The breaker is checked before the 
+        handler gets its SOAP client, which may fetch the WSDL.
+        """
+        
+        client_factory = handler.client_factory
+        send_request = handler._send_request
+        
+        def guarded_client_factory():
+            self.before_call()
+            
+            try:
+                return client_factory()
+            except Exception:
+                self.record_failure()
+                raise
+        
+        def guarded_send_request():
+            try:
+                response = send_request()
+            except Exception:
+                self.record_failure()
+                raise
+            
+            self.record_response(response)
+            
+            return response
+        
+        handler.client_factory = guarded_client_factory
+        handler._send_request = guarded_send_request
+
+class ServiceRegistry(object):
+    """
+    Registry of PayEx services, one per merchant account and environment.
+    
+    Services are kept per thread, since the `pypayex` handlers store the
+    parameters of a call on themselves. The parsed SOAP clients are shared by
+    all threads, and each thread uses a copy with its own connections. The
+    registry starts over in forked processes.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """
+        Discards all services and clients, and the state of the circuit breaker.
+        """
+        
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.clients = {}
+        self.breaker = None
+        
+        threshold = getattr(settings, 'PAYEX_CIRCUIT_BREAKER_THRESHOLD', 5)
+        if threshold:
+            self.breaker = CircuitBreaker(threshold, getattr(settings, 'PAYEX_CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+    
+    def get_service(self, merchant_number=None, encryption_key=None, production=None):
+        """
+        Returns the service for a merchant account, creating it on first use.
+        The account defaults to the PAYEX_* settings.
+        """
+        
+        if self.pid != os.getpid():
+            self.reset()
+        
+        if merchant_number is None:
+            merchant_number = settings.PAYEX_MERCHANT_NUMBER
+        if encryption_key is None:
+            encryption_key = settings.PAYEX_ENCRYPTION_KEY
+        if production is None:
+            production = settings.PAYEX_IN_PRODUCTION
+        
+        services = getattr(self.local, 'services', None)
+        if services is None:
+            services = self.local.services = {}
+        
+        key = (merchant_number, production)
+        service = services.get(key)
+        
+        if service is None:
+            service = services[key] = self.create_service(merchant_number, encryption_key, production)
+        
+        return service
+    
+    def create_service(self, merchant_number, encryption_key, production):
+        """
+        Creates a service with handlers using the shared clients, or an instance 
+        of PAYEX_SERVICE_BACKEND if set.
+        """
+        
+        backend = getattr(settings, 'PAYEX_SERVICE_BACKEND', None)
+        
+        if backend:
+            module, name = backend.rsplit('.', 1)
+            options = getattr(settings, 'PAYEX_SERVICE_BACKEND_OPTIONS', {})
+            
+            service = getattr(import_module(module), name)(merchant_number=merchant_number, encryption_key=encryption_key, production=production, **options)
+        else:
+            service = PayEx(merchant_number=merchant_number, encryption_key=encryption_key, production=production)
+            
+            # The copies of the clients used by this thread, by WSDL URL
+            clients = {}
+            
+            for handler in get_handlers(service):
+                handler.client_factory = self.get_client_factory(handler, clients)
+        
+        if metrics.get_backend() is not None:
+            instrument_service(service)
+        
+        if self.breaker is not None:
+            guard_service(service, self.breaker)
+        
+        return service
+    
+    def get_client_factory(self, handler, clients):
+        """
+        Returns a client factory for a handler, replacing the one that creates
+        a new client for every call.
+        """
+        
+        def client_factory():
+            url = get_wsdl_url(handler)
+            client = clients.get(url)
+            
+            if client is None:
+                client = clients[url] = self.get_client(url).clone()
+            
+            return client
+        
+        return client_factory
+    
+    def get_client(self, url):
+        """
+        Returns the shared client for a WSDL URL, building it on first use.
+        """
+        
+        client = self.clients.get(url)
+        
+        if client is None:
+            with self.lock:
+                client = self.clients.get(url)
+                
+                if client is None:
+                    client = self.clients[url] = build_client(url)
+        
+        return client
+
+registry = ServiceRegistry()
+
+
+def get_service(merchant_number=None, encryption_key=None, production=None):
+    """
+    Returns a PayEx service for the merchant account, defaulting to the PAYEX_*
+    settings. See `ServiceRegistry`.
+    """
+    
+    return registry.get_service(merchant_number, encryption_key, production)
+
+def get_circuit_breaker():
+    """
+    Returns the circuit breaker of the services, or None if it is disabled.
+    """
+    
+    return registry.breaker
+
+
+def get_handlers(service):
+    """
+    Returns the SOAP method handlers of a PayEx service.
+    """
+    
+    return [handler for handler in service.__dict__.values() if isinstance(handler, BaseHandler)]
+
+def instrument_service(service):
+    """
+    Records metrics of the calls made by a service, see `djpayex.metrics`.
+    
+    The requests of `pypayex` handlers are timed, so that the handlers stay in 
+    place. The methods of other services (set with PAYEX_SERVICE_BACKEND) are 
+    replaced with timed wrappers.
+    """
+    
+    handlers = [(name, handler) for name, handler in service.__dict__.items() if isinstance(handler, BaseHandler)]
+    
+    if handlers:
+        for name, handler in handlers:
+            handler._send_request = metrics.timed_call(name, handler._send_request)
+    else:
+        for name in SERVICE_METHODS:
+            if callable(getattr(service, name, None)):
+                setattr(service, name, metrics.timed_call(name, getattr(service, name)))
+
+def guard_service(service, breaker):
+    """
+    Guards the calls made by a service with a circuit breaker.
+    """
+    
+    handlers = get_handlers(service)
+    
+    if handlers:
+        for handler in handlers:
+            breaker.guard_handler(handler)
+    else:
+        for name in SERVICE_METHODS:
+            if callable(getattr(service, name, None)):
+                setattr(service, name, breaker.guard(getattr(service, name)))
+
+def get_wsdl_url(handler):
+    """
+    Returns the WSDL URL of a handler, for the environment of its service.
+    """
+    
+    if handler._service.production:
+        return handler.production_url
+    
+    return handler.testing_url
+
+def get_host(handler):
+    """
+    Returns the host a handler calls, or None if it is not a `pypayex` 
+    handler (e.g. a stand-in used in tests).
+    """
+    
+    if not isinstance(handler, BaseHandler):
+        return None
+    
+    return urlparse.urlsplit(get_wsdl_url(handler)).netloc
+
+def get_wsdl_cache():
+    """
+    Returns the on-disk cache for parsed WSDLs, or None if PAYEX_WSDL_CACHE_DIR 
+    is not set. The cache is versioned, and is kept for PAYEX_WSDL_CACHE_DAYS 
+    days (forever by default).
+    """
+    
+    location = getattr(settings, 'PAYEX_WSDL_CACHE_DIR', None)
+    
+    if not location:
+        return None
+    
+    location = os.path.join(location, 'djpayex-%s' % __version__)
+    
+    return ObjectCache(location=location, days=getattr(settings, 'PAYEX_WSDL_CACHE_DAYS', 0))
+
+def build_client(url):
+    """
+    Builds a SOAP client for a WSDL URL, with proxy settings like `pypayex` 
+    and a timeout of PAYEX_TIMEOUT seconds.
+    """
+    
+    proxy = {}
+    https_proxy = os.environ.get('PAYEX_HTTPS_PROXY') or os.environ.get('https_proxy')
+    http_proxy = os.environ.get('PAYEX_HTTP_PROXY') or os.environ.get('http_proxy')
+    
+    if https_proxy:
+        proxy['https'] = https_proxy
+    if http_proxy:
+        proxy['http'] = http_proxy
+    
+    # Cache the parsed WSDL rather than the XML document
+    timeout = getattr(settings, 'PAYEX_TIMEOUT', 30)
+    
+    cache = get_wsdl_cache()
+    if cache is not None:
+        client = Client(url, proxy=proxy, timeout=timeout, cache=cache, cachingpolicy=1)
+    else:
+        client = Client(url, proxy=proxy, timeout=timeout)
+    
+    client.set_options(transport=KeepAliveTransport())
+    client.set_options(proxy=proxy, timeout=timeout)
+    
+    return client
@@ -0,0 +1,33 @@
+"""
+Exceptions raised by django-payex.
+"""
+
+
+class PayexError(Exception):
+    """
+    Base class for errors when communicating with PayEx.
+    """
+    
+    pass
+
+class NoResponse(PayexError):
+    """
+    The PayEx service did not return a response, e.g. because of a SOAP fault.
+    """
+    
+    pass
+
+class CircuitOpen(PayexError):
+    """
+    PayEx was not called, because the circuit breaker is open after repeated 
+    failures.
+    """
+    
+    pass
+
+class ArchiveError(Exception):
+    """
+    An archive file could not be verified, and no rows were deleted.
+    """
+    
+    pass
@@ -0,0 +1,134 @@
+"""
+Export of responses as CSV or JSON lines, run by the `payex_export` management
+command and the export actions of the admin.
+
+Rows are read in chunks by primary key and written as they are read, so
+memory use does not grow with the number of rows. The output can be gzipped
+while it is written.
+"""
+
+import csv
+import datetime
+import zlib
+from cStringIO import StringIO
+
+from django.utils import simplejson as json
+from django.utils.encoding import smart_str
+
+from djpayex.fields import PayloadField, decode_payload
+from djpayex.utils import chunked_values, encode_value
+
+# Content types of the export formats
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def get_export_fields(model, fields=None):
+    """
+    Returns the names of the fields to export, all fields but the raw response
+    by default. Raises ValueError for unknown fields.
+    """
+    
+    names = [field.attname for field in model._meta.fields]
+    
+    if not fields:
+        return [field.attname for field in model._meta.fields if not isinstance(field, PayloadField)]
+    
+    for name in fields:
+        if name not in names:
+            raise ValueError('%s has no field %s.' % (model.__name__, name))
+    
+    return list(fields)
+
+def export_rows(queryset, fields=None, format='csv', chunk_size=1000):
+    """
+    Yields the rows of a queryset as CSV, with a header, or JSON lines, in
+    strings of up to `chunk_size` rows.
+    """
+    
+    if format not in FORMATS:
+        raise ValueError('Unknown export format %s.' % format)
+    
+    fields = get_export_fields(queryset.model, fields)
+    payloads = [field.attname for field in queryset.model._meta.fields if isinstance(field, PayloadField) and field.attname in fields]
+    
+    buf = StringIO()
+    writer = csv.writer(buf)
+    
+    if format == 'csv':
+        writer.writerow(fields)
+    
+    count = 0
+    
+    for row in chunked_values(queryset, fields, chunk_size):
+        for name in payloads:
+            row[name] = decode_payload(row[name])
+        
+        if format == 'csv':
+            writer.writerow([format_csv_value(row[name]) for name in fields])
+        else:
+            buf.write(json.dumps(dict((name, row[name]) for name in fields), sort_keys=True, separators=(',', ':'), default=encode_value) + '\n')
+        
+        count += 1
+        
+        if count % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    
+    if buf.tell():
+        yield buf.getvalue()
+
+def format_csv_value(value):
+    """
+    Formats a value for a CSV cell, as a UTF-8 string.
+    """
+    
+    if value is None:
+        return ''
+    
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'), default=encode_value)
+    
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    
+    return smart_str(value)
+
+def gzip_stream(chunks, compresslevel=6):
+    """
+    Compresses strings in the gzip format as they are yielded.
+    """
+    
+    # A window size over 16 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        
+        if data:
+            yield data
+    
+    yield compressor.flush()
+
+def export(queryset, fields=None, format='csv', compress=False, chunk_size=1000):
+    """
+    Yields the rows of a queryset in an export format, gzipped if `compress`
+    is True.
+    """
+    
+    chunks = export_rows(queryset, fields, format, chunk_size)
+    
+    if compress:
+        chunks = gzip_stream(chunks)
+    
+    return chunks
+
+def get_filename(model, format, compress=False):
+    """
+    Returns the name of an export file of a model.
+    """
+    
+    return '%s.%s%s' % (model._meta.module_name, format, '.gz' if compress else '')
@@ -0,0 +1,130 @@
+"""
+Model fields.
+"""
+
+import ast
+import base64
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.utils import simplejson as json
+from django.utils.encoding import smart_unicode
+
+# Prefix of compressed payloads, never the start of a JSON object
+COMPRESSED_PREFIX = 'zlib:'
+
+
+def encode_payload(value, compress_threshold=None):
+    """
+    Encodes a dictionary as canonical JSON, compressed with zlib if longer than
+    `compress_threshold` characters and smaller compressed.
+    """
+    
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'), default=smart_unicode)
+    
+    if compress_threshold is not None and len(data) > compress_threshold:
+        compressed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(data))
+        
+        if len(compressed) < len(data):
+            return compressed
+    
+    return data
+
+def decode_payload(data):
+    """
+    Decodes a payload encoded by `encode_payload`.
+    
+    Values stored by earlier versions, as the `repr` of a dictionary, are
+    decoded as well. Values that can't be decoded are returned as they are.
+    """
+    
+    if not data:
+        return {}
+    
+    if data.startswith(COMPRESSED_PREFIX):
+        return json.loads(zlib.decompress(base64.b64decode(data[len(COMPRESSED_PREFIX):])))
+    
+    try:
+        return json.loads(data)
+    except ValueError:
+        pass
+    
+    try:
+        return ast.literal_eval(data)
+    except (SyntaxError, ValueError):
+        return data
+
+def is_encoded(data):
+    """
+    Checks if a stored value is encoded by `encode_payload`, as opposed to a
+    value stored by earlier versions.
+    """
+    
+    if not data or data.startswith(COMPRESSED_PREFIX):
+        return True
+    
+    try:
+        json.loads(data)
+    except ValueError:
+        return False
+    
+    return True
+
+class PayloadDescriptor(object):
+    """
+    Decodes the stored value of a PayloadField when it is first accessed.
+    """
+    
+    def __init__(self, field):
+        self.field = field
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        
+        value = instance.__dict__[self.field.attname]
+        
+        if isinstance(value, basestring):
+            value = instance.__dict__[self.field.attname] = decode_payload(value)
+        
+        return value
+    
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+class PayloadField(models.TextField):
+    """
+    Stores a dictionary, such as a response from PayEx, as canonical JSON.
+    
+    Payloads longer than PAYEX_PAYLOAD_COMPRESS_THRESHOLD characters (1024 by
+    default, or None to never compress) are compressed with zlib. Stored values are decoded lazily, when
+    the attribute is first accessed, so loading rows does not pay for decoding.
+    """
+    
+    def contribute_to_class(self, cls, name):
+        super(PayloadField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, PayloadDescriptor(self))
+    
+    def get_compress_threshold(self):
+        return getattr(settings, 'PAYEX_PAYLOAD_COMPRESS_THRESHOLD', 1024)
+    
+    def pre_save(self, model_instance, add):
+        # Avoid decoding a value that is stored already
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        
+        return getattr(model_instance, self.attname)
+    
+    def get_prep_value(self, value):
+        if value is None:
+            return u''
+        
+        # Encoded already, or a value stored by earlier versions
+        if isinstance(value, basestring):
+            return value
+        
+        return encode_payload(value, self.get_compress_threshold())
+    
+    def value_to_string(self, obj):
+        return self.get_prep_value(self.pre_save(obj, False))
@@ -0,0 +1,229 @@
+"""
+Early rejection of callbacks that can't be from PayEx, before any database or
+network work is done for them.
+
+Callbacks are checked against the settings:
+
+    PAYEX_CALLBACK_ALLOWED_IPS          Addresses and CIDR ranges callbacks are
+                                        accepted from, e.g. the PayEx ranges
+                                        (all addresses by default)
+    PAYEX_CALLBACK_IP_HEADER            META key of the client address set by
+                                        a trusted proxy, e.g.
+                                        'HTTP_X_FORWARDED_FOR' (REMOTE_ADDR
+                                        by default)
+    PAYEX_CALLBACK_RATE_LIMIT           Callbacks per second accepted from an
+                                        address (no limit by default)
+    PAYEX_CALLBACK_RATE_LIMIT_BURST     Callbacks accepted at once from an
+                                        address (one second worth by default)
+    PAYEX_CALLBACK_STRICT               Only accept callbacks with a 32 digit
+                                        hexadecimal orderRef and transactionRef,
+                                        and an 8 digit transactionNumber
+"""
+
+import binascii
+import re
+import socket
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+
+from djpayex.metrics import get_backend as get_metrics_backend
+from djpayex.utils import RateLimiter
+
+# Formats of the callback fields in strict mode, and whether they are required
+CALLBACK_FORMATS = (
+    ('orderRef', re.compile(r'^[0-9a-fA-F]{32}$'), True),
+    ('transactionRef', re.compile(r'^[0-9a-fA-F]{32}$'), False),
+    ('transactionNumber', re.compile(r'^[0-9]{8}$'), False),
+)
+
+_filter = None
+
+
+def parse_address(address):
+    """
+    Returns the IP version and integer value of an address, or None if it is
+    not an IP address. IPv4 addresses mapped to IPv6 are returned as IPv4.
+    """
+    
+    for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        
+        value = int(binascii.hexlify(packed), 16)
+        
+        if version == 6 and value >> 32 == 0xffff:
+            return 4, value & 0xffffffff
+        
+        return version, value
+    
+    return None
+
+def parse_network(network):
+    """
+    Returns the IP version, network and netmask of an address or CIDR range as
+    integers. Raises ValueError if it is invalid.
+    """
+    
+    address, _, prefix = network.strip().partition('/')
+    parsed = parse_address(address)
+    
+    if parsed is None:
+        raise ValueError('Invalid network %s.' % network)
+    
+    version, value = parsed
+    bits = 32 if version == 4 else 128
+    
+    try:
+        prefix = int(prefix) if prefix else bits
+    except ValueError:
+        raise ValueError('Invalid network %s.' % network)
+    
+    if not 0 <= prefix <= bits:
+        raise ValueError('Invalid network %s.' % network)
+    
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+    
+    return version, value & mask, mask
+
+class IPAllowlist(object):
+    """
+    Addresses and CIDR ranges, parsed once, that addresses are checked against
+    with `in`.
+    """
+    
+    def __init__(self, networks):
+        self.networks = [parse_network(network) for network in networks]
+    
+    def __contains__(self, address):
+        parsed = parse_address(address)
+        
+        if parsed is None:
+            return False
+        
+        version, value = parsed
+        
+        for network_version, network, mask in self.networks:
+            if version == network_version and value & mask == network:
+                return True
+        
+        return False
+
+class CallbackFilter(object):
+    """
+    Checks callbacks against an allowlist of addresses, a rate limit per
+    address and the formats of the callback fields.
+    """
+    
+    def __init__(self, allowed_ips=None, ip_header=None, rate=None, burst=None, strict=False):
+        self.allowlist = IPAllowlist(allowed_ips) if allowed_ips else None
+        self.ip_header = ip_header
+        self.limiter = RateLimiter(rate, burst) if rate else None
+        self.strict = strict
+    
+    def get_client_ip(self, request):
+        """
+        Returns the address of the client, the last one in the IP header if
+        set, as that is the one added by the trusted proxy.
+        """
+        
+        if self.ip_header:
+            value = request.META.get(self.ip_header, '')
+            
+            if value:
+                return value.split(',')[-1].strip()
+        
+        return request.META.get('REMOTE_ADDR', '')
+    
+    def is_valid(self, data):
+        """
+        Checks that the callback fields have the expected formats.
+        """
+        
+        for name, pattern, required in CALLBACK_FORMATS:
+            value = data.get(name, '')
+            
+            if (value or required) and not pattern.match(value):
+                return False
+        
+        return True
+    
+    def check(self, request):
+        """
+        Returns a response rejecting a callback, or None if it is accepted.
+        """
+        
+        ip = self.get_client_ip(request)
+        
+        if self.allowlist is not None and ip not in self.allowlist:
+            return reject('forbidden', HttpResponseForbidden())
+        
+        if self.limiter is not None and not self.limiter.allow(ip):
+            return reject('rate_limited', HttpResponse('FAILURE', status=429))
+        
+        if self.strict and request.method == 'POST' and not self.is_valid(request.POST):
+            return reject('invalid', HttpResponseBadRequest('FAILURE'))
+        
+        return None
+
+def reject(reason, response):
+    """
+    Counts a rejected callback in the metrics, and returns the response.
+    """
+    
+    backend = get_metrics_backend()
+    
+    if backend is not None:
+        backend.increment('payex_callbacks_rejected_total', reason=reason)
+    
+    return response
+
+def get_filter():
+    """
+    Returns the callback filter for the PAYEX_CALLBACK_* settings.
+    """
+    
+    global _filter
+    
+    if _filter is None:
+        try:
+            _filter = CallbackFilter(
+                allowed_ips=getattr(settings, 'PAYEX_CALLBACK_ALLOWED_IPS', None),
+                ip_header=getattr(settings, 'PAYEX_CALLBACK_IP_HEADER', None),
+                rate=getattr(settings, 'PAYEX_CALLBACK_RATE_LIMIT', None),
+                burst=getattr(settings, 'PAYEX_CALLBACK_RATE_LIMIT_BURST', None),
+                strict=getattr(settings, 'PAYEX_CALLBACK_STRICT', False),
+            )
+        except ValueError as e:
+            raise ImproperlyConfigured('PAYEX_CALLBACK_ALLOWED_IPS: %s' % e)
+    
+    return _filter
+
+def reset_filter():
+    """
+    Discards the callback filter, so a new one is created from the settings.
+    """
+    
+    global _filter
+    
+    _filter = None
+
+def filter_callback(view):
+    """
+    Decorates a callback view, rejecting callbacks before calling the view.
+    """
+    
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = get_filter().check(request)
+        
+        if response is not None:
+            return response
+        
+        return view(request, *args, **kwargs)
+    
+    return wrapper
@@ -0,0 +1,96 @@
+"""
+Load test of the callback view, run by the `payex_loadtest` management command.
+
+Callbacks for new orders are posted concurrently to a running server, which
+should use a fake PayEx service (see PAYEX_SERVICE_BACKEND in
+`djpayex.client`). The rows written are counted in the database of the
+current settings, which should be the database of the server.
+"""
+
+import math
+import time
+import urllib
+import urllib2
+import uuid
+
+from djpayex.models import TransactionStatus, QueuedCallback, ProcessedCallback
+from djpayex.utils import run_concurrently
+
+
+def percentile(values, percent):
+    """
+    Returns the value at a percentile of sorted values, by the nearest rank.
+    """
+    
+    if not values:
+        return None
+    
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    
+    return values[max(0, min(index, len(values) - 1))]
+
+def count_rows():
+    """
+    Returns the number of rows in the tables written by callbacks.
+    """
+    
+    return {
+        'transaction_statuses': TransactionStatus.objects.count(),
+        'queued_callbacks': QueuedCallback.objects.count(),
+        'processed_callbacks': ProcessedCallback.objects.count(),
+    }
+
+def post_callback(url, timeout=30):
+    """
+    Posts a callback for a new order. Returns the response body, or the error,
+    and the number of seconds taken.
+    """
+    
+    data = urllib.urlencode({
+        'orderRef': uuid.uuid4().hex,
+        'transactionRef': uuid.uuid4().hex,
+        'transactionNumber': '%08d' % (uuid.uuid4().int % 100000000),
+    })
+    
+    started = time.time()
+    
+    try:
+        result = urllib2.urlopen(url, data, timeout).read().strip()
+    except urllib2.HTTPError as e:
+        result = 'HTTP %s' % e.code
+    except Exception as e:
+        result = e.__class__.__name__
+    
+    return result, time.time() - started
+
+def run_load_test(url, requests=1000, concurrency=10, timeout=30):
+    """
+    Posts `requests` callbacks to the URL with `concurrency` threads, and
+    returns a dictionary with the latency percentiles in seconds, throughput in
+    requests per second, number of responses by result and rows written.
+    """
+    
+    before = count_rows()
+    started = time.time()
+    
+    results = run_concurrently(lambda i: post_callback(url, timeout), range(requests), workers=concurrency)
+    
+    seconds = time.time() - started
+    after = count_rows()
+    
+    latencies = sorted(latency for result, latency in results)
+    responses = {}
+    for result, latency in results:
+        responses[result] = responses.get(result, 0) + 1
+    
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'throughput': requests / seconds if seconds else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'responses': responses,
+        'rows_written': dict((key, after[key] - before[key]) for key in after),
+    }
@@ -0,0 +1,171 @@
+"""
+Logging of callbacks.
+
+`QueueHandler` hands records to a background thread, which formats and writes
+them with another handler, so that log I/O never blocks the request. Configure
+it in LOGGING with the handler class and its arguments:
+
+    'payex_audit': {
+        'class': 'djpayex.log.QueueHandler',
+        'handler_class': 'logging.FileHandler',
+        'filename': '/var/log/payex/callbacks.log',
+    }
+"""
+
+import logging
+import os
+import Queue
+import random
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+# The callback audit log
+audit_logger = logging.getLogger('djpayex.audit')
+
+# Callback fields that are logged
+CALLBACK_FIELDS = ('orderRef', 'transactionRef', 'transactionNumber', )
+
+
+def redact(value, keep=4):
+    """
+    Masks all but the last `keep` characters of a value.
+    """
+    
+    if len(value) <= keep:
+        return '*' * len(value)
+    
+    return '*' * (len(value) - keep) + value[-keep:]
+
+def log_callback(request, result, seconds):
+    """
+    Logs a callback to the audit log, with the callback fields, the client
+    address, the result and the number of seconds taken.
+    
+    Fields in PAYEX_CALLBACK_LOG_REDACT are masked. Only a share of
+    PAYEX_CALLBACK_LOG_SAMPLE_RATE of the successful callbacks are logged (all
+    of them by default), and all failed ones. Nothing is done if INFO is not
+    enabled for the logger.
+    """
+    
+    if not audit_logger.isEnabledFor(logging.INFO):
+        return
+    
+    if result == 'OK':
+        sample_rate = getattr(settings, 'PAYEX_CALLBACK_LOG_SAMPLE_RATE', 1.0)
+        
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return
+    
+    redacted = getattr(settings, 'PAYEX_CALLBACK_LOG_REDACT', ())
+    
+    fields = {
+        'result': result,
+        'seconds': seconds,
+        'remote_addr': request.META.get('REMOTE_ADDR', ''),
+    }
+    
+    for name in CALLBACK_FIELDS:
+        value = request.POST.get(name, '')
+        fields[name] = redact(value) if name in redacted else value
+    
+    # Formatted lazily by the handler, the fields are also available to
+    # structured handlers as the `payex` attribute of the record
+    audit_logger.info('PayEx callback %(result)s orderRef=%(orderRef)s transactionRef=%(transactionRef)s transactionNumber=%(transactionNumber)s remote_addr=%(remote_addr)s seconds=%(seconds).3f', fields, extra={'payex': fields})
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue of at most `maxsize` records, handled by a
+    background thread with an instance of `handler_class` created with the
+    remaining arguments. Records are dropped, and counted in `dropped`, when
+    the queue is full. A forked process starts its own thread, with an empty
+    queue.
+    """
+    
+    def __init__(self, handler_class='logging.StreamHandler', maxsize=10000, **kwargs):
+        logging.Handler.__init__(self)
+        
+        if isinstance(handler_class, basestring):
+            module, name = handler_class.rsplit('.', 1)
+            handler_class = getattr(import_module(module), name)
+        
+        self.target = handler_class(**kwargs)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.reset()
+    
+    def reset(self):
+        """
+        Discards the queue and thread, e.g. the ones inherited from the parent
+        process after a fork.
+        """
+        
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.maxsize)
+        self.thread = None
+        self._lock = threading.Lock()
+    
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+    
+    def start(self):
+        """
+        Starts the background thread, if not running.
+        """
+        
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='djpayex-log')
+                self.thread.daemon = True
+                self.thread.start()
+    
+    def run(self):
+        """
+        Handles queued records until the handler is closed.
+        """
+        
+        while True:
+            record = self.queue.get()
+            
+            if record is None:
+                return
+            
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+    
+    def emit(self, record):
+        # Tracebacks are formatted now, rather than keeping the frames alive
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        
+        if self.pid != os.getpid():
+            self.reset()
+        
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def close(self, timeout=5):
+        """
+        Writes the queued records, and closes the target handler.
+        """
+        
+        if self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except Queue.Full:
+                pass
+            
+            self.thread.join(timeout)
+        
+        self.target.close()
+        logging.Handler.close(self)
@@ -0,0 +1,49 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils import timezone
+
+from djpayex.archive import ARCHIVED_MODELS, archive_model, get_retention_days
+from djpayex.exceptions import ArchiveError
+
+
+class Command(NoArgsCommand):
+    help = 'Archives responses older than the retention period of their model to compressed files, and deletes them.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--directory', help='Directory the archive files are written to.'),
+        make_option('--days', action='append', default=[], metavar='MODEL=DAYS', help='Retention period of a model in days, overriding PAYEX_RETENTION_DAYS. Can be given for several models.'),
+        make_option('--chunk-size', type='int', default=1000, help='Number of rows read per query.'),
+        make_option('--delete-batch-size', type='int', default=500, help='Number of rows deleted per transaction.'),
+        make_option('--keep', action='store_true', default=False, help='Write the archive files without deleting the rows.'),
+    )
+    
+    def handle_noargs(self, **options):
+        if not options['directory']:
+            raise CommandError('--directory is required.')
+        
+        overrides = {}
+        for value in options['days']:
+            try:
+                name, days = value.split('=', 1)
+                overrides[name.lower()] = int(days)
+            except ValueError:
+                raise CommandError('Invalid --days %r, expected MODEL=DAYS.' % value)
+        
+        retention = get_retention_days(overrides)
+        
+        for model in ARCHIVED_MODELS:
+            days = retention.get(model._meta.module_name)
+            
+            if days is None:
+                continue
+            
+            cutoff = timezone.now() - datetime.timedelta(days=days)
+            try:
+                result = archive_model(model, cutoff, options['directory'], options['chunk_size'], options['delete_batch_size'], not options['keep'])
+            except ArchiveError as e:
+                raise CommandError(str(e))
+            
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Archived %s and deleted %s %s to %s files.\n' % (result['archived'], result['deleted'], unicode(model._meta.verbose_name_plural), len(result['files'])))
@@ -0,0 +1,66 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from djpayex.autopay import AutoPayRunner
+from djpayex.models import Agreement
+
+
+class Command(NoArgsCommand):
+    help = 'Charges agreements with PayEx autopay in a resumable batch run.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--run', help='Name of the run, e.g. the billing period. Agreements are charged once per run.'),
+        make_option('--amount', type='int', default=None, help='Amount in minor units to charge every agreement created successfully.'),
+        make_option('--amounts-file', default=None, help='CSV file of agreementRef and amount in minor units to charge.'),
+        make_option('--product-number', help='Product number of the autopays.'),
+        make_option('--description', help='Description of the autopays.'),
+        make_option('--workers', type='int', default=4, help='Number of concurrent calls to PayEx.'),
+        make_option('--batch-size', type='int', default=500, help='Number of agreements per batch.'),
+        make_option('--rate', type='float', default=10, help='Maximum number of calls to PayEx per second, 0 for no limit.'),
+        make_option('--retry-failed', action='store_true', default=False, help='Charge agreements again if PayEx failed them earlier in the run.'),
+    )
+    
+    def handle_noargs(self, **options):
+        for option in ('run', 'product_number', 'description'):
+            if not options[option]:
+                raise CommandError('--%s is required.' % option.replace('_', '-'))
+        
+        agreements = Agreement.objects.filter(errorcode='OK')
+        
+        if options['amounts_file']:
+            with open(options['amounts_file'], 'rb') as f:
+                amounts = dict((row[0], int(row[1])) for row in csv.reader(f) if row)
+            
+            # Queried in batches, as SQLite limits the number of variables
+            refs = sorted(amounts)
+            batches = [agreements.filter(agreementref__in=refs[i:i + options['batch_size']]) for i in range(0, len(refs), options['batch_size'])]
+        elif options['amount']:
+            amounts = options['amount']
+            batches = [agreements]
+        else:
+            raise CommandError('Either --amount or --amounts-file is required.')
+        
+        runner = AutoPayRunner(
+            options['run'],
+            amounts,
+            options['product_number'],
+            options['description'],
+            workers=options['workers'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            retry_failed=options['retry_failed'],
+        )
+        
+        summary = dict.fromkeys(('charged', 'declined', 'failed', 'unknown', 'skipped', 'seconds', ), 0)
+        
+        for batch in batches:
+            for key, value in runner.run(batch).iteritems():
+                summary[key] += value
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Charged %(charged)s agreements in %(seconds).1f seconds: %(declined)s declined, %(failed)s failed, %(unknown)s unknown, %(skipped)s skipped.\n' % summary)
+            
+            if summary['unknown']:
+                self.stdout.write('The outcome of unknown autopays must be checked with PayEx, they are not charged again in this run.\n')
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import router, transaction
+
+from djpayex.mapping import to_integer
+from djpayex.models import TransactionStatus
+from djpayex.utils import chunked_queryset
+
+
+class Command(NoArgsCommand):
+    help = 'Sets amount_minor on transaction statuses stored by earlier versions of django-payex.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000, help='Number of rows updated per transaction.'),
+    )
+    
+    def handle_noargs(self, **options):
+        queryset = TransactionStatus.objects.filter(amount_minor__isnull=True).exclude(amount='').only('pk', 'amount')
+        updated = 0
+        
+        for chunk in chunked_queryset(queryset, options['chunk_size']):
+            with transaction.commit_on_success(using=router.db_for_write(TransactionStatus)):
+                updated += self.backfill(chunk)
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Updated %s transaction statuses.\n' % updated)
+    
+    def backfill(self, objs):
+        """
+        Sets amount_minor on the objects, with one update per distinct amount.
+        """
+        
+        pks_by_amount = {}
+        for obj in objs:
+            amount = to_integer(obj.amount)
+            
+            if amount is not None:
+                pks_by_amount.setdefault(amount, []).append(obj.pk)
+        
+        updated = 0
+        for amount, pks in pks_by_amount.iteritems():
+            updated += TransactionStatus.objects.filter(pk__in=pks).update(amount_minor=amount)
+        
+        return updated
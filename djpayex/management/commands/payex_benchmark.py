@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.utils import simplejson as json
+
+from djpayex.benchmark import run_benchmarks
+
+
+class Command(NoArgsCommand):
+    help = 'Benchmarks storing PayEx responses in a test database, and outputs the results as JSON.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--count', type='int', default=10000, help='Number of responses per benchmark.'),
+        make_option('--batch-size', type='int', default=500, help='Batch size of bulk inserts.'),
+        make_option('--output', default=None, help='File to write the results to, instead of standard output.'),
+        make_option('--noinput', action='store_false', dest='interactive', default=True, help='Do not prompt before destroying an existing test database.'),
+    )
+    
+    def handle_noargs(self, **options):
+        # Never write to the real database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        
+        try:
+            results = run_benchmarks(count=options['count'], batch_size=options['batch_size'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        
+        output = json.dumps(results, indent=2, sort_keys=True)
+        
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output + '\n')
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from djpayex.callbacks import CallbackWorker
+
+
+class Command(NoArgsCommand):
+    help = 'Completes orders for callbacks queued by the callback view (when PAYEX_CALLBACK_QUEUED is set).'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', default=4, help='Number of callbacks processed concurrently.'),
+        make_option('--batch-size', type='int', default=100, help='Number of callbacks claimed at a time.'),
+        make_option('--max-attempts', type='int', default=10, help='Attempts before a callback is marked as failed.'),
+        make_option('--backoff', type='int', default=60, help='Seconds before the first retry, doubled for each attempt.'),
+        make_option('--max-backoff', type='int', default=3600, help='Maximum number of seconds between retries.'),
+        make_option('--interval', type='int', default=5, help='Seconds between polls of an empty queue.'),
+        make_option('--once', action='store_true', default=False, help='Exit when the queue is empty.'),
+    )
+    
+    def handle_noargs(self, **options):
+        worker = CallbackWorker(
+            workers=options['workers'], 
+            batch_size=options['batch_size'], 
+            max_attempts=options['max_attempts'], 
+            backoff=options['backoff'], 
+            max_backoff=options['max_backoff']
+        )
+        
+        processed = worker.run(once=options['once'], interval=options['interval'])
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Processed %s callbacks.\n' % processed)
@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import router, transaction
+
+from djpayex.fields import decode_payload, is_encoded
+from djpayex.models import InitializedPayment, TransactionStatus, Agreement, AutoPayStatus
+from djpayex.utils import chunked_queryset
+
+
+class Command(NoArgsCommand):
+    help = 'Converts raw responses stored by earlier versions of django-payex to JSON.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000, help='Number of rows converted per transaction.'),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        
+        for model in (InitializedPayment, TransactionStatus, Agreement, AutoPayStatus):
+            field = model._meta.get_field('raw_response')
+            converted = 0
+            
+            for chunk in chunked_queryset(model.objects.only('pk', 'raw_response'), options['chunk_size']):
+                with transaction.commit_on_success(using=router.db_for_write(model)):
+                    converted += self.convert(model, field, chunk)
+            
+            if verbosity > 0:
+                self.stdout.write('Converted %s %s.\n' % (converted, model._meta.verbose_name_plural))
+    
+    def convert(self, model, field, objs):
+        """
+        Converts the objects not stored as JSON, and returns the number converted.
+        """
+        
+        converted = 0
+        
+        for obj in objs:
+            data = obj.__dict__['raw_response']
+            
+            if is_encoded(data):
+                continue
+            
+            value = decode_payload(data)
+            
+            # Leave values that were not dictionaries as they are
+            if not isinstance(value, dict):
+                continue
+            
+            model.objects.filter(pk=obj.pk).update(raw_response=field.get_prep_value(value))
+            converted += 1
+        
+        return converted
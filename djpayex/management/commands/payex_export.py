@@ -0,0 +1,69 @@
+from optparse import make_option
+
+from django.core.exceptions import FieldError
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db.models import get_model
+from django.utils.dateparse import parse_date
+
+from djpayex.export import FORMATS, export, get_export_fields
+from djpayex.models import PayexResponse
+
+
+class Command(NoArgsCommand):
+    help = 'Exports responses created in a date range as CSV or JSON lines, to a file or standard output.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', default='transactionstatus', help='Model to export, e.g. transactionstatus or autopaystatus.'),
+        make_option('--since', help='Export responses created on or after this date (YYYY-MM-DD).'),
+        make_option('--until', help='Export responses created before this date (YYYY-MM-DD).'),
+        make_option('--filter', action='append', default=[], metavar='FIELD=VALUE', help='Export only responses with a field equal to a value. Can be given several times.'),
+        make_option('--fields', help='Comma-separated fields to export, all but the raw response by default.'),
+        make_option('--format', default='csv', choices=sorted(FORMATS), help='Export format, csv or jsonl.'),
+        make_option('--gzip', action='store_true', default=False, help='Compress the export with gzip.'),
+        make_option('--output', help='File to write to, standard output by default.'),
+        make_option('--chunk-size', type='int', default=1000, help='Number of rows read per query.'),
+    )
+    
+    def handle_noargs(self, **options):
+        model = get_model('djpayex', options['model'])
+        
+        if model is None or not issubclass(model, PayexResponse):
+            raise CommandError('Unknown response model %s.' % options['model'])
+        
+        queryset = model.objects.all()
+        
+        for option, lookup in (('since', 'created__gte'), ('until', 'created__lt')):
+            if options[option]:
+                date = parse_date(options[option])
+                
+                if date is None:
+                    raise CommandError('Invalid --%s date %s.' % (option, options[option]))
+                
+                queryset = queryset.filter(**{lookup: date})
+        
+        for value in options['filter']:
+            if '=' not in value:
+                raise CommandError('Invalid --filter %r, expected FIELD=VALUE.' % value)
+            
+            name, value = value.split('=', 1)
+            
+            try:
+                queryset = queryset.filter(**{str(name): value})
+            except FieldError as e:
+                raise CommandError(str(e))
+        
+        fields = options['fields'].split(',') if options['fields'] else None
+        
+        try:
+            get_export_fields(model, fields)
+        except ValueError as e:
+            raise CommandError(str(e))
+        
+        output = open(options['output'], 'wb') if options['output'] else self.stdout
+        
+        try:
+            for chunk in export(queryset, fields, options['format'], options['gzip'], options['chunk_size']):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
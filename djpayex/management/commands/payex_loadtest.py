@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from djpayex.loadtest import run_load_test
+
+
+class Command(NoArgsCommand):
+    help = 'Posts concurrent callbacks to a running server using a fake PayEx service, and reports latency, throughput and rows written.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--url', default='http://127.0.0.1:8000/payex/callback/', help='URL of the callback view.'),
+        make_option('--requests', type='int', default=1000, help='Number of callbacks to post.'),
+        make_option('--concurrency', type='int', default=10, help='Number of callbacks posted at a time.'),
+        make_option('--timeout', type='float', default=30, help='Seconds to wait for a response.'),
+    )
+    
+    def handle_noargs(self, **options):
+        result = run_load_test(options['url'], options['requests'], options['concurrency'], options['timeout'])
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Posted %(requests)s callbacks in %(seconds).2f seconds (%(throughput).1f/s) with concurrency %(concurrency)s.\n' % result)
+            self.stdout.write('Latency: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms.\n' % (result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000))
+            self.stdout.write('Responses: %s.\n' % ', '.join('%s %s' % item for item in sorted(result['responses'].items())))
+            self.stdout.write('Rows written: %s.\n' % ', '.join('%s %s' % item for item in sorted(result['rows_written'].items())))
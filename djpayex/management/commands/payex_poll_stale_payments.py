@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from djpayex.poller import StalePaymentPoller
+
+
+class Command(NoArgsCommand):
+    help = 'Completes initialized payments without a terminal status with PayEx, for orders whose callbacks were lost.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--older-than', type='int', default=30, help='Minutes since the payment was initialized.'),
+        make_option('--max-age', type='int', default=7 * 24 * 60, help='Minutes since the payment was initialized, after which it is no longer polled (a week by default).'),
+        make_option('--limit', type='int', default=None, help='Maximum number of orders to complete.'),
+        make_option('--workers', type='int', default=4, help='Number of concurrent calls to PayEx.'),
+        make_option('--rate', type='float', default=10, help='Maximum number of calls to PayEx per second, 0 for no limit.'),
+        make_option('--max-attempts', type='int', default=3, help='Number of attempts per order.'),
+        make_option('--backoff', type='float', default=1, help='Seconds before the first retry, doubled for each attempt.'),
+        make_option('--poll-backoff', type='int', default=30, help='Minutes before an order still without a terminal status is polled again, doubled for each poll.'),
+    )
+    
+    def handle_noargs(self, **options):
+        poller = StalePaymentPoller(
+            workers=options['workers'],
+            rate=options['rate'],
+            max_attempts=options['max_attempts'],
+            backoff=options['backoff'],
+            poll_backoff=options['poll_backoff'],
+        )
+        
+        result = poller.poll(older_than=options['older_than'], limit=options['limit'], max_age=options['max_age'])
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Polled %(orders)s orders in %(seconds).1f seconds (%(rate).1f orders/s): %(completed)s completed, %(failed)s failed.\n' % result)
@@ -0,0 +1,64 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import router
+from django.utils import timezone
+
+from djpayex.models import TransactionStatus, AutoPayStatus, CurrentStatus
+from djpayex.utils import chunked_queryset, write_transaction
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the current status of orders and agreements from the stored transaction and autopay statuses.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000, help='Number of statuses read per query.'),
+        make_option('--clear', action='store_true', default=False, help='Replace the current statuses instead of only updating them, deleting those without statuses.'),
+    )
+    
+    def handle_noargs(self, **options):
+        using = router.db_for_write(CurrentStatus)
+        read = 0
+        
+        # Rows not updated since the start are cleared chunk by chunk, in the 
+        # same transaction as they are rebuilt
+        started = timezone.now() if options['clear'] else None
+        
+        for model in (TransactionStatus, AutoPayStatus):
+            manager = model.objects
+            fields = [field for reference_type, field in manager.current_status_fields]
+            queryset = manager.only('pk', 'created', 'errorcode', 'transactionstatus', 'transactionnumber', *fields)
+            
+            for chunk in chunked_queryset(queryset, options['chunk_size']):
+                with write_transaction(using):
+                    if started is not None:
+                        self.clear(manager, chunk, started)
+                    self.update(manager, chunk)
+                read += len(chunk)
+        
+        if started is not None:
+            with write_transaction(using):
+                CurrentStatus.objects.filter(updated__lt=started).delete()
+        
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Read %s statuses, %s current statuses stored.\n' % (read, CurrentStatus.objects.count()))
+    
+    def clear(self, manager, statuses, started, chunk_size=500):
+        """
+        Deletes the current statuses of the references of a chunk of statuses 
+        that have not been updated since `started`.
+        """
+        
+        for reference_type, field in manager.current_status_fields:
+            references = list(set(getattr(status, field) for status in statuses) - set([u'']))
+            
+            # Deleted in chunks, as SQLite limits the number of variables
+            for i in range(0, len(references), chunk_size):
+                CurrentStatus.objects.filter(reference_type=reference_type, reference__in=references[i:i + chunk_size], updated__lt=started).delete()
+    
+    def update(self, manager, statuses):
+        """
+        Updates the current statuses from a chunk of statuses.
+        """
+        
+        manager.update_current_status(statuses)
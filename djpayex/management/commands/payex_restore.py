@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djpayex.archive import restore_archive
+from djpayex.exceptions import ArchiveError
+
+
+class Command(BaseCommand):
+    help = 'Restores responses from archive files written by payex_archive.'
+    args = '<archive file> [<archive file> ...]'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500, help='Number of rows saved per transaction.'),
+    )
+    
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('At least one archive file is required.')
+        
+        for path in paths:
+            try:
+                restored = restore_archive(path, options['batch_size'])
+            except ArchiveError as e:
+                raise CommandError(str(e))
+            
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Restored %s rows from %s.\n' % (restored, path))
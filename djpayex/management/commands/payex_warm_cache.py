@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from payex.service import PayEx
+
+from djpayex.client import build_client, get_handlers, get_wsdl_cache, get_wsdl_url
+
+
+class Command(NoArgsCommand):
+    help = 'Fetches the PayEx WSDLs and stores the parsed service definitions in PAYEX_WSDL_CACHE_DIR.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all-environments', action='store_true', default=False, help='Cache the WSDLs for both the production and test environments.'),
+    )
+    
+    def handle_noargs(self, **options):
+        if get_wsdl_cache() is None:
+            raise CommandError('PAYEX_WSDL_CACHE_DIR is not set.')
+        
+        if options['all_environments']:
+            environments = (True, False)
+        else:
+            environments = (settings.PAYEX_IN_PRODUCTION, )
+        
+        urls = set()
+        for production in environments:
+            service = PayEx(merchant_number='', encryption_key='', production=production)
+            urls.update(get_wsdl_url(handler) for handler in get_handlers(service))
+        
+        for url in sorted(urls):
+            build_client(url)
+            
+            if int(options['verbosity']) > 0:
+                self.stdout.write('Cached %s\n' % url)
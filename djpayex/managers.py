@@ -1,79 +1,746 @@
-from django.db import models
+import datetime
+import time
+from decimal import Decimal
+from itertools import islice
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, router
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Count, Q, Sum
+from django.db.models.query import QuerySet
+from django.utils import timezone
 
-class PayexResponseManager(models.Manager):
+from djpayex import metrics, states
+from djpayex.exceptions import CircuitOpen
+from djpayex.mapping import get_mapper
+from djpayex.utils import run_concurrently, write_transaction
+
+
+class EstimatedCountQuerySet(QuerySet):
+    """
+    QuerySet of large tables, with counts estimated from the table statistics.
+    """
+    
+    def estimated_count(self, threshold=None):
+        """
+        Returns the number of objects, estimated from the table statistics on 
+        PostgreSQL and MySQL if the queryset is not filtered and the estimate 
+        is above `threshold` (PAYEX_ESTIMATED_COUNT_THRESHOLD, 10000 by 
+        default). Otherwise the objects are counted.
+        """
+        
+        if threshold is None:
+            threshold = getattr(settings, 'PAYEX_ESTIMATED_COUNT_THRESHOLD', 10000)
+        
+        if not self.query.where and not self.query.low_mark and self.query.high_mark is None:
+            estimate = self._get_table_estimate()
+            
+            if estimate is not None and estimate > threshold:
+                return estimate
+        
+        return self.count()
+    
+    def _get_table_estimate(self):
+        """
+        Returns the estimated number of rows in the table, or None if the 
+        database has no estimate.
+        """
+        
+        connection = connections[self.db]
+        
+        if connection.vendor == 'postgresql':
+            sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+        elif connection.vendor == 'mysql':
+            sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s'
+        else:
+            return None
+        
+        cursor = connection.cursor()
+        cursor.execute(sql, [self.model._meta.db_table])
+        row = cursor.fetchone()
+        
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        
+        return int(row[0])
+
+class PayexResponseQuerySet(EstimatedCountQuerySet):
+    """
+    QuerySet for classes subclassing PayexResponse, with filters on the state 
+    of transactions, see `djpayex.states`. The state filters can only be used 
+    on models with a transactionstatus field.
+    """
+    
+    def by_state(self, *names):
+        """
+        Filters on transactions in any of the states.
+        """
+        
+        return self.filter(states.get_q(*names))
+    
+    def successful(self):
+        """
+        Filters on transactions completed successfully (sales and authorizations).
+        """
+        
+        return self.by_state(states.SUCCESSFUL)
+    
+    def failed(self):
+        """
+        Filters on cancelled and failed transactions. Requests that failed 
+        are in the ERROR state rather than this one.
+        """
+        
+        return self.by_state(states.FAILED)
+    
+    def pending(self):
+        """
+        Filters on transactions that are initialized but not completed.
+        """
+        
+        return self.by_state(states.PENDING)
+    
+    def completed_successfully(self):
+        """
+        Filters on transactions completed successfully, same as `successful`.
+        """
+        
+        return self.successful()
+
+class EstimatedCountManager(models.Manager):
+    """
+    Manager of large tables, see `EstimatedCountQuerySet`.
+    """
+    
+    queryset_class = EstimatedCountQuerySet
+    
+    def get_query_set(self):
+        return self.queryset_class(self.model, using=self._db)
+    
+    def estimated_count(self, threshold=None):
+        return self.get_query_set().estimated_count(threshold)
+
+class PayexResponseManager(EstimatedCountManager):
     """
     Manager with convenience methods for classes subclassing PayexResponse.
     """
     
+    queryset_class = PayexResponseQuerySet
+    
+    # The (reference type, field) pairs of the CurrentStatus rows kept up to 
+    # date with the stored objects
+    current_status_fields = ()
+    
+    def by_state(self, *names):
+        return self.get_query_set().by_state(*names)
+    
+    def successful(self):
+        return self.get_query_set().successful()
+    
+    def failed(self):
+        return self.get_query_set().failed()
+    
+    def pending(self):
+        return self.get_query_set().pending()
+    
+    def completed_successfully(self):
+        return self.get_query_set().completed_successfully()
+    
     def create_from_response(self, response, obj=None, commit=True):
         """
         Sets variables on an object based on a response dictionary from `pypayex`.
-        """
         
-        available_fields = self.model._meta.get_all_field_names()
+        Values are coerced to the type of the model field they are set on, see 
+        `djpayex.mapping`.
+        """
         
         # Instantiate a new object if not provided
         if obj is None:
             obj = self.model()
         
-        obj.raw_response = response
+        get_mapper(self.model).apply(response, obj)
         
-        # Explicitly set response status
-        if 'status' in response:
-            obj.errorcode = response['status']['errorCode']
-            obj.description = response['status']['description']
-            obj.paramname = response['status']['paramName'] or u''
-            obj.thirdpartyerror = response['status']['thirdPartyError'] or u''
+        if commit:
+            backend = metrics.get_backend()
+            started = time.time()
+            
+            with write_transaction(router.db_for_write(self.model)):
+                obj.save()
+                self.update_current_status([obj])
+            
+            if backend is not None:
+                metrics.record_save(backend, self.model._meta.module_name, obj.errorcode, time.time() - started)
+        
+        return obj
+    
+    def bulk_create_from_responses(self, responses, batch_size=500, ignore_conflicts=False):
+        """
+        Creates objects from an iterable of response dictionaries from `pypayex`, 
+        inserting them with `bulk_create` in batches of `batch_size`. Items can 
+        also be (response, obj) tuples, to set the responses on given objects.
+        
+        The iterable is consumed lazily, so generators of any length can be used. 
+        If `ignore_conflicts` is set, responses with a header id that is already 
+        stored (or seen earlier in the iterable) are skipped, which makes it safe 
+        to replay the same responses again.
+        
+        Returns the number of inserted objects.
+        """
         
-        # Explicitly set eventual error codes
-        if 'errorDetails' in response:
-            obj.transactionerrorcode = response['errorDetails']['transactionErrorCode'] or u''
-            obj.transactionerrordescription = response['errorDetails']['transactionErrorDescription'] or u''
-            obj.transactionthirdpartyerror = response['errorDetails']['transactionThirdPartyError'] or u''
+        responses = iter(responses)
+        inserted = 0
         
-        # Set response on available fields
-        for key, val in response.iteritems():
+        while True:
+            objs = []
+            for item in islice(responses, batch_size):
+                if isinstance(item, tuple):
+                    objs.append(self.create_from_response(item[0], obj=item[1], commit=False))
+                else:
+                    objs.append(self.create_from_response(item, commit=False))
             
-            # Normalize key case
-            key = key.lower()
+            if not objs:
+                break
             
-            # Convert None values to empty strings
-            if val is None:
-                val = u''
+            if ignore_conflicts:
+                objs = self._exclude_conflicts(objs)
             
-            if key in available_fields:
-                setattr(obj, key, val)
+            if objs:
+                backend = metrics.get_backend()
+                started = time.time()
+                
+                with write_transaction(router.db_for_write(self.model)):
+                    size = self._get_insert_batch_size(batch_size)
+                    chunks = iter(objs)
+                    
+                    while True:
+                        chunk = list(islice(chunks, size))
+                        
+                        if not chunk:
+                            break
+                        
+                        self.bulk_create(chunk)
+                    self.update_current_status(self._get_stored(objs))
+                
+                if backend is not None:
+                    metrics.record_bulk_save(backend, self.model._meta.module_name, objs, time.time() - started)
+                
+                inserted += len(objs)
         
-        if commit:
-            obj.save()
+        return inserted
+    
+    def update_current_status(self, objs):
+        """
+        Updates the CurrentStatus of the orders and agreements of the stored 
+        objects, where an object is newer than the current status.
+        """
         
-        return obj
+        if self.current_status_fields:
+            CurrentStatus = models.get_model('djpayex', 'CurrentStatus')
+            CurrentStatus.objects.update_from_statuses(objs, self.current_status_fields)
+    
+    def _get_insert_batch_size(self, batch_size):
+        """
+        Returns the number of objects inserted per `bulk_create` call, fewer 
+        than `batch_size` on SQLite, which limits the number of variables and 
+        compound selects in a query.
+        """
+        
+        connection = connections[router.db_for_write(self.model)]
+        
+        if connection.vendor == 'sqlite':
+            return max(1, min(batch_size, 500, 999 // len(self.model._meta.fields)))
+        
+        return batch_size
+    
+    def _get_stored(self, objs, chunk_size=500):
+        """
+        Returns the stored objects for the orders and agreements of objects 
+        inserted with `bulk_create`, which leaves their primary keys unset. 
+        Objects stored for them at the same time are returned too, 
+        `update_current_status` applies them all in order.
+        """
+        
+        stored = {}
+        created = min(obj.created for obj in objs)
+        
+        for reference_type, field in self.current_status_fields:
+            references = list(set(getattr(obj, field) for obj in objs) - set([u'']))
+            
+            # Queried in chunks, as SQLite limits the number of variables
+            for i in range(0, len(references), chunk_size):
+                queryset = self.filter(created__gte=created, **{'%s__in' % field: references[i:i + chunk_size]})
+                stored.update((obj.pk, obj) for obj in queryset)
+        
+        return stored.values()
+    
+    def _exclude_conflicts(self, objs):
+        """
+        Filters out objects with a header id that is already stored, or repeated 
+        within the batch. Earlier batches are stored, so one query is enough.
+        """
+        
+        headerids = [obj.headerid for obj in objs if obj.headerid]
+        seen = set(self.filter(headerid__in=headerids).values_list('headerid', flat=True))
+        
+        unique = []
+        for obj in objs:
+            if obj.headerid:
+                if obj.headerid in seen:
+                    continue
+                seen.add(obj.headerid)
+            unique.append(obj)
+        
+        return unique
 
 class InitializedPaymentManager(PayexResponseManager):
     """
     Manager for InitializedPayment model.
     """
     
-    pass
+    def for_order(self, orderref):
+        """
+        Returns the initializations of an order.
+        """
+        
+        return self.filter(orderref=orderref)
+
+class TransactionStatusQuerySet(PayexResponseQuerySet):
+    """
+    QuerySet for TransactionStatus model, with aggregation of amounts in the database.
+    """
+    
+    def total_amount(self):
+        """
+        Returns the sum of the amounts as Decimal.
+        """
+        
+        total = self.aggregate(total=Sum('amount_minor'))['total'] or 0
+        
+        return Decimal(total) / 100
+    
+    def totals_by(self, field):
+        """
+        Returns the sum and number of amounts grouped by a field, or by 'day' 
+        of creation, as a list of dictionaries with the keys `field`, 'total' 
+        (as Decimal) and 'count', ordered by `field`.
+        """
+        
+        queryset = self
+        
+        if field == 'day':
+            connection = connections[self.db]
+            created = '%s.%s' % (connection.ops.quote_name(self.model._meta.db_table), connection.ops.quote_name('created'))
+            queryset = queryset.extra(select={'day': connection.ops.date_trunc_sql('day', created)})
+        
+        totals = queryset.values(field).annotate(total=Sum('amount_minor'), count=Count('pk')).order_by(field)
+        
+        results = []
+        for row in totals:
+            key = row[field]
+            
+            # SQLite returns the day as a string
+            if field == 'day' and isinstance(key, basestring):
+                key = typecast_timestamp(key)
+            if field == 'day' and isinstance(key, datetime.datetime):
+                key = key.date()
+            
+            results.append({field: key, 'total': Decimal(row['total'] or 0) / 100, 'count': row['count']})
+        
+        return results
 
 class TransactionStatusManager(PayexResponseManager):
     """
     Manager for TransactionStatus model.
     """
     
-    pass
+    queryset_class = TransactionStatusQuerySet
+    
+    current_status_fields = (('order', 'orderref'), ('agreement', 'agreementref'), )
+    
+    def total_amount(self):
+        return self.get_query_set().total_amount()
+    
+    def totals_by(self, field):
+        return self.get_query_set().totals_by(field)
+    
+    def for_order(self, orderref):
+        """
+        Returns the statuses of an order.
+        """
+        
+        return self.filter(orderref=orderref)
+    
+    def latest_for_order(self, orderref):
+        """
+        Returns the latest status of an order, or None. Uses the index on 
+        (orderref, created).
+        """
+        
+        try:
+            return self.filter(orderref=orderref).order_by('-created', '-id')[0]
+        except IndexError:
+            return None
+    
+    def for_agreement(self, agreementref):
+        """
+        Returns the statuses of transactions on an agreement.
+        """
+        
+        return self.filter(agreementref=agreementref)
 
 class AgreementManager(PayexResponseManager):
     """
     Manager for Agreement model.
     """
     
-    pass
+    def for_agreement(self, agreementref):
+        """
+        Returns the agreements with a reference.
+        """
+        
+        return self.filter(agreementref=agreementref)
+    
+    def get_cache_key(self, agreementref):
+        """
+        Returns the cache key for the verification status of an agreement.
+        """
+        
+        return 'djpayex:agreement-verified:%s' % agreementref
+    
+    def get_cache_timeout(self):
+        """
+        Returns the number of seconds verification statuses are cached for.
+        """
+        
+        return getattr(settings, 'PAYEX_AGREEMENT_CACHE_TIMEOUT', 300)
+    
+    def get_stale_cache_key(self, agreementref):
+        """
+        Returns the cache key for the last known verification status of an 
+        agreement, served while PayEx can't be called.
+        """
+        
+        return 'djpayex:agreement-verified-stale:%s' % agreementref
+    
+    def get_stale_cache_timeout(self):
+        """
+        Returns the number of seconds last known verification statuses are 
+        cached for.
+        """
+        
+        return getattr(settings, 'PAYEX_AGREEMENT_STALE_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+    
+    def check_agreement(self, agreementref):
+        """
+        Checks with PayEx if an agreement is verified. Returns None if PayEx 
+        did not return a response.
+        """
+        
+        from djpayex.client import get_service
+        
+        response = get_service().check_agreement(agreementRef=agreementref)
+        
+        if response is None:
+            return None
+        
+        if response['status']['description'] == 'OK':
+            return response['agreementStatus'] == '1'
+        
+        return False
+    
+    def check_agreement_or_stale(self, agreementref):
+        """
+        Checks with PayEx if an agreement is verified, like `check_agreement`. 
+        If the circuit breaker is open, the last known status is returned 
+        instead, or None. Returns the status and whether it is fresh.
+        """
+        
+        try:
+            return self.check_agreement(agreementref), True
+        except CircuitOpen:
+            return cache.get(self.get_stale_cache_key(agreementref)), False
+    
+    def set_cached(self, values):
+        """
+        Caches fresh verification statuses, by agreementref.
+        """
+        
+        timeout = self.get_cache_timeout()
+        
+        if timeout and values:
+            cache.set_many(dict((self.get_cache_key(agreementref), value) for agreementref, value in values.iteritems()), timeout)
+            cache.set_many(dict((self.get_stale_cache_key(agreementref), value) for agreementref, value in values.iteritems()), self.get_stale_cache_timeout())
+    
+    def verify(self, agreementref, use_cache=True):
+        """
+        Checks if an agreement is verified, using the cached status if available.
+        
+        While the circuit breaker is open, the last known status is returned.
+        """
+        
+        timeout = self.get_cache_timeout()
+        key = self.get_cache_key(agreementref)
+        
+        if use_cache and timeout:
+            verified = cache.get(key)
+            
+            if verified is not None:
+                return verified
+        
+        verified, fresh = self.check_agreement_or_stale(agreementref)
+        
+        if verified is None:
+            return False
+        
+        if fresh:
+            self.set_cached({agreementref: verified})
+        
+        return verified
+    
+    def verify_many(self, queryset, max_workers=4):
+        """
+        Checks if the agreements in a queryset are verified, and returns a dictionary 
+        of agreementref to bool. Agreements without a cached status are checked 
+        with PayEx concurrently, using up to `max_workers` threads.
+        """
+        
+        agreementrefs = set(queryset.values_list('agreementref', flat=True))
+        agreementrefs.discard(u'')
+        
+        timeout = self.get_cache_timeout()
+        verified = {}
+        
+        # Look up cached statuses
+        if timeout:
+            keys = dict((self.get_cache_key(agreementref), agreementref) for agreementref in agreementrefs)
+            
+            for key, value in cache.get_many(keys.keys()).iteritems():
+                verified[keys[key]] = value
+        
+        # Check the rest with PayEx
+        unchecked = [agreementref for agreementref in agreementrefs if agreementref not in verified]
+        results = run_concurrently(self.check_agreement_or_stale, unchecked, workers=max_workers)
+        
+        checked = {}
+        for agreementref, (value, fresh) in zip(unchecked, results):
+            verified[agreementref] = bool(value)
+            
+            if value is not None and fresh:
+                checked[agreementref] = value
+        
+        self.set_cached(checked)
+        
+        return verified
+    
+    def invalidate(self, agreementref):
+        """
+        Removes the cached verification status of an agreement.
+        """
+        
+        cache.delete(self.get_cache_key(agreementref))
+        cache.delete(self.get_stale_cache_key(agreementref))
 
 class AutoPayStatusManager(PayexResponseManager):
     """
     Manager for AutoPayStatus model.
     """
     
-    pass
+    current_status_fields = (('agreement', 'agreementref'), )
+    
+    def for_agreement(self, agreementref):
+        """
+        Returns the autopay statuses of an agreement.
+        """
+        
+        return self.filter(agreementref=agreementref)
+
+class PolledPaymentManager(EstimatedCountManager):
+    """
+    Manager for PolledPayment model.
+    """
+    
+    def record(self, orderrefs, backoff=30, max_backoff=24 * 60):
+        """
+        Records a poll of orders that are still without a terminal status, and 
+        schedules the next poll of each after `backoff` minutes, doubled for 
+        each poll and capped at `max_backoff`.
+        """
+        
+        now = timezone.now()
+        existing = dict((obj.orderref, obj) for obj in self.filter(orderref__in=orderrefs))
+        new = []
+        
+        for orderref in orderrefs:
+            obj = existing.get(orderref)
+            
+            if obj is None:
+                obj = self.model(orderref=orderref)
+                new.append(obj)
+            
+            obj.attempts += 1
+            obj.next_poll = now + datetime.timedelta(minutes=min(backoff * 2 ** (obj.attempts - 1), max_backoff))
+            
+            if obj.pk:
+                self.filter(pk=obj.pk).update(attempts=obj.attempts, next_poll=obj.next_poll, updated=now)
+        
+        self.bulk_create(new)
+
+class CurrentStatusManager(EstimatedCountManager):
+    """
+    Manager for CurrentStatus model.
+    """
+    
+    def for_order(self, orderref):
+        """
+        Returns the current status of an order, or None.
+        """
+        
+        return self.for_reference(self.model.ORDER, orderref)
+    
+    def for_agreement(self, agreementref):
+        """
+        Returns the current status of an agreement, or None.
+        """
+        
+        return self.for_reference(self.model.AGREEMENT, agreementref)
+    
+    def for_reference(self, reference_type, reference):
+        """
+        Returns the current status of an order or agreement, or None.
+        """
+        
+        try:
+            return self.get(reference_type=reference_type, reference=reference)
+        except self.model.DoesNotExist:
+            return None
+    
+    def update_from_statuses(self, statuses, fields):
+        """
+        Updates the current statuses from stored TransactionStatus or 
+        AutoPayStatus objects, given the (reference type, field) pairs to 
+        take the references from.
+        """
+        
+        latest = {}
+        
+        for status in sorted(statuses, key=lambda status: (status.created, status.pk)):
+            for reference_type, field in fields:
+                reference = getattr(status, field)
+                
+                if not reference:
+                    continue
+                
+                key = (reference_type, reference)
+                other = latest.get(key)
+                
+                if other is None or self.replaces(reference_type, other, status):
+                    latest[key] = status
+        
+        for (reference_type, reference), status in latest.iteritems():
+            self.update_from_status(reference_type, reference, status)
+    
+    def replaces(self, reference_type, current, status):
+        """
+        Checks if a newer status replaces the current status of an order or 
+        agreement. The status of an order only changes along the transitions 
+        in `djpayex.states` once terminal, while an agreement follows the 
+        latest status of any of its transactions.
+        """
+        
+        if reference_type != self.model.ORDER:
+            return True
+        
+        return states.can_replace(current.errorcode, current.transactionstatus, status.errorcode, status.transactionstatus)
+    
+    def update_from_status(self, reference_type, reference, status):
+        """
+        Sets a stored status as the current status of an order or agreement, 
+        unless the current status is newer, or is not replaced by the status 
+        (see `replaces`). Safe to call concurrently, the update is conditional 
+        on the current status being older and replaceable.
+        """
+        
+        values = {
+            'errorcode': status.errorcode,
+            'transactionstatus': status.transactionstatus,
+            'transactionnumber': status.transactionnumber,
+            'state': states.get_state(status.errorcode, status.transactionstatus) or u'',
+            'status_model': status._meta.concrete_model._meta.module_name,
+            'status_id': status.pk,
+            'status_created': status.created,
+        }
+        
+        current, created = self.get_or_create(reference_type=reference_type, reference=reference, defaults=values)
+        
+        if not created:
+            older = Q(status_created__lt=status.created) | Q(status_created=status.created, status_id__lt=status.pk)
+            queryset = self.filter(older, pk=current.pk)
+            
+            if reference_type == self.model.ORDER:
+                queryset = queryset.filter(states.get_replaceable_q(status.errorcode, status.transactionstatus))
+            
+            queryset.update(updated=timezone.now(), **values)
+
+class QueuedCallbackManager(EstimatedCountManager):
+    """
+    Manager for QueuedCallback model.
+    """
+    
+    def enqueue(self, orderref, transactionref='', transactionnumber='', claimed=False):
+        """
+        Queues a callback for processing by a worker. Claimed callbacks are 
+        processed by the caller, and only picked up by workers when stale.
+        """
+        
+        status = self.model.PROCESSING if claimed else self.model.PENDING
+        
+        return self.create(orderref=orderref, transactionref=transactionref, transactionnumber=transactionnumber, status=status)
+    
+    def claim(self, limit=100, stale_after=600):
+        """
+        Claims up to `limit` callbacks that are due for processing, and returns them.
+        
+        Callbacks left processing for more than `stale_after` seconds (e.g. by a 
+        worker that crashed) are claimed again. Each callback is claimed with a 
+        conditional update, so concurrent workers never claim the same callback.
+        """
+        
+        now = timezone.now()
+        stale = now - datetime.timedelta(seconds=stale_after)
+        
+        due = self.filter(
+            Q(status=self.model.PENDING, next_attempt__lte=now) | 
+            Q(status=self.model.PROCESSING, updated__lt=stale)
+        ).order_by('next_attempt')[:limit]
+        
+        claimed = []
+        for item in due:
+            updated = self.filter(pk=item.pk, status=item.status, updated=item.updated).update(status=self.model.PROCESSING, updated=now)
+            
+            if updated:
+                item.status = self.model.PROCESSING
+                item.updated = now
+                claimed.append(item)
+        
+        return claimed
+
+class ProcessedCallbackManager(models.Manager):
+    """
+    Manager for ProcessedCallback model.
+    """
+    
+    def is_processed(self, orderref, transactionnumber):
+        """
+        Checks if a callback for the transaction has been processed.
+        """
+        
+        return self.filter(orderref=orderref, transactionnumber=transactionnumber).exists()
+    
+    def mark_processed(self, orderref, transactionnumber):
+        """
+        Records that a callback for the transaction has been processed. Safe to 
+        call concurrently, the unique index decides which call creates the row.
+        """
+        
+        return self.get_or_create(orderref=orderref, transactionnumber=transactionnumber)[0]
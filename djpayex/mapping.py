@@ -0,0 +1,206 @@
+"""
+Mapping of response dictionaries from `pypayex` onto PayexResponse models.
+"""
+
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.encoding import smart_unicode
+
+# Compiled mappers, one per model
+_mappers = {}
+
+
+def get_mapper(model):
+    """
+    Returns the mapper for a model, compiling it on first use.
+    """
+    
+    mapper = _mappers.get(model)
+    
+    if mapper is None:
+        mapper = _mappers[model] = ResponseMapper(model)
+    
+    return mapper
+
+############
+# Coercion #
+############
+
+def to_text(value):
+    """
+    Converts a value to unicode, with None as an empty string.
+    """
+    
+    if value is None:
+        return u''
+    
+    return smart_unicode(value)
+
+def to_boolean(value):
+    """
+    Converts booleans given as strings ('true', 'False', '1') to bool.
+    """
+    
+    if isinstance(value, bool):
+        return value
+    
+    if value is None:
+        return False
+    
+    return smart_unicode(value).strip().lower() in (u'true', u'1', u'yes')
+
+def to_integer(value):
+    """
+    Converts a value to int, or None if it is empty or invalid.
+    """
+    
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_decimal(value):
+    """
+    Converts a value to Decimal, or None if it is empty or invalid.
+    """
+    
+    try:
+        return Decimal(smart_unicode(value))
+    except (TypeError, InvalidOperation):
+        return None
+
+def to_date(value):
+    """
+    Converts a 'YYYY-MM-DD' string to a date, or None if it is invalid.
+    """
+    
+    if isinstance(value, datetime.date):
+        return value
+    
+    try:
+        return parse_date(smart_unicode(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+def to_datetime(value):
+    """
+    Converts a 'YYYY-MM-DD HH:MM:SS' string to a datetime, or None if it is invalid.
+    """
+    
+    if not isinstance(value, datetime.datetime):
+        try:
+            value = parse_datetime(smart_unicode(value))
+        except (TypeError, ValueError):
+            return None
+    
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    
+    return value
+
+# Coercion functions by internal field type, text is used for the rest
+COERCIONS = {
+    'BooleanField': to_boolean,
+    'IntegerField': to_integer,
+    'BigIntegerField': to_integer,
+    'PositiveIntegerField': to_integer,
+    'PositiveSmallIntegerField': to_integer,
+    'SmallIntegerField': to_integer,
+    'DecimalField': to_decimal,
+    'DateField': to_date,
+    'DateTimeField': to_datetime,
+}
+
+class ResponseMapper(object):
+    """
+    Sets values from a response dictionary on an object.
+    
+    The model fields are introspected once, and response keys are resolved to
+    field setters the first time they are seen, so mapping a response is a
+    dictionary lookup per key present in the response.
+    
+    A model can set a response key on additional fields with a 
+    `response_aliases` attribute, mapping lowercase keys to field names.
+    """
+    
+    # Fields that are never set from a response key
+    excluded_fields = ('raw_response', 'headerid', 'created', 'updated', )
+    
+    def __init__(self, model):
+        self.model = model
+        
+        # Setters by lowercase field name
+        self.fields = {}
+        for field in model._meta.fields:
+            if field.primary_key or field.name in self.excluded_fields:
+                continue
+            
+            self.fields[field.name] = (self.get_field_setter(field), )
+        
+        # Additional setters for aliased keys
+        for key, names in getattr(model, 'response_aliases', {}).iteritems():
+            setters = tuple(self.get_field_setter(model._meta.get_field(name)) for name in names)
+            self.fields[key] = self.fields.get(key, ()) + setters
+        
+        # Setters by response key, resolved lazily
+        self.keys = {}
+    
+    def get_field_setter(self, field):
+        """
+        Returns the (attname, coerce) setter for a field.
+        """
+        
+        return (field.attname, COERCIONS.get(field.get_internal_type(), to_text))
+    
+    def get_setters(self, key):
+        """
+        Returns the (attname, coerce) setters for a response key, or None.
+        """
+        
+        try:
+            return self.keys[key]
+        except KeyError:
+            setters = self.keys[key] = self.fields.get(key.lower())
+            return setters
+    
+    def apply(self, response, obj):
+        """
+        Sets the response on the object.
+        """
+        
+        obj.raw_response = response
+        
+        # Explicitly set response status
+        status = response.get('status')
+        if status:
+            obj.errorcode = status['errorCode'] or u''
+            obj.description = status['description'] or u''
+            obj.paramname = status['paramName'] or u''
+            obj.thirdpartyerror = status['thirdPartyError'] or u''
+        
+        # Keep the unique id of the response message from the header
+        header = response.get('header')
+        if header:
+            obj.headerid = header['id'] or u''
+        
+        # Explicitly set eventual error codes
+        details = response.get('errorDetails')
+        if details:
+            obj.transactionerrorcode = details['transactionErrorCode'] or u''
+            obj.transactionerrordescription = details['transactionErrorDescription'] or u''
+            obj.transactionthirdpartyerror = details['transactionThirdPartyError'] or u''
+        
+        # Set response on available fields
+        get_setters = self.get_setters
+        for key, val in response.iteritems():
+            setters = get_setters(key)
+            
+            if setters is not None:
+                for attname, coerce in setters:
+                    setattr(obj, attname, coerce(val))
+        
+        return obj
@@ -0,0 +1,242 @@
+"""
+Metrics of calls to PayEx and saves of responses.
+
+Metrics are recorded by the backend set with PAYEX_METRICS_BACKEND, the dotted
+path of a class with the methods of `Backend`. Without a backend nothing is
+recorded, and the instrumented code only checks that the backend is None.
+
+`InMemoryBackend` keeps the metrics in the process, and renders them in the
+Prometheus text format for the `djpayex.views.metrics` view.
+
+Recorded metrics, tagged by method or model, and errorcode:
+    
+    payex_calls_total               Calls to PayEx
+    payex_call_seconds              Duration of calls to PayEx
+    payex_saves_total               Saved responses
+    payex_save_seconds              Duration of saving responses
+    payex_bulk_save_seconds         Duration of saving batches of responses
+    payex_callbacks_rejected_total  Callbacks rejected by `djpayex.firewall`, by
+                                    reason
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+# Marks the backend as not loaded
+UNSET = object()
+
+_backend = UNSET
+
+
+def get_backend():
+    """
+    Returns the metrics backend, or None if metrics are disabled.
+    """
+    
+    global _backend
+    
+    if _backend is UNSET:
+        path = getattr(settings, 'PAYEX_METRICS_BACKEND', None)
+        
+        if path:
+            module, name = path.rsplit('.', 1)
+            _backend = getattr(import_module(module), name)()
+        else:
+            _backend = None
+    
+    return _backend
+
+def reset():
+    """
+    Discards the backend, so it is loaded again from the settings.
+    """
+    
+    global _backend
+    
+    _backend = UNSET
+
+def get_errorcode(response):
+    """
+    Returns the errorCode of a response, for tagging metrics.
+    """
+    
+    if response is None:
+        return 'NO_RESPONSE'
+    
+    try:
+        return response['status']['errorCode'] or ''
+    except (KeyError, TypeError):
+        return ''
+
+def timed_call(method, func):
+    """
+    Wraps a function calling PayEx, recording the duration and errorCode of
+    the calls as `method`.
+    """
+    
+    def wrapper(*args, **kwargs):
+        backend = get_backend()
+        
+        if backend is None:
+            return func(*args, **kwargs)
+        
+        started = time.time()
+        
+        try:
+            response = func(*args, **kwargs)
+        except Exception:
+            record_call(backend, method, 'EXCEPTION', time.time() - started)
+            raise
+        
+        record_call(backend, method, get_errorcode(response), time.time() - started)
+        
+        return response
+    
+    return wrapper
+
+def record_call(backend, method, errorcode, seconds):
+    """
+    Records a call to PayEx.
+    """
+    
+    backend.increment('payex_calls_total', method=method, errorcode=errorcode)
+    backend.observe('payex_call_seconds', seconds, method=method, errorcode=errorcode)
+
+def record_save(backend, model, errorcode, seconds):
+    """
+    Records a saved response.
+    """
+    
+    backend.increment('payex_saves_total', model=model, errorcode=errorcode)
+    backend.observe('payex_save_seconds', seconds, model=model, errorcode=errorcode)
+
+def record_bulk_save(backend, model, objs, seconds):
+    """
+    Records a batch of responses saved with `bulk_create`.
+    """
+    
+    counts = {}
+    for obj in objs:
+        counts[obj.errorcode] = counts.get(obj.errorcode, 0) + 1
+    
+    for errorcode, count in counts.iteritems():
+        backend.increment('payex_saves_total', count, model=model, errorcode=errorcode)
+    
+    backend.observe('payex_bulk_save_seconds', seconds, model=model)
+
+class Backend(object):
+    """
+    Metrics backend recording nothing, the base class of backends.
+    """
+    
+    def increment(self, name, value=1, **tags):
+        """
+        Increments a counter.
+        """
+        
+        pass
+    
+    def observe(self, name, value, **tags):
+        """
+        Records a value in a histogram.
+        """
+        
+        pass
+
+class InMemoryBackend(Backend):
+    """
+    Keeps counters and histograms in memory, per process.
+    """
+    
+    # Upper bounds of the histogram buckets, in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, )
+    
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+    
+    def get_key(self, name, tags):
+        """
+        Returns the key of a metric with tags.
+        """
+        
+        return (name, tuple(sorted(tags.items())))
+    
+    def increment(self, name, value=1, **tags):
+        key = self.get_key(name, tags)
+        
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **tags):
+        key = self.get_key(name, tags)
+        
+        with self._lock:
+            histogram = self.histograms.get(key)
+            
+            if histogram is None:
+                # Counts per bucket, sum and count
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def clear(self):
+        """
+        Removes all metrics.
+        """
+        
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+    
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(value[0]), value[1], value[2]]) for key, value in self.histograms.items())
+        
+        lines = []
+        types = set()
+        
+        for (name, tags), value in counters:
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE %s counter' % name)
+            
+            lines.append('%s%s %s' % (name, format_labels(tags), value))
+        
+        for (name, tags), (counts, total, count) in histograms:
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %s' % (name, format_labels(tags + (('le', repr(float(bound))), )), bucket_count))
+            
+            lines.append('%s_bucket%s %s' % (name, format_labels(tags + (('le', '+Inf'), )), count))
+            lines.append('%s_sum%s %r' % (name, format_labels(tags), total))
+            lines.append('%s_count%s %s' % (name, format_labels(tags), count))
+        
+        return '\n'.join(lines) + '\n'
+
+def format_labels(tags):
+    """
+    Formats (name, value) pairs as Prometheus labels.
+    """
+    
+    if not tags:
+        return ''
+    
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in tags)
@@ -1,9 +1,13 @@
 from decimal import Decimal
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from djpayex.managers import InitializedPaymentManager, TransactionStatusManager, AgreementManager, AutoPayStatusManager
+from djpayex import states
+from djpayex.fields import PayloadField
+from djpayex.managers import EstimatedCountManager, InitializedPaymentManager, TransactionStatusManager, AgreementManager, AutoPayStatusManager, PolledPaymentManager, CurrentStatusManager, QueuedCallbackManager, ProcessedCallbackManager
 
 
 class PayexResponse(models.Model):
@@ -17,11 +21,14 @@ class PayexResponse(models.Model):
     paramname = models.CharField(_('paramName'), max_length=255, blank=True, help_text=_('Name of the parameter that contains invalid data.'))
     thirdpartyerror = models.CharField(_('thirdPartyError'), max_length=255, blank=True, help_text=_('Error code received from third party (if returned).'))
     
-    # The raw response received from the client
-    raw_response = models.TextField(_('raw response'), blank=True)
+    # Unique id of the response message, from the response header
+    headerid = models.CharField(_('header id'), max_length=255, blank=True, db_index=True, help_text=_('Unique id of the response, used to detect replayed responses.'))
+    
+    # The raw response received from the client, stored as JSON
+    raw_response = PayloadField(_('raw response'), blank=True)
     
     # Timestamps
-    created = models.DateTimeField(_('created'), auto_now_add=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True, db_index=True)
     updated = models.DateTimeField(_('updated'), auto_now=True)
     
     class Meta:
@@ -36,7 +43,7 @@ class InitializedPayment(PayexResponse):
     Initialization of a Payment.
     """
     
-    orderref = models.CharField(_('orderRef'), max_length=255, blank=True, help_text=_('If successful, a 32bit hexadecimal value (Guid) identifying the orderRef.'))
+    orderref = models.CharField(_('orderRef'), max_length=255, blank=True, db_index=True, help_text=_('If successful, a 32bit hexadecimal value (Guid) identifying the orderRef.'))
     redirecturl = models.CharField(_('redirectUrl'), max_length=255, blank=True, help_text=_('Dynamic URL to send the end user to, when using redirect model.'))
     
     objects = InitializedPaymentManager()
@@ -56,13 +63,15 @@ class TransactionStatus(PayexResponse):
     
     # Transaction status
     transactionstatus = models.CharField(_('transactionStatus'), max_length=255, blank=True, help_text=_('0=Sale, 1=Initialize, 2=Credit, 3=Authorize, 4=Cancel,5=Failure,6=Capture'))
-    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True, help_text=_('Transaction number if the transaction is successful.'))
+    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True, db_index=True, help_text=_('Transaction number if the transaction is successful.'))
     
     # Info about the order
-    orderid = models.CharField(_('orderId'), max_length=255, blank=True, help_text=_('The orderID supplied by the merchant when the order was created.'))
+    orderref = models.CharField(_('orderRef'), max_length=255, blank=True, help_text=_('The orderRef the status was requested for, if known.'))
+    orderid = models.CharField(_('orderId'), max_length=255, blank=True, db_index=True, help_text=_('The orderID supplied by the merchant when the order was created.'))
     productid = models.CharField(_('productId'), max_length=255, blank=True)
     paymentmethod = models.CharField(_('paymentMethod'), max_length=255, blank=True)
     amount = models.CharField(_('amount'), max_length=255, blank=True)
+    amount_minor = models.BigIntegerField(_('amount in minor units'), null=True, blank=True, help_text=_('The amount as an integer, for aggregation in the database.'))
     alreadycompleted = models.BooleanField(_('alreadyCompleted'), default=False)
     stopdate = models.CharField(_('stopDate'), max_length=255, blank=True)
     productnumber = models.CharField(_('productNumber'), max_length=255, blank=True)
@@ -86,6 +95,12 @@ class TransactionStatus(PayexResponse):
     
     objects = TransactionStatusManager()
     
+    # Also set the amount as an integer
+    response_aliases = {'amount': ('amount_minor', )}
+    
+    # Indexes on (orderref, created) and (agreementref, created) are created 
+    # by sql/transactionstatus.sql
+    
     class Meta:
         verbose_name = _('transaction status')
         verbose_name_plural = _('transaction statuses')
@@ -93,23 +108,57 @@ class TransactionStatus(PayexResponse):
     def __unicode__(self):
         return _('Transaction status %s') % self.id
     
+    def get_state(self):
+        """
+        Returns the state of the transaction, see `djpayex.states`.
+        """
+        
+        return states.get_state(self.errorcode, self.transactionstatus)
+    
     def is_completed_successfully(self):
         """
         Checks if the transaction was completed successfully.
         """
         
-        return self.errorcode == 'OK' and self.transactionstatus in ('0', '3')
+        return self.get_state() == states.SUCCESSFUL
     
     def get_decimal_amount(self):
         """
         Returns the amount as Decimal.
         """
         
+        if self.amount_minor is not None:
+            return Decimal(self.amount_minor) / 100
+        
         if self.amount:
             return Decimal(self.amount) / 100
         
         return Decimal('0.00')
 
+class PolledPayment(models.Model):
+    """
+    Polls of an initialized payment without a terminal status, see 
+    `djpayex.poller`. Orders PayEx does not complete (e.g. abandoned or not 
+    found) are polled again with backoff rather than on every run.
+    """
+    
+    orderref = models.CharField(_('orderRef'), max_length=255, unique=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_poll = models.DateTimeField(_('next poll'), default=timezone.now, db_index=True)
+    
+    # Timestamps
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+    
+    objects = PolledPaymentManager()
+    
+    class Meta:
+        verbose_name = _('polled payment')
+        verbose_name_plural = _('polled payments')
+    
+    def __unicode__(self):
+        return _('Polls of %s') % self.orderref
+
 ####################
 # Agreement models #
 ####################
@@ -119,7 +168,7 @@ class Agreement(PayexResponse):
     Agreement between merchant and client.
     """
     
-    agreementref = models.CharField(_('agreementRef'), max_length=255, blank=True, help_text=_('Reference to the created agreement.'))
+    agreementref = models.CharField(_('agreementRef'), max_length=255, blank=True, db_index=True, help_text=_('Reference to the created agreement.'))
     
     # Information about the agreement given by the merchant upon creation
     maxamount = models.CharField(_('maxAmount'), max_length=255, blank=True, help_text=_('One single transaction can never be greater than this amount.'))
@@ -133,27 +182,15 @@ class Agreement(PayexResponse):
     def __unicode__(self):
         return _('Agreement %s') % self.agreementref
     
-    def is_verified(self):
+    def is_verified(self, use_cache=True):
         """
         Checks with PayEx if the agreement is verified.
-        """
-        
-        from django.conf import settings
-        from payex.service import PayEx
-        
-        # Initialize service
-        service = PayEx(
-            merchant_number=settings.PAYEX_MERCHANT_NUMBER, 
-            encryption_key=settings.PAYEX_ENCRYPTION_KEY, 
-            production=settings.PAYEX_IN_PRODUCTION
-        )
         
-        response = service.check_agreement(agreementRef=self.agreementref)
-        
-        if response['status']['description'] == 'OK':
-            return response['agreementStatus'] == '1'
+        The status is cached for PAYEX_AGREEMENT_CACHE_TIMEOUT seconds (300 by 
+        default), unless `use_cache` is False.
+        """
         
-        return False
+        return Agreement.objects.verify(self.agreementref, use_cache=use_cache)
 
 class AutoPayStatus(PayexResponse):
     """
@@ -163,9 +200,12 @@ class AutoPayStatus(PayexResponse):
     # Transaction status
     transactionstatus = models.CharField(_('transactionStatus'), max_length=255, blank=True, help_text=_('0=Sale, 1=Initialize, 2=Credit, 3=Authorize, 4=Cancel,5=Failure,6=Capture'))
     transactionref = models.CharField(_('transactionRef'), max_length=255, blank=True, help_text=_('An ID to the transaction completed.'))
-    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True, help_text=_('Transaction number if the transaction is successful.'))
+    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True, db_index=True, help_text=_('Transaction number if the transaction is successful.'))
     paymentmethod = models.CharField(_('paymentMethod'), max_length=255, blank=True, help_text=_('Payment method used for this transaction.'))
     
+    # The agreement charged, not part of the response
+    agreementref = models.CharField(_('agreementRef'), max_length=255, blank=True, db_index=True, help_text=_('The agreementRef the autopay was performed on, if known.'))
+    
     objects = AutoPayStatusManager()
     
     class Meta:
@@ -175,9 +215,183 @@ class AutoPayStatus(PayexResponse):
     def __unicode__(self):
         return _('Autopay status %s') % self.id
     
+    def get_state(self):
+        """
+        Returns the state of the transaction, see `djpayex.states`.
+        """
+        
+        return states.get_state(self.errorcode, self.transactionstatus)
+    
     def is_completed_successfully(self):
         """
         Checks if the transaction was completed successfully.
         """
         
-        return self.errorcode == 'OK' and self.transactionstatus in ('0', '3')
+        return self.get_state() == states.SUCCESSFUL
+
+class AutoPayAttempt(models.Model):
+    """
+    Checkpoint of an autopay in a batch run, see `djpayex.autopay`. An 
+    agreement is charged at most once per run.
+    """
+    
+    STARTED = 'started'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    STATUS_CHOICES = (
+        (STARTED, _('Started')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+    
+    run = models.CharField(_('run'), max_length=100, help_text=_('Name of the batch run, e.g. the billing period.'))
+    agreementref = models.CharField(_('agreementRef'), max_length=255, db_index=True)
+    amount = models.BigIntegerField(_('amount'), help_text=_('The amount charged, in minor units.'))
+    status = models.CharField(_('status'), max_length=20, choices=STATUS_CHOICES, default=STARTED, db_index=True, help_text=_('Started if the outcome of the autopay is unknown, failed if PayEx did not perform it.'))
+    
+    # Timestamps
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+    
+    objects = EstimatedCountManager()
+    
+    class Meta:
+        unique_together = ('run', 'agreementref', )
+        verbose_name = _('autopay attempt')
+        verbose_name_plural = _('autopay attempts')
+    
+    def __unicode__(self):
+        return _('Autopay of %s in %s') % (self.agreementref, self.run)
+
+#################
+# Status models #
+#################
+
+class CurrentStatus(models.Model):
+    """
+    The latest transaction status of an order or agreement, kept up to date 
+    when statuses are stored, so that it can be looked up without sorting the 
+    history of statuses.
+    """
+    
+    ORDER = 'order'
+    AGREEMENT = 'agreement'
+    
+    REFERENCE_TYPE_CHOICES = (
+        (ORDER, _('Order')),
+        (AGREEMENT, _('Agreement')),
+    )
+    
+    # The order or agreement
+    reference_type = models.CharField(_('reference type'), max_length=20, choices=REFERENCE_TYPE_CHOICES)
+    reference = models.CharField(_('reference'), max_length=255, db_index=True, help_text=_('The orderRef or agreementRef.'))
+    
+    # Copy of the latest status
+    errorcode = models.CharField(_('errorCode'), max_length=255, blank=True)
+    transactionstatus = models.CharField(_('transactionStatus'), max_length=255, blank=True)
+    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True)
+    state = models.CharField(_('state'), max_length=20, blank=True, db_index=True, help_text=_('The state of the transaction, see djpayex.states.'))
+    
+    # The latest status, a TransactionStatus or AutoPayStatus
+    status_model = models.CharField(_('status model'), max_length=100)
+    status_id = models.PositiveIntegerField(_('status id'))
+    status_created = models.DateTimeField(_('status created'))
+    
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+    
+    objects = CurrentStatusManager()
+    
+    class Meta:
+        unique_together = ('reference_type', 'reference', )
+        verbose_name = _('current status')
+        verbose_name_plural = _('current statuses')
+    
+    def __unicode__(self):
+        return _('Current status of %s %s') % (self.reference_type, self.reference)
+    
+    def get_status(self):
+        """
+        Returns the TransactionStatus or AutoPayStatus this is a copy of.
+        """
+        
+        return models.get_model('djpayex', self.status_model).objects.get(pk=self.status_id)
+
+###################
+# Callback models #
+###################
+
+class QueuedCallback(models.Model):
+    """
+    A transaction callback from PayEx, queued for completion by a worker.
+    """
+    
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (PROCESSING, _('Processing')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+    
+    # Callback data posted by PayEx
+    transactionref = models.CharField(_('transactionRef'), max_length=255, blank=True)
+    transactionnumber = models.CharField(_('transactionNumber'), max_length=255, blank=True, db_index=True)
+    orderref = models.CharField(_('orderRef'), max_length=255, db_index=True)
+    
+    # Processing state
+    status = models.CharField(_('status'), max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), default=timezone.now, db_index=True)
+    last_error = models.TextField(_('last error'), blank=True)
+    
+    # Timestamps
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+    
+    objects = QueuedCallbackManager()
+    
+    class Meta:
+        verbose_name = _('queued callback')
+        verbose_name_plural = _('queued callbacks')
+    
+    def __unicode__(self):
+        return _('Queued callback %s') % self.id
+
+class ProcessedCallback(models.Model):
+    """
+    A transaction callback that has been processed, used to ignore repeated callbacks.
+    """
+    
+    orderref = models.CharField(_('orderRef'), max_length=255)
+    transactionnumber = models.CharField(_('transactionNumber'), max_length=255)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    
+    objects = ProcessedCallbackManager()
+    
+    class Meta:
+        unique_together = ('orderref', 'transactionnumber', )
+        verbose_name = _('processed callback')
+        verbose_name_plural = _('processed callbacks')
+    
+    def __unicode__(self):
+        return _('Processed callback %s') % self.id
+
+###########
+# Signals #
+###########
+
+def invalidate_agreement_cache(sender, instance, **kwargs):
+    """
+    Removes the cached verification status when an agreement is saved or deleted.
+    """
+    
+    if instance.agreementref:
+        Agreement.objects.invalidate(instance.agreementref)
+
+post_save.connect(invalidate_agreement_cache, sender=Agreement)
+post_delete.connect(invalidate_agreement_cache, sender=Agreement)
@@ -0,0 +1,146 @@
+"""
+Reconciliation of initialized payments that never got a callback.
+
+Orders are completed with PayEx if they were initialized more than a while ago 
+(but not too long ago) and have no terminal status (see `djpayex.states`) in 
+CurrentStatus. Orders still without one after a poll, e.g. abandoned orders 
+PayEx reports as not found, are recorded in PolledPayment and skipped until 
+their next poll is due, so they don't crowd out newer orders.
+"""
+
+import datetime
+import logging
+import time
+
+from django.db import router, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from djpayex import states
+from djpayex.client import get_host, get_service
+from djpayex.models import InitializedPayment, TransactionStatus, PolledPayment, CurrentStatus
+from djpayex.utils import RateLimiter, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+
+class StalePaymentPoller(object):
+    """
+    Completes stale orders with PayEx concurrently, using a pool of `workers` 
+    threads, and stores the statuses in bulk.
+    
+    Calls are limited to `rate` per second per PayEx host. Calls that fail are 
+    retried with exponential backoff, starting at `backoff` seconds and capped 
+    at `max_backoff`, up to `max_attempts` times per order. Orders still 
+    without a terminal status are polled again after `poll_backoff` minutes, 
+    doubled for each poll and capped at `max_poll_backoff`.
+    
+    The service defaults to the one for the PAYEX_* settings, for the thread 
+    making the call.
+    """
+    
+    def __init__(self, service=None, workers=4, rate=10, max_attempts=3, backoff=1, max_backoff=30, batch_size=500, poll_backoff=30, max_poll_backoff=24 * 60):
+        self.service = service
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.poll_backoff = poll_backoff
+        self.max_poll_backoff = max_poll_backoff
+    
+    def get_stale_orderrefs(self, older_than=30, limit=None, max_age=7 * 24 * 60):
+        """
+        Returns the orderRefs of successful initializations older than 
+        `older_than` minutes but newer than `max_age` minutes, without a 
+        terminal status and due for a poll, the latest initialized first.
+        """
+        
+        now = timezone.now()
+        cutoff = now - datetime.timedelta(minutes=older_than)
+        oldest = now - datetime.timedelta(minutes=max_age)
+        
+        terminal = CurrentStatus.objects.filter(reference_type=CurrentStatus.ORDER, state__in=states.TERMINAL_STATES).values('reference')
+        backed_off = PolledPayment.objects.filter(next_poll__gt=now).values('orderref')
+        
+        orderrefs = InitializedPayment.objects.filter(errorcode='OK', created__lt=cutoff, created__gte=oldest).exclude(orderref='')
+        orderrefs = orderrefs.exclude(orderref__in=terminal).exclude(orderref__in=backed_off)
+        orderrefs = orderrefs.values('orderref').annotate(initialized=Max('created')).order_by('-initialized', 'orderref')
+        
+        if limit:
+            orderrefs = orderrefs[:limit]
+        
+        return [row['orderref'] for row in orderrefs]
+    
+    def get_delay(self, attempts):
+        """
+        Returns the number of seconds to wait before the next attempt.
+        """
+        
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+    
+    def complete(self, orderref):
+        """
+        Completes an order with PayEx. Returns a (response, TransactionStatus) 
+        tuple, or None if all attempts failed.
+        """
+        
+        service = self.service or get_service()
+        host = get_host(service.complete)
+        
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.wait(host)
+            
+            try:
+                response = service.complete(orderRef=orderref)
+            except Exception:
+                logger.exception('Completing orderRef %s failed (attempt %s).', orderref, attempt)
+                response = None
+            
+            if response is not None:
+                return (response, TransactionStatus(orderref=orderref))
+            
+            if attempt < self.max_attempts:
+                time.sleep(self.get_delay(attempt))
+        
+        return None
+    
+    def record_polls(self, orderrefs):
+        """
+        Records the polls of orders, backing off the ones still without a 
+        terminal status and forgetting the rest.
+        """
+        
+        resolved = set(CurrentStatus.objects.filter(reference_type=CurrentStatus.ORDER, reference__in=orderrefs, state__in=states.TERMINAL_STATES).values_list('reference', flat=True))
+        
+        with transaction.commit_on_success(using=router.db_for_write(PolledPayment)):
+            PolledPayment.objects.record([orderref for orderref in orderrefs if orderref not in resolved], self.poll_backoff, self.max_poll_backoff)
+            PolledPayment.objects.filter(orderref__in=resolved).delete()
+    
+    def poll(self, older_than=30, limit=None, max_age=7 * 24 * 60):
+        """
+        Completes the stale orders, and returns a dictionary with the number of 
+        'orders', 'completed' and 'failed' orders, 'seconds' taken and 'rate' 
+        of orders per second.
+        """
+        
+        started = time.time()
+        orderrefs = self.get_stale_orderrefs(older_than, limit, max_age)
+        completed = 0
+        
+        for i in range(0, len(orderrefs), self.batch_size):
+            batch = orderrefs[i:i + self.batch_size]
+            results = run_concurrently(self.complete, batch, workers=self.workers)
+            completed += TransactionStatus.objects.bulk_create_from_responses([result for result in results if result is not None], batch_size=self.batch_size)
+            self.record_polls(batch)
+        
+        seconds = time.time() - started
+        
+        return {
+            'orders': len(orderrefs),
+            'completed': completed,
+            'failed': len(orderrefs) - completed,
+            'seconds': seconds,
+            'rate': len(orderrefs) / seconds if seconds else 0.0,
+        }
@@ -0,0 +1,129 @@
+"""
+Database router for the djpayex models.
+
+Writes go to the PAYEX_DB_WRITE_ALIAS database, and reads to the
+PAYEX_DB_READ_ALIAS database, e.g. a replica (both 'default' by default).
+Enable it, and the middleware resetting it between requests, in the settings:
+
+    DATABASE_ROUTERS = ['djpayex.routers.PayexRouter']
+    MIDDLEWARE_CLASSES += ('djpayex.routers.PayexRouterMiddleware', )
+    PAYEX_DB_WRITE_ALIAS = 'default'
+    PAYEX_DB_READ_ALIAS = 'replica'
+
+Once a thread has written to a djpayex model, its reads go to the write
+database as well, until `unpin` is called (by the middleware at the end of
+each request), so a request always reads its own writes. The callback views,
+and the autopay and callback workers, read from the write database only.
+"""
+
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_local = threading.local()
+
+
+def get_write_alias():
+    """
+    Returns the alias of the database djpayex writes to.
+    """
+    
+    return getattr(settings, 'PAYEX_DB_WRITE_ALIAS', DEFAULT_DB_ALIAS)
+
+def get_read_alias():
+    """
+    Returns the alias of the database djpayex reads from, when not pinned.
+    """
+    
+    return getattr(settings, 'PAYEX_DB_READ_ALIAS', get_write_alias())
+
+def pin():
+    """
+    Sends the reads of the current thread to the write database.
+    """
+    
+    _local.pinned = True
+
+def unpin():
+    """
+    Sends the reads of the current thread to the read database again.
+    """
+    
+    _local.pinned = False
+
+def is_pinned():
+    """
+    Checks if the reads of the current thread go to the write database.
+    """
+    
+    return getattr(_local, 'pinned', False)
+
+def use_write_db(func):
+    """
+    Decorates a function, such as a view, to read from the write database.
+    The thread is unpinned afterwards unless it was pinned already.
+    """
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        pinned = is_pinned()
+        pin()
+        
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if not pinned:
+                unpin()
+    
+    return wrapper
+
+class PayexRouter(object):
+    """
+    Routes the djpayex models to the write and read databases.
+    """
+    
+    app_label = 'djpayex'
+    
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        
+        if is_pinned():
+            return get_write_alias()
+        
+        return get_read_alias()
+    
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        
+        pin()
+        
+        return get_write_alias()
+    
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == self.app_label and obj2._meta.app_label == self.app_label:
+            return True
+        
+        return None
+    
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label != self.app_label:
+            return None
+        
+        return db == get_write_alias()
+
+class PayexRouterMiddleware(object):
+    """
+    Unpins the thread at the start and end of each request, so reads go to
+    the read database until the request writes.
+    """
+    
+    def process_request(self, request):
+        unpin()
+    
+    def process_response(self, request, response):
+        unpin()
+        return response
@@ -0,0 +1,3 @@
+-- Composite indexes for the latest status of an order or agreement
+CREATE INDEX djpayex_transactionstatus_orderref_created ON djpayex_transactionstatus (orderref, created);
+CREATE INDEX djpayex_transactionstatus_agreementref_created ON djpayex_transactionstatus (agreementref, created);
@@ -0,0 +1,120 @@
+"""
+Transaction states, shared by the model methods and the queryset filters so
+that they can't disagree.
+
+A transaction is in the ERROR state if the request to PayEx failed (errorCode
+is not OK), and otherwise in the state given by its transactionStatus. Once 
+in a terminal state, the status of a transaction only changes along the 
+transition table, so that a late status can't undo a completed transaction.
+"""
+
+from django.db.models import Q
+
+# Values of transactionStatus
+SALE = '0'
+INITIALIZE = '1'
+CREDIT = '2'
+AUTHORIZE = '3'
+CANCEL = '4'
+FAILURE = '5'
+CAPTURE = '6'
+
+# States
+SUCCESSFUL = 'successful'
+PENDING = 'pending'
+CAPTURED = 'captured'
+CREDITED = 'credited'
+FAILED = 'failed'
+ERROR = 'error'
+
+# The state for each transactionStatus, when errorCode is OK
+STATES = {
+    SALE: SUCCESSFUL,
+    AUTHORIZE: SUCCESSFUL,
+    INITIALIZE: PENDING,
+    CAPTURE: CAPTURED,
+    CREDIT: CREDITED,
+    CANCEL: FAILED,
+    FAILURE: FAILED,
+}
+
+# The transactionStatus values for each state
+STATUSES = {}
+for status, state in sorted(STATES.items()):
+    STATUSES.setdefault(state, ())
+    STATUSES[state] += (status, )
+
+# States that will not change without further action from the merchant
+TERMINAL_STATES = (SUCCESSFUL, CAPTURED, CREDITED, FAILED, )
+
+# The transactionStatus values a transaction can change to
+TRANSITIONS = {
+    INITIALIZE: (SALE, AUTHORIZE, CANCEL, FAILURE, ),
+    AUTHORIZE: (CAPTURE, CANCEL, ),
+    SALE: (CREDIT, ),
+    CAPTURE: (CREDIT, ),
+    CREDIT: (),
+    CANCEL: (),
+    FAILURE: (),
+}
+
+
+def get_state(errorcode, transactionstatus):
+    """
+    Returns the state of a transaction, or None if the transactionStatus is unknown.
+    """
+    
+    if errorcode != 'OK':
+        return ERROR
+    
+    return STATES.get(transactionstatus)
+
+def get_q(*states):
+    """
+    Returns a Q object filtering on transactions in any of the states.
+    """
+    
+    q = Q(pk__in=[])
+    
+    for state in states:
+        if state == ERROR:
+            q |= ~Q(errorcode='OK')
+        elif state in STATUSES:
+            q |= Q(errorcode='OK', transactionstatus__in=STATUSES[state])
+        else:
+            raise ValueError('Unknown transaction state: %s' % state)
+    
+    return q
+
+def can_transition(transactionstatus, new_transactionstatus):
+    """
+    Checks if a transaction can change from one transactionStatus to another.
+    """
+    
+    return new_transactionstatus in TRANSITIONS.get(transactionstatus, ())
+
+def can_replace(errorcode, transactionstatus, new_errorcode, new_transactionstatus):
+    """
+    Checks if a newer status replaces the status of a transaction. A status in 
+    a terminal state is only replaced by a status it can change to, or by the 
+    same status.
+    """
+    
+    if get_state(errorcode, transactionstatus) not in TERMINAL_STATES:
+        return True
+    
+    return new_errorcode == 'OK' and (new_transactionstatus == transactionstatus or can_transition(transactionstatus, new_transactionstatus))
+
+def get_replaceable_q(new_errorcode, new_transactionstatus):
+    """
+    Returns a Q object filtering on transactions whose status is replaced by 
+    the newer status, see `can_replace`.
+    """
+    
+    q = ~get_q(*TERMINAL_STATES)
+    
+    if new_errorcode == 'OK':
+        previous = [status for status in TRANSITIONS if status == new_transactionstatus or can_transition(status, new_transactionstatus)]
+        q |= Q(errorcode='OK', transactionstatus__in=previous)
+    
+    return q
@@ -0,0 +1,224 @@
+"""
+Synthetic PayEx responses, shaped like the responses of `pypayex`, for tests
+and benchmarks, and a fake PayEx service returning them.
+
+Importing this module also resets the state djpayex builds from its settings
+when they are changed in tests, e.g. with `override_settings`.
+"""
+
+import random
+import socket
+import time
+import uuid
+
+from django.test.signals import setting_changed
+
+PAYMENT_METHODS = ('VISA', 'MC', 'AMEX', 'DANKORT', )
+
+
+def status(errorcode='OK', description='OK'):
+    """
+    Returns the status of a response.
+    """
+    
+    return {
+        'errorCode': errorcode,
+        'code': errorcode,
+        'description': description,
+        'thirdPartyError': None,
+        'paramName': None
+    }
+
+def header(headerid=None):
+    """
+    Returns the header of a response, with a random id by default.
+    """
+    
+    return {
+        'date': '2011-10-07 12:59:30',
+        'name': 'Payex Header v1.0',
+        'id': headerid or uuid.uuid4().hex
+    }
+
+def initialize_response(orderref=None):
+    """
+    Returns a response for an initialized payment.
+    """
+    
+    orderref = orderref or uuid.uuid4().hex
+    
+    return {
+        'status': status(),
+        'header': header(),
+        'sessionRef': uuid.uuid4().hex,
+        'redirectUrl': 'https://test-account.payex.com/MiscUI/PxMenu.aspx?orderRef=%s' % orderref,
+        'orderRef': orderref
+    }
+
+def complete_response(orderid='test1', transactionnumber='40276785', transactionstatus='0', amount='5000', paymentmethod='VISA', headerid=None, errorcode='OK'):
+    """
+    Returns a response for a completed transaction.
+    """
+    
+    return {
+        'status': status(errorcode),
+        'header': header(headerid),
+        'orderId': orderid,
+        'transactionNumber': transactionnumber,
+        'clientAccount': '0',
+        'pending': False,
+        'alreadyCompleted': False,
+        'clientGsmNumber': None,
+        'productNumber': '123',
+        'AuthenticatedStatus': '3DSecure',
+        'maskedNumber': '41**********1111',
+        'amount': amount,
+        'fraudData': False,
+        'orderStatus': '0',
+        'AuthenticatedWith': 'Y',
+        'transactionRef': uuid.uuid4().hex,
+        'transactionStatus': transactionstatus,
+        'paymentMethod': paymentmethod,
+        'BankHash': '12300001-4111-1111-1111-000000000000',
+        'productId': '123'
+    }
+
+def check_agreement_response(agreementstatus='1', errorcode='OK'):
+    """
+    Returns a response for an agreement check, verified by default.
+    """
+    
+    return {
+        'status': status(errorcode, errorcode),
+        'header': header(),
+        'agreementStatus': agreementstatus
+    }
+
+def autopay_response(transactionnumber='40276785', transactionstatus='0'):
+    """
+    Returns a response for an autopay.
+    """
+    
+    return {
+        'status': status(),
+        'header': header(),
+        'transactionNumber': transactionnumber,
+        'transactionRef': uuid.uuid4().hex,
+        'paymentMethod': 'VISA',
+        'transactionStatus': transactionstatus
+    }
+
+def generate_complete_responses(count, seed=0):
+    """
+    Yields `count` varied responses for completed transactions, the same ones
+    for the same seed apart from random ids.
+    """
+    
+    rand = random.Random(seed)
+    
+    for i in xrange(count):
+        yield complete_response(
+            orderid='order%s' % i,
+            transactionnumber=str(40000000 + i),
+            transactionstatus=rand.choice(('0', '0', '0', '3', '3', '5')),
+            amount=str(rand.randint(1, 500000)),
+            paymentmethod=rand.choice(PAYMENT_METHODS),
+        )
+
+class FakePayEx(object):
+    """
+    Stand-in for the `pypayex` service, answering calls locally with synthetic 
+    responses, for load tests. Use it by setting PAYEX_SERVICE_BACKEND to 
+    'djpayex.testing.FakePayEx', with options from 
+    PAYEX_SERVICE_BACKEND_OPTIONS.
+    
+    Calls take `latency` seconds, or a random time between the values of a 
+    (min, max) tuple. A share of `fault_rate` of the calls return None, like 
+    `pypayex` does on SOAP faults, and a share of `error_rate` return an error 
+    status. A share of `timeout_rate` of the calls raise `socket.timeout`, like 
+    calls exceeding PAYEX_TIMEOUT. A share of `declined_rate` of the 
+    transactions fail.
+    """
+    
+    def __init__(self, merchant_number='', encryption_key='', production=False, latency=0, error_rate=0, fault_rate=0, timeout_rate=0, declined_rate=0, seed=None):
+        self.accountNumber = merchant_number
+        self.encryption_key = encryption_key
+        self.production = production
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fault_rate = fault_rate
+        self.timeout_rate = timeout_rate
+        self.declined_rate = declined_rate
+        self.random = random.Random(seed)
+    
+    def respond(self, response):
+        """
+        Waits for the latency, and returns the response, an error or None, or 
+        raises `socket.timeout`.
+        """
+        
+        if isinstance(self.latency, (list, tuple)):
+            time.sleep(self.random.uniform(*self.latency))
+        elif self.latency:
+            time.sleep(self.latency)
+        
+        if self.random.random() < self.timeout_rate:
+            raise socket.timeout('timed out')
+        
+        if self.random.random() < self.fault_rate:
+            return None
+        
+        if self.random.random() < self.error_rate:
+            response['status'] = status('Error_Generic', 'Error_Generic')
+        
+        return response
+    
+    def get_transactionstatus(self):
+        """
+        Returns the transactionStatus of a transaction, failed or a sale.
+        """
+        
+        if self.random.random() < self.declined_rate:
+            return '5'
+        
+        return '0'
+    
+    def initialize(self, **kwargs):
+        return self.respond(initialize_response())
+    
+    def complete(self, orderRef, **kwargs):
+        return self.respond(complete_response(transactionnumber=str(self.random.randint(10000000, 99999999)), transactionstatus=self.get_transactionstatus()))
+    
+    def get_transaction_details(self, transactionNumber, **kwargs):
+        return self.respond(complete_response(transactionnumber=transactionNumber, transactionstatus=self.get_transactionstatus()))
+    
+    def create_agreement(self, **kwargs):
+        return self.respond({'status': status(), 'header': header(), 'agreementRef': uuid.uuid4().hex})
+    
+    def check_agreement(self, agreementRef, **kwargs):
+        return self.respond(check_agreement_response())
+    
+    def autopay(self, agreementRef, **kwargs):
+        return self.respond(autopay_response(str(self.random.randint(10000000, 99999999)), self.get_transactionstatus()))
+
+def reset_on_setting_changed(sender, setting, **kwargs):
+    """
+    Discards the state built from a PAYEX_* setting when it is changed in
+    tests, so it is built again from the new value.
+    """
+    
+    from djpayex import callbacks, client, firewall, metrics
+    
+    if setting.startswith('PAYEX_'):
+        client.registry.reset()
+    
+    if setting.startswith('PAYEX_CALLBACK_'):
+        firewall.reset_filter()
+    
+    if setting.startswith('PAYEX_CALLBACK_EXECUTOR_'):
+        callbacks.reset_executor()
+    
+    if setting == 'PAYEX_METRICS_BACKEND':
+        metrics.reset()
+
+setting_changed.connect(reset_on_setting_changed)
@@ -1,2 +1,12 @@
 from managers import *
 from views import *
+from callbacks import *
+from client import *
+from fields import *
+from poller import *
+from autopay import *
+from metrics import *
+from archive import *
+from admin import *
+from export import *
+from routers import *
@@ -0,0 +1,117 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from djpayex.managers import EstimatedCountQuerySet, PayexResponseQuerySet
+from djpayex.models import TransactionStatus, AutoPayAttempt, PolledPayment, CurrentStatus, QueuedCallback
+from djpayex.tests.utils import completed_response
+
+
+class PayexResponseAdminTests(TestCase):
+    
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        
+        for orderref in ('a1', 'a2', 'a3'):
+            TransactionStatus.objects.create_from_response(completed_response(orderref), obj=TransactionStatus(orderref=orderref))
+    
+    def testChangeList(self):
+        """
+        Test that the change list does not load raw responses, and searches 
+        with exact matches.
+        """
+        
+        url = reverse('admin:djpayex_transactionstatus_changelist')
+        
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context['cl'].result_count, 3)
+        self.assertTrue('raw_response' not in response.context['cl'].result_list[0].__dict__)
+        
+        response = self.client.get(url, {'q': 'a2'})
+        self.assertEquals([obj.orderref for obj in response.context['cl'].result_list], ['a2'])
+        self.assertEquals(response.context['cl'].full_result_count, 3)
+        
+        response = self.client.get(url, {'q': 'a'})
+        self.assertEquals(response.context['cl'].result_count, 0)
+        
+        # Every term has to match
+        response = self.client.get(url, {'q': 'a2 40276785'})
+        self.assertEquals([obj.orderref for obj in response.context['cl'].result_list], ['a2'])
+        
+        pk = TransactionStatus.objects.get(orderref='a1').pk
+        response = self.client.get(url, {'q': str(pk)})
+        self.assertEquals([obj.pk for obj in response.context['cl'].result_list], [pk])
+    
+    def testEstimatedCount(self):
+        """
+        Test that the estimate is only used for large unfiltered tables.
+        """
+        
+        self.assertEquals(TransactionStatus.objects.estimated_count(), 3)
+        
+        get_table_estimate = PayexResponseQuerySet._get_table_estimate
+        PayexResponseQuerySet._get_table_estimate = lambda self: 20000
+        try:
+            self.assertEquals(TransactionStatus.objects.estimated_count(), 20000)
+            self.assertEquals(TransactionStatus.objects.estimated_count(threshold=50000), 3)
+            self.assertEquals(TransactionStatus.objects.filter(orderref='a1').estimated_count(), 1)
+        finally:
+            PayexResponseQuerySet._get_table_estimate = get_table_estimate
+    
+    def testExportAction(self):
+        """
+        Test that the selected objects are exported.
+        """
+        
+        pks = TransactionStatus.objects.filter(orderref__in=('a1', 'a3')).values_list('pk', flat=True)
+        response = self.client.post(reverse('admin:djpayex_transactionstatus_changelist'), {'action': 'export_csv', '_selected_action': list(pks)})
+        
+        self.assertEquals(response['Content-Type'], 'text/csv')
+        self.assertEquals(response['Content-Disposition'], 'attachment; filename=transactionstatus.csv')
+        
+        # Read by iterating, as the content of a streamed response is not kept
+        content = ''.join(response)
+        self.assertEquals([line.split(',')[0] for line in content.splitlines()], ['id'] + [str(pk) for pk in pks])
+
+class LargeTableAdminTests(TestCase):
+    
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        
+        for orderref in ('a1', 'a2', 'a3'):
+            TransactionStatus.objects.create_from_response(completed_response(orderref), obj=TransactionStatus(orderref=orderref))
+            AutoPayAttempt.objects.create(run='2012-06', agreementref=orderref, amount=1000)
+            QueuedCallback.objects.enqueue(orderref)
+        
+        PolledPayment.objects.record(['a1', 'a2', 'a3'])
+    
+    def testChangeLists(self):
+        """
+        Test that the change lists of the other large tables search with exact 
+        matches and use the estimated count.
+        """
+        
+        for model in (AutoPayAttempt, PolledPayment, CurrentStatus, QueuedCallback):
+            url = reverse('admin:djpayex_%s_changelist' % model._meta.module_name)
+            
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response.context['cl'].result_count, 3)
+            
+            response = self.client.get(url, {'q': 'a2'})
+            self.assertEquals(response.context['cl'].result_count, 1)
+            
+            response = self.client.get(url, {'q': 'a'})
+            self.assertEquals(response.context['cl'].result_count, 0)
+            
+            get_table_estimate = EstimatedCountQuerySet._get_table_estimate
+            EstimatedCountQuerySet._get_table_estimate = lambda self: 20000
+            try:
+                response = self.client.get(url, {'q': 'a2'})
+                self.assertEquals(response.context['cl'].result_count, 1)
+                self.assertEquals(response.context['cl'].full_result_count, 20000)
+            finally:
+                EstimatedCountQuerySet._get_table_estimate = get_table_estimate
@@ -0,0 +1,112 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from djpayex.archive import archive_model, get_archive_model, restore_archive, verify_archive, write_archive
+from djpayex.exceptions import ArchiveError
+from djpayex.models import TransactionStatus, CurrentStatus
+from djpayex.tests.utils import completed_response
+
+
+class ArchiveTests(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        
+        for orderref in ('old1', 'old2', 'old3', 'recent'):
+            TransactionStatus.objects.create_from_response(completed_response(orderref), obj=TransactionStatus(orderref=orderref))
+        
+        TransactionStatus.objects.filter(orderref__in=('old1', 'old2')).update(created=datetime.datetime(2013, 1, 15, 12, 30, 0, 123456))
+        TransactionStatus.objects.filter(orderref='old3').update(created=datetime.datetime(2013, 2, 1))
+        
+        # The old statuses are no longer the current ones
+        for orderref in ('old1', 'old2', 'old3'):
+            TransactionStatus.objects.create_from_response(completed_response(orderref, '40276786'), obj=TransactionStatus(orderref=orderref))
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def testArchiveAndRestore(self):
+        """
+        Test that old rows are archived per month and deleted, and restored 
+        as they were.
+        """
+        
+        stored = dict((obj.pk, (obj.created, obj.raw_response)) for obj in TransactionStatus.objects.all())
+        
+        result = archive_model(TransactionStatus, timezone.now() - datetime.timedelta(days=30), self.directory, chunk_size=1, delete_batch_size=1)
+        
+        self.assertEquals(result['archived'], 3)
+        self.assertEquals(result['deleted'], 3)
+        self.assertEquals([os.path.basename(path)[:35] for path in result['files']], ['djpayex.transactionstatus-2013-01-2', 'djpayex.transactionstatus-2013-02-2'])
+        self.assertEquals(sorted(os.listdir(self.directory)), sorted(os.path.basename(path) for path in result['files']))
+        self.assertEquals(sorted(TransactionStatus.objects.values_list('transactionnumber', flat=True)), ['40276785', '40276786', '40276786', '40276786'])
+        
+        for path in result['files']:
+            self.assertEquals(get_archive_model(path), TransactionStatus)
+            restore_archive(path, batch_size=1)
+        
+        self.assertEquals(dict((obj.pk, (obj.created, obj.raw_response)) for obj in TransactionStatus.objects.all()), stored)
+        
+        # Restoring again overwrites the rows
+        restore_archive(result['files'][0])
+        self.assertEquals(TransactionStatus.objects.count(), 7)
+    
+    def testCurrentStatusKept(self):
+        """
+        Test that statuses that are the current status of an order are not 
+        archived.
+        """
+        
+        TransactionStatus.objects.filter(orderref='recent').update(created=datetime.datetime(2013, 3, 1))
+        
+        result = archive_model(TransactionStatus, timezone.now() - datetime.timedelta(days=30), self.directory)
+        self.assertEquals(result['archived'], 3)
+        self.assertEquals(TransactionStatus.objects.filter(orderref='recent').count(), 1)
+        
+        for current in CurrentStatus.objects.all():
+            self.assertEquals(current.get_status().orderref, current.reference)
+    
+    def testVerify(self):
+        """
+        Test that files not matching the written rows are detected.
+        """
+        
+        path = os.path.join(self.directory, 'test.jsonl.gz')
+        count, checksum = write_archive(path, [{'id': 1}, {'id': 2}])
+        verify_archive(path, count, checksum)
+        
+        self.assertRaises(ArchiveError, verify_archive, path, 3, checksum)
+        
+        archive = gzip.open(path, 'wb')
+        archive.write('{"id":1}\n{"id":3}\n')
+        archive.close()
+        self.assertRaises(ArchiveError, verify_archive, path, count, checksum)
+        
+        open(path, 'wb').write('not gzip')
+        self.assertRaises(ArchiveError, verify_archive, path, count, checksum)
+        
+        self.assertRaises(ArchiveError, get_archive_model, path)
+    
+    @override_settings(PAYEX_RETENTION_DAYS={'autopaystatus': 30})
+    def testCommand(self):
+        """
+        Test that only models with a retention period are archived.
+        """
+        
+        out = StringIO()
+        call_command('payex_archive', directory=self.directory, stdout=out)
+        self.assertEquals(TransactionStatus.objects.count(), 7)
+        
+        call_command('payex_archive', directory=self.directory, days=['TransactionStatus=30'], keep=True, stdout=out)
+        self.assertEquals(TransactionStatus.objects.count(), 7)
+        self.assertEquals(len(os.listdir(self.directory)), 2)
+        self.assertTrue('Archived 3 and deleted 0 transaction statuses to 2 files.' in out.getvalue())
@@ -0,0 +1,119 @@
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djpayex import states
+from djpayex.autopay import AutoPayRunner
+from djpayex.models import Agreement, AutoPayStatus, AutoPayAttempt, CurrentStatus
+from djpayex.tests.utils import StubService
+
+
+class AutoPayRunnerTests(TestCase):
+    
+    def setUp(self):
+        for agreementref in ('ok1', 'ok2', 'declined', 'failing', 'raising', 'free'):
+            Agreement.objects.create(errorcode='OK', agreementref=agreementref)
+    
+    def testRun(self):
+        """
+        Test a run, and that resuming it does not charge agreements again.
+        """
+        
+        amounts = lambda agreement: 0 if agreement.agreementref == 'free' else 1000
+        service = StubService(failing=('failing', ), raising=('raising', ), declined=('declined', ))
+        runner = AutoPayRunner('2013-05', amounts, 'P1', 'Subscription', service=service, workers=2, rate=0, batch_size=4)
+        
+        summary = runner.run(Agreement.objects.all())
+        self.assertEquals(summary['charged'], 2)
+        self.assertEquals(summary['declined'], 1)
+        self.assertEquals(summary['failed'], 1)
+        self.assertEquals(summary['unknown'], 1)
+        self.assertEquals(summary['skipped'], 1)
+        self.assertEquals(len(service.calls), 5)
+        
+        self.assertEquals(AutoPayStatus.objects.count(), 3)
+        self.assertEquals(AutoPayStatus.objects.successful().count(), 2)
+        self.assertEquals(CurrentStatus.objects.for_agreement('declined').state, states.FAILED)
+        
+        attempts = dict(AutoPayAttempt.objects.values_list('agreementref', 'status'))
+        self.assertEquals(attempts, {
+            'ok1': AutoPayAttempt.DONE, 
+            'ok2': AutoPayAttempt.DONE, 
+            'declined': AutoPayAttempt.DONE, 
+            'failing': AutoPayAttempt.FAILED, 
+            'raising': AutoPayAttempt.STARTED, 
+        })
+        
+        # Resume, only retrying the failed autopay
+        service = StubService()
+        runner = AutoPayRunner('2013-05', amounts, 'P1', 'Subscription', service=service, rate=0, retry_failed=True)
+        
+        summary = runner.run(Agreement.objects.all())
+        self.assertEquals(service.calls, [('autopay', 'failing', 1000)])
+        self.assertEquals(summary['charged'], 1)
+        self.assertEquals(summary['unknown'], 1)
+        self.assertEquals(AutoPayAttempt.objects.get(agreementref='failing').status, AutoPayAttempt.DONE)
+    
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'fault_rate': 1}, PAYEX_CIRCUIT_BREAKER_THRESHOLD=2)
+    def testCircuitOpen(self):
+        """
+        Test that agreements PayEx was not called for, as the circuit breaker 
+        is open, are charged when the run is resumed.
+        """
+        
+        amounts = lambda agreement: 1000
+        
+        summary = AutoPayRunner('2013-05', amounts, 'P1', 'Subscription', workers=1, rate=0).run(Agreement.objects.all())
+        self.assertEquals(summary['failed'], 6)
+        self.assertEquals(summary['unknown'], 0)
+        self.assertEquals(list(AutoPayAttempt.objects.values_list('status', flat=True)), [AutoPayAttempt.FAILED] * 2)
+        
+        service = StubService()
+        summary = AutoPayRunner('2013-05', amounts, 'P1', 'Subscription', service=service, rate=0).run(Agreement.objects.all())
+        self.assertEquals(summary['charged'], 4)
+        self.assertEquals(summary['skipped'], 2)
+        self.assertEquals(summary['unknown'], 0)
+    
+    def testCommand(self):
+        """
+        Test the management command against the configured service.
+        """
+        
+        from djpayex import autopay
+        
+        service = StubService()
+        get_service, autopay.get_service = autopay.get_service, lambda: service
+        
+        try:
+            call_command('payex_autopay', run='2013-05', amount=500, product_number='P1', description='Subscription', rate=0, verbosity=0)
+        finally:
+            autopay.get_service = get_service
+        
+        self.assertEquals(len(service.calls), 6)
+        self.assertEquals(AutoPayStatus.objects.filter(agreementref='free').count(), 1)
+    
+    def testCommandAmountsFile(self):
+        """
+        Test the management command with amounts per agreement from a file, 
+        queried in batches.
+        """
+        
+        from djpayex import autopay
+        
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            f.write('ok1,1000\nok2,2000\nunknown,3000\n')
+        
+        service = StubService()
+        get_service, autopay.get_service = autopay.get_service, lambda: service
+        
+        try:
+            call_command('payex_autopay', run='2013-05', amounts_file=path, batch_size=1, product_number='P1', description='Subscription', rate=0, verbosity=0)
+        finally:
+            autopay.get_service = get_service
+            os.remove(path)
+        
+        self.assertEquals(sorted(service.calls), [('autopay', 'ok1', 1000), ('autopay', 'ok2', 2000)])
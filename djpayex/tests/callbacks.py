@@ -0,0 +1,432 @@
+import datetime
+import logging
+import threading
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from djpayex import views
+from djpayex import callbacks
+from djpayex.callbacks import CallbackExecutor, CallbackWorker, deduplicator
+from djpayex.client import get_service
+from djpayex.firewall import IPAllowlist, parse_network
+from djpayex.log import QueueHandler, audit_logger
+from djpayex.models import TransactionStatus, QueuedCallback, ProcessedCallback
+from djpayex.tests.utils import StubService
+
+
+class QueuedCallbackTests(TestCase):
+    
+    def setUp(self):
+        deduplicator.cache.clear()
+    
+    @override_settings(PAYEX_CALLBACK_QUEUED=True)
+    def testCallbackViewQueued(self):
+        """
+        Test that the callback view only queues the callback in queued mode.
+        """
+        
+        response = self.client.post(reverse('payex-callback'), {
+            'transactionRef': '123',
+            'transactionNumber': '456',
+            'orderRef': 'abc123',
+        })
+        self.assertEquals(response.content, 'OK')
+        self.assertEquals(TransactionStatus.objects.count(), 0)
+        
+        item = QueuedCallback.objects.get()
+        self.assertEquals(item.orderref, 'abc123')
+        self.assertEquals(item.transactionref, '123')
+        self.assertEquals(item.transactionnumber, '456')
+        self.assertEquals(item.status, QueuedCallback.PENDING)
+    
+    def testWorker(self):
+        """
+        Test that the worker completes queued orders, and retries failures.
+        """
+        
+        QueuedCallback.objects.enqueue(orderref='abc123', transactionnumber='456')
+        QueuedCallback.objects.enqueue(orderref='def456', transactionnumber='789')
+        
+        service = StubService(failing=('def456', ))
+        worker = CallbackWorker(service, workers=1, max_attempts=2, backoff=60)
+        
+        self.assertEquals(worker.run(once=True), 2)
+        self.assertEquals(len(service.calls), 2)
+        
+        self.assertEquals(TransactionStatus.objects.count(), 1)
+        self.assertEquals(TransactionStatus.objects.get().orderid, 'abc123')
+        
+        done = QueuedCallback.objects.get(orderref='abc123')
+        self.assertEquals(done.status, QueuedCallback.DONE)
+        self.assertEquals(done.attempts, 1)
+        
+        # The failed callback waits for a retry
+        retry = QueuedCallback.objects.get(orderref='def456')
+        self.assertEquals(retry.status, QueuedCallback.PENDING)
+        self.assertEquals(retry.attempts, 1)
+        self.assertTrue(retry.next_attempt > timezone.now() + datetime.timedelta(seconds=50))
+        self.assertEquals(worker.process_batch(), 0)
+        
+        # Fail the last attempt
+        QueuedCallback.objects.filter(pk=retry.pk).update(next_attempt=timezone.now())
+        self.assertEquals(worker.process_batch(), 1)
+        
+        retry = QueuedCallback.objects.get(pk=retry.pk)
+        self.assertEquals(retry.status, QueuedCallback.FAILED)
+        self.assertEquals(retry.attempts, 2)
+        self.assertEquals(len(service.calls), 3)
+    
+    def testClaimStale(self):
+        """
+        Test that callbacks are claimed once, unless left processing.
+        """
+        
+        item = QueuedCallback.objects.enqueue(orderref='abc123')
+        
+        self.assertEquals(len(QueuedCallback.objects.claim()), 1)
+        self.assertEquals(len(QueuedCallback.objects.claim()), 0)
+        
+        QueuedCallback.objects.filter(pk=item.pk).update(updated=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEquals(len(QueuedCallback.objects.claim(stale_after=600)), 1)
+    
+    def testWorkerSkipsProcessed(self):
+        """
+        Test that the worker does not complete transactions processed already.
+        """
+        
+        ProcessedCallback.objects.mark_processed('abc123', '456')
+        item = QueuedCallback.objects.enqueue(orderref='abc123', transactionnumber='456')
+        
+        service = StubService()
+        CallbackWorker(service, workers=1).run(once=True)
+        
+        self.assertEquals(service.calls, [])
+        self.assertEquals(QueuedCallback.objects.get(pk=item.pk).status, QueuedCallback.DONE)
+
+class DeduplicationTests(TestCase):
+    
+    def setUp(self):
+        deduplicator.cache.clear()
+        
+        self.service = StubService(failing=('failing', ))
+        views.get_service = lambda: self.service
+    
+    def tearDown(self):
+        views.get_service = get_service
+    
+    def post(self, orderref, transactionnumber):
+        return self.client.post(reverse('payex-callback'), {
+            'transactionRef': 'e4ee430eba5a4cdb85f7e81a93c2e424',
+            'transactionNumber': transactionnumber,
+            'orderRef': orderref,
+        })
+    
+    def testRepeatedCallbacks(self):
+        """
+        Test that repeated callbacks are answered without contacting PayEx.
+        """
+        
+        for i in range(3):
+            response = self.post('abc123', '456')
+            self.assertEquals(response.content, 'OK')
+        
+        self.assertEquals(len(self.service.calls), 1)
+        self.assertEquals(TransactionStatus.objects.get().orderref, 'abc123')
+        self.assertEquals(ProcessedCallback.objects.count(), 1)
+        
+        # Another transaction on the same order is processed
+        self.assertEquals(self.post('abc123', '789').content, 'OK')
+        self.assertEquals(len(self.service.calls), 2)
+        
+        # Processed callbacks are found in the database when not cached
+        deduplicator.cache.clear()
+        self.assertEquals(self.post('abc123', '456').content, 'OK')
+        self.assertEquals(len(self.service.calls), 2)
+        self.assertTrue(('abc123', '456') in deduplicator.cache)
+    
+    def testFailedCallbackRetried(self):
+        """
+        Test that failed callbacks are not recorded as processed.
+        """
+        
+        self.assertEquals(self.post('failing', '456').content, 'FAILURE')
+        self.assertEquals(self.post('failing', '456').content, 'FAILURE')
+        
+        self.assertEquals(len(self.service.calls), 2)
+        self.assertEquals(ProcessedCallback.objects.count(), 0)
+
+class DeferredCallbackTests(TestCase):
+    
+    def setUp(self):
+        deduplicator.cache.clear()
+    
+    def post(self, orderref, transactionnumber):
+        return self.client.post(reverse('payex-callback-deferred'), {
+            'transactionRef': 'e4ee430eba5a4cdb85f7e81a93c2e424',
+            'transactionNumber': transactionnumber,
+            'orderRef': orderref,
+        })
+    
+    @override_settings(PAYEX_CALLBACK_EXECUTOR_WORKERS=0, PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx')
+    def testCallbackViewDeferred(self):
+        """
+        Test that deferred callbacks are completed by the executor.
+        """
+        
+        self.assertEquals(self.post('abc123', '456').content, 'OK')
+        
+        self.assertEquals(TransactionStatus.objects.get().orderref, 'abc123')
+        self.assertEquals(QueuedCallback.objects.get().status, QueuedCallback.DONE)
+        self.assertEquals(ProcessedCallback.objects.count(), 1)
+        
+        self.assertEquals(self.post('abc123', '456').content, 'OK')
+        self.assertEquals(QueuedCallback.objects.count(), 1)
+    
+    @override_settings(PAYEX_CALLBACK_EXECUTOR_WORKERS=0, PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'fault_rate': 1})
+    def testFailedCallbackQueued(self):
+        """
+        Test that failed deferred callbacks are left for the worker.
+        """
+        
+        self.assertEquals(self.post('abc123', '456').content, 'OK')
+        
+        item = QueuedCallback.objects.get()
+        self.assertEquals(item.status, QueuedCallback.PENDING)
+        self.assertEquals(item.attempts, 1)
+        self.assertEquals(TransactionStatus.objects.count(), 0)
+    
+    def testSaturated(self):
+        """
+        Test that callbacks are refused when the backlog of the executor is 
+        full.
+        """
+        
+        started = threading.Event()
+        release = threading.Event()
+        
+        def block():
+            started.set()
+            release.wait(5)
+        
+        executor = CallbackExecutor(workers=1, backlog=1)
+        self.assertTrue(executor.submit(block))
+        started.wait(5)
+        self.assertTrue(executor.submit(block))
+        self.assertTrue(executor.is_full())
+        self.assertFalse(executor.submit(block))
+        
+        callbacks._executor = executor
+        try:
+            self.assertEquals(self.post('abc123', '456').content, 'FAILURE')
+            self.assertEquals(QueuedCallback.objects.count(), 0)
+        finally:
+            callbacks._executor = None
+            release.set()
+            executor.queue.join()
+    
+    def testAfterFork(self):
+        """
+        Test that the executor starts new threads when the ones it had are 
+        gone, as in a forked process.
+        """
+        
+        done = threading.Event()
+        
+        # A forked process inherits the thread objects, but not the threads
+        executor = CallbackExecutor(workers=1, backlog=1)
+        executor.threads = [threading.Thread()]
+        self.assertTrue(executor.submit(done.set))
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        
+        done.clear()
+        executor.pid = -1
+        executor.threads = [threading.Thread()]
+        self.assertTrue(executor.submit(done.set))
+        done.wait(5)
+        self.assertTrue(done.is_set())
+
+class CallbackFilterTests(TestCase):
+    
+    def setUp(self):
+        deduplicator.cache.clear()
+        
+        self.service = StubService()
+        views.get_service = lambda: self.service
+    
+    def tearDown(self):
+        views.get_service = get_service
+    
+    def post(self, orderref='a' * 32, transactionnumber='12345678', **extra):
+        return self.client.post(reverse('payex-callback'), {
+            'transactionRef': 'e4ee430eba5a4cdb85f7e81a93c2e424',
+            'transactionNumber': transactionnumber,
+            'orderRef': orderref,
+        }, **extra)
+    
+    def testAllowlist(self):
+        """
+        Test matching of addresses against CIDR ranges.
+        """
+        
+        allowlist = IPAllowlist(['10.0.0.0/8', '192.168.1.1', '2001:db8::/32'])
+        
+        self.assertTrue('10.20.30.40' in allowlist)
+        self.assertTrue('192.168.1.1' in allowlist)
+        self.assertTrue('::ffff:10.0.0.1' in allowlist)
+        self.assertTrue('2001:db8:1::1' in allowlist)
+        self.assertFalse('11.0.0.1' in allowlist)
+        self.assertFalse('192.168.1.2' in allowlist)
+        self.assertFalse('2001:db9::1' in allowlist)
+        self.assertFalse('unknown' in allowlist)
+        self.assertFalse('' in allowlist)
+        
+        self.assertRaises(ValueError, parse_network, '10.0.0.0/33')
+        self.assertRaises(ValueError, parse_network, '10.0.0/8')
+    
+    @override_settings(PAYEX_CALLBACK_ALLOWED_IPS=('10.0.0.0/8', ), PAYEX_CALLBACK_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def testAllowedIps(self):
+        """
+        Test that callbacks are only accepted from the allowed addresses.
+        """
+        
+        self.assertEquals(self.post().status_code, 403)
+        self.assertEquals(self.post(HTTP_X_FORWARDED_FOR='10.0.0.1, 127.0.0.1').status_code, 403)
+        self.assertEquals(len(self.service.calls), 0)
+        
+        self.assertEquals(self.post(HTTP_X_FORWARDED_FOR='127.0.0.1, 10.0.0.1').content, 'OK')
+        self.assertEquals(len(self.service.calls), 1)
+    
+    @override_settings(PAYEX_CALLBACK_RATE_LIMIT=0.001, PAYEX_CALLBACK_RATE_LIMIT_BURST=2)
+    def testRateLimit(self):
+        """
+        Test that callbacks are limited per address.
+        """
+        
+        self.assertEquals(self.post(transactionnumber='11111111').content, 'OK')
+        self.assertEquals(self.post(transactionnumber='22222222').content, 'OK')
+        self.assertEquals(self.post(transactionnumber='33333333').status_code, 429)
+        self.assertEquals(self.post(REMOTE_ADDR='10.0.0.1').content, 'OK')
+        self.assertEquals(len(self.service.calls), 3)
+    
+    @override_settings(PAYEX_CALLBACK_STRICT=True)
+    def testStrict(self):
+        """
+        Test that callbacks with invalid fields are rejected in strict mode.
+        """
+        
+        self.assertEquals(self.post(orderref='abc123').status_code, 400)
+        self.assertEquals(self.post(transactionnumber='1234').status_code, 400)
+        self.assertEquals(self.post(orderref='').status_code, 400)
+        self.assertEquals(len(self.service.calls), 0)
+        
+        self.assertEquals(self.post().content, 'OK')
+        self.assertEquals(self.post(transactionnumber='').content, 'OK')
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the records it handles.
+    """
+    
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    
+    def emit(self, record):
+        self.records.append(record)
+
+class AuditLogTests(TestCase):
+    
+    def setUp(self):
+        deduplicator.cache.clear()
+        
+        self.handler = RecordingHandler()
+        self.level = audit_logger.level
+        audit_logger.addHandler(self.handler)
+        audit_logger.setLevel(logging.INFO)
+        
+        self.service = StubService()
+        views.get_service = lambda: self.service
+    
+    def tearDown(self):
+        audit_logger.removeHandler(self.handler)
+        audit_logger.setLevel(self.level)
+        views.get_service = get_service
+    
+    @override_settings(PAYEX_CALLBACK_LOG_REDACT=('transactionRef', ))
+    def testLogged(self):
+        """
+        Test that callbacks are logged with the callback fields only, redacted.
+        """
+        
+        self.client.post(reverse('payex-callback'), {
+            'transactionRef': 'e4ee430eba5a4cdb85f7e81a93c2e424',
+            'transactionNumber': '40276785',
+            'orderRef': 'abc123',
+        }, HTTP_COOKIE='sessionid=secret')
+        
+        record = self.handler.records[0]
+        self.assertEquals(record.payex['result'], 'OK')
+        self.assertEquals(record.payex['orderRef'], 'abc123')
+        self.assertEquals(record.payex['transactionRef'], '*' * 28 + 'e424')
+        self.assertTrue('transactionNumber=40276785' in record.getMessage())
+        self.assertFalse('secret' in record.getMessage())
+    
+    @override_settings(PAYEX_CALLBACK_LOG_SAMPLE_RATE=0)
+    def testSampled(self):
+        """
+        Test that sampling skips successful callbacks only.
+        """
+        
+        self.client.post(reverse('payex-callback'), {'orderRef': 'abc123'})
+        self.client.post(reverse('payex-callback'), {})
+        
+        self.assertEquals([record.payex['result'] for record in self.handler.records], ['FAILURE'])
+    
+    def testQueueHandler(self):
+        """
+        Test that the queue handler writes records in the background.
+        """
+        
+        handler = QueueHandler(handler_class=RecordingHandler, maxsize=10)
+        logger = logging.getLogger('djpayex.tests.queue')
+        logger.addHandler(handler)
+        logger.propagate = False
+        
+        try:
+            for i in range(3):
+                logger.warning('Record %s', i)
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        
+        self.assertEquals([record.getMessage() for record in handler.target.records], ['Record 0', 'Record 1', 'Record 2'])
+        self.assertEquals(handler.dropped, 0)
+    
+    def testQueueHandlerAfterFork(self):
+        """
+        Test that the queue handler starts a new thread when the one it had 
+        is gone, as in a forked process.
+        """
+        
+        handler = QueueHandler(handler_class=RecordingHandler, maxsize=10)
+        logger = logging.getLogger('djpayex.tests.queue')
+        logger.addHandler(handler)
+        logger.propagate = False
+        
+        try:
+            logger.warning('Record 0')
+            handler.queue.put(None)
+            handler.thread.join(5)
+            
+            # A forked process inherits the thread object, but not the thread
+            handler.pid = -1
+            logger.warning('Record 1')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        
+        self.assertEquals([record.getMessage() for record in handler.target.records], ['Record 0', 'Record 1'])
@@ -0,0 +1,259 @@
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import threading
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from suds.transport import Request, TransportError
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from djpayex.client import CircuitBreaker, KeepAliveTransport, ServiceRegistry, build_client, get_circuit_breaker, get_service
+from djpayex.exceptions import CircuitOpen
+from djpayex.models import Agreement
+from djpayex.testing import FakePayEx
+
+WSDL = """<?xml version="1.0"?>
+<definitions name="Test" targetNamespace="http://example.com/test" xmlns:tns="http://example.com/test" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns="http://schemas.xmlsoap.org/wsdl/">
+  <message name="PingIn"><part name="value" type="xsd:string"/></message>
+  <message name="PingOut"><part name="result" type="xsd:string"/></message>
+  <portType name="TestPort"><operation name="Ping"><input message="tns:PingIn"/><output message="tns:PingOut"/></operation></portType>
+  <binding name="TestBinding" type="tns:TestPort">
+    <soap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="Ping">
+      <soap:operation soapAction="Ping"/>
+      <input><soap:body use="literal" namespace="http://example.com/test"/></input>
+      <output><soap:body use="literal" namespace="http://example.com/test"/></output>
+    </operation>
+  </binding>
+  <service name="TestService"><port name="TestPort" binding="tns:TestBinding"><soap:address location="http://127.0.0.1/test"/></port></service>
+</definitions>
+"""
+
+
+class SoapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers POST requests on a persistent HTTP/1.1 connection.
+    """
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        
+        if self.path == '/fault':
+            body = 'fault'
+            self.send_response(500)
+        else:
+            self.send_response(200)
+        
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+class KeepAliveTransportTests(TestCase):
+    
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), SoapHandler)
+        self.server.connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def testConnectionReused(self):
+        """
+        Test that requests are sent on the same connection.
+        """
+        
+        transport = KeepAliveTransport()
+        
+        for message in ('<a/>', '<b/>', '<c/>'):
+            reply = transport.send(Request('%s/pxorder' % self.url, message))
+            self.assertEquals(reply.code, 200)
+            self.assertEquals(reply.message, message)
+        
+        self.assertEquals(self.server.connections, 1)
+        
+        # Errors are raised as transport errors, for suds to handle
+        self.assertRaises(TransportError, transport.send, Request('%s/fault' % self.url, '<a/>'))
+        
+        transport.close()
+
+class ServiceRegistryTests(TestCase):
+    
+    def testServicePerThread(self):
+        """
+        Test that services are reused within a thread, and not shared between threads.
+        """
+        
+        registry = ServiceRegistry()
+        
+        service = registry.get_service('123', 'abc', False)
+        self.assertTrue(registry.get_service('123', 'abc', False) is service)
+        self.assertFalse(registry.get_service('123', 'abc', True) is service)
+        self.assertFalse(registry.get_service('456', 'abc', False) is service)
+        
+        services = []
+        thread = threading.Thread(target=lambda: services.append(registry.get_service('123', 'abc', False)))
+        thread.start()
+        thread.join()
+        self.assertFalse(services[0] is service)
+        
+        # Forked processes start over
+        registry.pid = -1
+        self.assertFalse(registry.get_service('123', 'abc', False) is service)
+    
+    def testClientShared(self):
+        """
+        Test that the client for a WSDL is built once, and copied for each thread.
+        """
+        
+        class Client(object):
+            def clone(self):
+                return Client()
+        
+        built = []
+        
+        def get_client(url):
+            built.append(url)
+            return Client()
+        
+        registry = ServiceRegistry()
+        registry.get_client = get_client
+        
+        service = registry.get_service('123', 'abc', False)
+        client = service.complete.client_factory()
+        
+        self.assertTrue(service.complete.client_factory() is client)
+        self.assertTrue(isinstance(client, Client))
+        self.assertEquals(built, [service.complete.testing_url])
+        
+        # Handlers for the same WSDL share the client
+        self.assertTrue(service.initialize.client_factory() is client)
+        self.assertEquals(len(built), 1)
+    
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'declined_rate': 1})
+    def testServiceBackend(self):
+        """
+        Test that PAYEX_SERVICE_BACKEND replaces the PayEx service.
+        """
+        
+        service = ServiceRegistry().get_service('123', 'abc', False)
+        self.assertTrue(isinstance(service, FakePayEx))
+        self.assertEquals(service.accountNumber, '123')
+        self.assertEquals(service.complete(orderRef='abc')['transactionStatus'], '5')
+
+class WsdlCacheTests(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wsdl = os.path.join(self.directory, 'test.wsdl')
+        
+        f = open(self.wsdl, 'w')
+        f.write(WSDL)
+        f.close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def testCachedDefinitions(self):
+        """
+        Test that clients are built from the cache when the WSDL is gone.
+        """
+        
+        url = 'file://%s' % self.wsdl
+        
+        with override_settings(PAYEX_WSDL_CACHE_DIR=os.path.join(self.directory, 'cache')):
+            client = build_client(url)
+            self.assertTrue(isinstance(client.options.transport, KeepAliveTransport))
+            
+            os.remove(self.wsdl)
+            
+            client = build_client(url)
+            self.assertEquals(client.wsdl.services[0].name, 'TestService')
+
+class CircuitBreakerTests(TestCase):
+    
+    def testStates(self):
+        """
+        Test that the breaker opens after repeated failures, and closes after 
+        a successful trial call.
+        """
+        
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+        
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEquals(breaker.get_state()['state'], CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen, breaker.before_call)
+        
+        # A trial call after the reset timeout, failing
+        breaker.opened -= 30
+        breaker.before_call()
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertRaises(CircuitOpen, breaker.before_call)
+        breaker.record_failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        
+        # A successful trial call
+        breaker.opened -= 30
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEquals(breaker.get_state(), {'state': CircuitBreaker.CLOSED, 'failures': 0, 'opened': None})
+    
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'fault_rate': 1}, PAYEX_CIRCUIT_BREAKER_THRESHOLD=2)
+    def testCallback(self):
+        """
+        Test that callbacks fail fast while the breaker is open.
+        """
+        
+        for i in range(3):
+            response = self.client.post(reverse('payex-callback'), {'orderRef': 'abc%s' % i})
+            self.assertEquals(response.content, 'FAILURE')
+        
+        self.assertEquals(get_circuit_breaker().get_state()['state'], CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen, get_service().complete, orderRef='abc')
+    
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_CIRCUIT_BREAKER_THRESHOLD=1)
+    def testVerifyStale(self):
+        """
+        Test that the last known verification status is used while the breaker 
+        is open.
+        """
+        
+        cache.clear()
+        obj = Agreement.objects.create(agreementref='verified1')
+        self.assertTrue(obj.is_verified())
+        
+        get_circuit_breaker().record_failure()
+        cache.delete(Agreement.objects.get_cache_key('verified1'))
+        
+        self.assertTrue(obj.is_verified())
+        self.assertEquals(Agreement.objects.verify_many(Agreement.objects.all()), {'verified1': True})
+        self.assertFalse(Agreement.objects.verify('unknown'))
+    
+    @override_settings(PAYEX_CIRCUIT_BREAKER_THRESHOLD=0)
+    def testDisabled(self):
+        """
+        Test that the breaker can be disabled.
+        """
+        
+        self.assertEquals(get_circuit_breaker(), None)
@@ -0,0 +1,71 @@
+import csv
+import datetime
+import gzip
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson as json
+
+from djpayex.export import export, export_rows, gzip_stream
+from djpayex.models import TransactionStatus
+from djpayex.tests.utils import completed_response
+
+
+class ExportTests(TestCase):
+    
+    def setUp(self):
+        for orderref in ('a1', 'a2', 'a3'):
+            TransactionStatus.objects.create_from_response(completed_response(orderref), obj=TransactionStatus(orderref=orderref))
+        
+        TransactionStatus.objects.filter(orderref='a1').update(created=datetime.datetime(2013, 1, 15))
+    
+    def testCsv(self):
+        """
+        Test that rows are exported in chunks with a header.
+        """
+        
+        chunks = list(export_rows(TransactionStatus.objects.all(), ['id', 'orderref', 'created'], chunk_size=2))
+        self.assertEquals(len(chunks), 2)
+        
+        rows = list(csv.reader(StringIO(''.join(chunks))))
+        self.assertEquals(rows[0], ['id', 'orderref', 'created'])
+        self.assertEquals([row[1] for row in rows[1:]], ['a1', 'a2', 'a3'])
+        self.assertEquals(rows[1][2], '2013-01-15T00:00:00')
+        
+        rows = list(csv.reader(StringIO(''.join(export_rows(TransactionStatus.objects.filter(orderref='a2'))))))
+        self.assertTrue('raw_response' not in rows[0])
+        self.assertTrue('transactionnumber' in rows[0])
+        
+        self.assertRaises(ValueError, list, export_rows(TransactionStatus.objects.all(), ['unknown']))
+    
+    def testJsonLines(self):
+        """
+        Test that raw responses are exported decoded.
+        """
+        
+        data = ''.join(export(TransactionStatus.objects.filter(orderref='a2'), ['orderref', 'raw_response'], 'jsonl', compress=True))
+        lines = gzip.GzipFile(fileobj=StringIO(data)).read().splitlines()
+        
+        self.assertEquals(len(lines), 1)
+        self.assertEquals(json.loads(lines[0])['raw_response']['orderId'], 'a2')
+        
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(''.join(gzip_stream([])))).read(), '')
+    
+    def testCommand(self):
+        """
+        Test that responses are exported for a date range.
+        """
+        
+        out = StringIO()
+        call_command('payex_export', since='2013-01-01', until='2013-02-01', fields='orderref', stdout=out)
+        self.assertEquals(out.getvalue().splitlines(), ['orderref', 'a1'])
+        
+        path = tempfile.mktemp()
+        try:
+            call_command('payex_export', model='autopaystatus', format='jsonl', gzip=True, output=path)
+            self.assertEquals(gzip.open(path).read(), '')
+        finally:
+            os.remove(path)
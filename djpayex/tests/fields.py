@@ -0,0 +1,65 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djpayex.fields import COMPRESSED_PREFIX, decode_payload, encode_payload
+from djpayex.models import TransactionStatus
+from djpayex.tests.utils import completed_response
+
+
+class PayloadFieldTests(TestCase):
+    
+    def testEncoding(self):
+        """
+        Test that payloads are stored as canonical JSON, compressed when large.
+        """
+        
+        response = completed_response('abc123')
+        
+        data = encode_payload(response)
+        self.assertTrue(data.startswith('{"amount":"5000",'))
+        self.assertEquals(decode_payload(data), response)
+        
+        data = encode_payload(response, compress_threshold=100)
+        self.assertTrue(data.startswith(COMPRESSED_PREFIX))
+        self.assertEquals(decode_payload(data), response)
+        
+        # Values stored by earlier versions
+        self.assertEquals(decode_payload(repr(response)), response)
+        self.assertEquals(decode_payload(''), {})
+    
+    @override_settings(PAYEX_PAYLOAD_COMPRESS_THRESHOLD=100)
+    def testLazyDecoding(self):
+        """
+        Test that stored payloads are decoded when accessed.
+        """
+        
+        response = completed_response('abc123')
+        obj = TransactionStatus.objects.create_from_response(response)
+        
+        obj = TransactionStatus.objects.get(pk=obj.pk)
+        self.assertTrue(obj.__dict__['raw_response'].startswith(COMPRESSED_PREFIX))
+        self.assertEquals(obj.raw_response, response)
+        self.assertTrue(obj.__dict__['raw_response'] is obj.raw_response)
+        
+        # Saving does not change the payload
+        obj.save()
+        self.assertEquals(TransactionStatus.objects.get(pk=obj.pk).raw_response, response)
+        
+        # Deferred payloads are loaded when accessed
+        obj = TransactionStatus.objects.defer('raw_response').get(pk=obj.pk)
+        self.assertEquals(obj.raw_response, response)
+    
+    def testConvertCommand(self):
+        """
+        Test conversion of raw responses stored by earlier versions.
+        """
+        
+        response = completed_response('abc123')
+        obj = TransactionStatus.objects.create_from_response(response)
+        TransactionStatus.objects.filter(pk=obj.pk).update(raw_response=repr(response))
+        
+        call_command('payex_convert_payloads', chunk_size=1, verbosity=0)
+        
+        stored = TransactionStatus.objects.values_list('raw_response', flat=True).get(pk=obj.pk)
+        self.assertEquals(stored, encode_payload(response, 1024))
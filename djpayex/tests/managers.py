@@ -1,9 +1,17 @@
 import datetime
+from decimal import Decimal
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
 
-from djpayex.models import InitializedPayment, TransactionStatus, Agreement, AutoPayStatus
+from djpayex import states
+from djpayex.mapping import get_mapper
+from djpayex.models import InitializedPayment, TransactionStatus, Agreement, AutoPayStatus, CurrentStatus
+from djpayex.management.commands.payex_rebuild_current_status import Command
+from djpayex.tests.utils import completed_response
 
 class InitializedPaymentTests(TestCase):
     
@@ -153,6 +161,86 @@ class TransactionStatusTests(TestCase):
         self.assertFalse(obj.frauddata)
         
         self.assertTrue(obj.is_completed_successfully())
+    
+    def testLatestForOrder(self):
+        """
+        Test lookup of the latest status of an order.
+        """
+        
+        self.assertEquals(TransactionStatus.objects.latest_for_order('abc123'), None)
+        
+        first = TransactionStatus.objects.create(orderref='abc123', orderstatus='1')
+        latest = TransactionStatus.objects.create(orderref='abc123', orderstatus='0')
+        TransactionStatus.objects.create(orderref='def456', orderstatus='1')
+        
+        self.assertEquals(TransactionStatus.objects.latest_for_order('abc123'), latest)
+        self.assertNotEquals(TransactionStatus.objects.latest_for_order('abc123'), first)
+        self.assertEquals(TransactionStatus.objects.for_order('abc123').count(), 2)
+        
+        # The composite indexes are created with the table
+        if connection.vendor == 'sqlite':
+            cursor = connection.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'djpayex_transactionstatus'")
+            indexes = [row[0] for row in cursor.fetchall()]
+            
+            self.assertTrue('djpayex_transactionstatus_orderref_created' in indexes)
+            self.assertTrue('djpayex_transactionstatus_agreementref_created' in indexes)
+
+class TransactionStatusAmountTests(TestCase):
+    
+    def setUp(self):
+        for amount, paymentmethod, transactionstatus in (('5000', 'VISA', '0'), ('2500', 'VISA', '3'), ('1000', 'MC', '0'), ('700', 'MC', '5')):
+            TransactionStatus.objects.create_from_response({
+                'status': {
+                    'errorCode': 'OK', 
+                    'code': 'OK', 
+                    'description': 'OK', 
+                    'thirdPartyError': None, 
+                    'paramName': None
+                }, 
+                'amount': amount, 
+                'paymentMethod': paymentmethod, 
+                'transactionStatus': transactionstatus
+            })
+    
+    def testAmountMinor(self):
+        """
+        Test that amounts are stored as integers.
+        """
+        
+        obj = TransactionStatus.objects.get(amount='5000')
+        self.assertEquals(obj.amount_minor, 5000)
+        self.assertEquals(obj.get_decimal_amount(), Decimal('50.00'))
+    
+    def testTotals(self):
+        """
+        Test aggregation of amounts in the database.
+        """
+        
+        self.assertEquals(TransactionStatus.objects.total_amount(), Decimal('92.00'))
+        self.assertEquals(TransactionStatus.objects.completed_successfully().total_amount(), Decimal('85.00'))
+        self.assertEquals(TransactionStatus.objects.filter(paymentmethod='AMEX').total_amount(), Decimal('0'))
+        
+        self.assertEquals(TransactionStatus.objects.totals_by('paymentmethod'), [
+            {'paymentmethod': u'MC', 'total': Decimal('17.00'), 'count': 2}, 
+            {'paymentmethod': u'VISA', 'total': Decimal('75.00'), 'count': 2}, 
+        ])
+        
+        self.assertEquals(TransactionStatus.objects.totals_by('day'), [
+            {'day': TransactionStatus.objects.all()[0].created.date(), 'total': Decimal('92.00'), 'count': 4}, 
+        ])
+    
+    def testBackfill(self):
+        """
+        Test the backfill of amounts stored by earlier versions.
+        """
+        
+        TransactionStatus.objects.update(amount_minor=None)
+        
+        call_command('payex_backfill_amounts', chunk_size=3, verbosity=0)
+        
+        self.assertEquals(TransactionStatus.objects.filter(amount_minor__isnull=True).count(), 0)
+        self.assertEquals(TransactionStatus.objects.get(amount='2500').amount_minor, 2500)
 
 class AgreementTests(TestCase):
     
@@ -193,6 +281,57 @@ class AgreementTests(TestCase):
         self.assertEquals(obj.description, response['status']['description'])
         
         self.assertEquals(obj.agreementref, '8a9c58a1b10641ed8fbfe345968bc062')
+    
+    def _fake_check_agreement(self, agreementref):
+        self.checked.append(agreementref)
+        return agreementref.startswith('verified')
+    
+    def testVerifyCached(self):
+        """
+        Test that verification statuses are cached until the agreement changes.
+        """
+        
+        cache.clear()
+        self.checked = []
+        Agreement.objects.check_agreement = self._fake_check_agreement
+        
+        try:
+            obj = Agreement.objects.create(agreementref='verified1')
+            
+            self.assertTrue(obj.is_verified())
+            self.assertTrue(obj.is_verified())
+            self.assertEquals(self.checked, ['verified1'])
+            
+            self.assertTrue(obj.is_verified(use_cache=False))
+            self.assertEquals(len(self.checked), 2)
+            
+            # Saving the agreement invalidates the status
+            obj.save()
+            self.assertTrue(obj.is_verified())
+            self.assertEquals(len(self.checked), 3)
+        finally:
+            del Agreement.objects.check_agreement
+    
+    def testVerifyMany(self):
+        """
+        Test that only agreements without a cached status are checked.
+        """
+        
+        cache.clear()
+        self.checked = []
+        Agreement.objects.check_agreement = self._fake_check_agreement
+        
+        try:
+            for agreementref in ('verified1', 'verified2', 'unverified1'):
+                Agreement.objects.create(agreementref=agreementref)
+            
+            self.assertTrue(Agreement.objects.verify('verified1'))
+            
+            verified = Agreement.objects.verify_many(Agreement.objects.all(), max_workers=2)
+            self.assertEquals(verified, {'verified1': True, 'verified2': True, 'unverified1': False})
+            self.assertEquals(sorted(self.checked), ['unverified1', 'verified1', 'verified2'])
+        finally:
+            del Agreement.objects.check_agreement
 
 class AutoPayTests(TestCase):
     
@@ -239,3 +378,355 @@ class AutoPayTests(TestCase):
         self.assertEquals(obj.transactionstatus, '0')
         
         self.assertTrue(obj.is_completed_successfully())
+
+class TransactionStateTests(TestCase):
+    
+    def setUp(self):
+        for errorcode, transactionstatus in (('OK', '0'), ('OK', '3'), ('OK', '1'), ('OK', '4'), ('OK', '5'), ('OK', '6'), ('Order_OrderProcessing', '')):
+            AutoPayStatus.objects.create(errorcode=errorcode, transactionstatus=transactionstatus)
+    
+    def testStateFilters(self):
+        """
+        Test that the queryset filters agree with the Python methods.
+        """
+        
+        objs = AutoPayStatus.objects.all()
+        
+        for state in (states.SUCCESSFUL, states.PENDING, states.FAILED, states.CAPTURED, states.CREDITED, states.ERROR):
+            expected = set(obj.pk for obj in objs if obj.get_state() == state)
+            self.assertEquals(set(AutoPayStatus.objects.by_state(state).values_list('pk', flat=True)), expected)
+        
+        self.assertEquals(sorted(AutoPayStatus.objects.successful().values_list('transactionstatus', flat=True)), [u'0', u'3'])
+        self.assertEquals(sorted(AutoPayStatus.objects.failed().values_list('transactionstatus', flat=True)), [u'4', u'5'])
+        self.assertEquals(list(AutoPayStatus.objects.pending().values_list('transactionstatus', flat=True)), [u'1'])
+        self.assertEquals(AutoPayStatus.objects.by_state(states.PENDING, states.ERROR).count(), 2)
+        self.assertEquals(AutoPayStatus.objects.by_state().count(), 0)
+        
+        successful = [obj.pk for obj in objs if obj.is_completed_successfully()]
+        self.assertEquals(sorted(AutoPayStatus.objects.completed_successfully().values_list('pk', flat=True)), sorted(successful))
+        
+        self.assertRaises(ValueError, AutoPayStatus.objects.by_state, 'unknown')
+    
+    def testTransitions(self):
+        """
+        Test the transition table.
+        """
+        
+        self.assertTrue(states.can_transition(states.INITIALIZE, states.SALE))
+        self.assertTrue(states.can_transition(states.AUTHORIZE, states.CAPTURE))
+        self.assertFalse(states.can_transition(states.SALE, states.INITIALIZE))
+        self.assertFalse(states.can_transition(states.FAILURE, states.SALE))
+        
+        self.assertTrue(states.can_replace('OK', states.INITIALIZE, 'OK', states.FAILURE))
+        self.assertTrue(states.can_replace('ERROR', '', 'OK', states.INITIALIZE))
+        self.assertTrue(states.can_replace('OK', states.SALE, 'OK', states.SALE))
+        self.assertFalse(states.can_replace('OK', states.SALE, 'OK', states.INITIALIZE))
+        self.assertFalse(states.can_replace('OK', states.CAPTURE, 'ERROR', ''))
+
+
+class ResponseMapperTests(TestCase):
+    
+    def testMapperCoercion(self):
+        """
+        Test that values are coerced to the field types.
+        """
+        
+        response = {
+            'status': {
+                'errorCode': 'OK', 
+                'code': 'OK', 
+                'description': 'OK', 
+                'thirdPartyError': None, 
+                'paramName': None
+            }, 
+            'transactionNumber': 40276785, 
+            'alreadyCompleted': 'True', 
+            'pending': 'false', 
+            'fraudData': None, 
+            'clientGsmNumber': None, 
+            'unknownKey': 'ignored'
+        }
+        
+        obj = TransactionStatus.objects.create_from_response(response, commit=False)
+        
+        self.assertEquals(obj.transactionnumber, u'40276785')
+        self.assertEquals(obj.clientgsmnumber, u'')
+        self.assertTrue(obj.alreadycompleted is True)
+        self.assertTrue(obj.pending is False)
+        self.assertTrue(obj.frauddata is False)
+        self.assertFalse(hasattr(obj, 'unknownkey'))
+    
+    def testMapperCached(self):
+        """
+        Test that mappers are compiled once per model.
+        """
+        
+        self.assertTrue(get_mapper(TransactionStatus) is get_mapper(TransactionStatus))
+        self.assertFalse(get_mapper(TransactionStatus) is get_mapper(AutoPayStatus))
+        self.assertEquals(get_mapper(Agreement).get_setters('agreementRef')[0][0], 'agreementref')
+        self.assertEquals(get_mapper(Agreement).get_setters('header'), None)
+
+class BulkCreateTests(TestCase):
+    
+    def _responses(self, count):
+        """
+        Generates completed transaction responses with unique header ids.
+        """
+        
+        for i in range(count):
+            yield {
+                'status': {
+                    'errorCode': 'OK', 
+                    'code': 'OK', 
+                    'description': 'OK', 
+                    'thirdPartyError': None, 
+                    'paramName': None
+                }, 
+                'header': {
+                    'date': '2011-10-07 12:59:30', 
+                    'name': 'Payex Header v1.0', 
+                    'id': '%032x' % i
+                }, 
+                'transactionNumber': str(40276785 + i), 
+                'transactionStatus': '0', 
+                'clientGsmNumber': None, 
+                'amount': '5000'
+            }
+    
+    def testBulkCreateFromResponses(self):
+        """
+        Test bulk creation from a generator of responses.
+        """
+        
+        inserted = TransactionStatus.objects.bulk_create_from_responses(self._responses(25), batch_size=10)
+        self.assertEquals(inserted, 25)
+        self.assertEquals(TransactionStatus.objects.count(), 25)
+        
+        obj = TransactionStatus.objects.get(transactionnumber='40276785')
+        self.assertEquals(obj.headerid, '%032x' % 0)
+        self.assertEquals(obj.errorcode, 'OK')
+        self.assertEquals(obj.clientgsmnumber, '')
+        self.assertTrue(isinstance(obj.created, datetime.datetime))
+        self.assertTrue(obj.is_completed_successfully())
+    
+    def testBulkCreateIgnoreConflicts(self):
+        """
+        Test that replaying responses does not duplicate rows.
+        """
+        
+        TransactionStatus.objects.bulk_create_from_responses(self._responses(10))
+        
+        # Replay with new responses and a duplicate within the same batch
+        responses = list(self._responses(15)) + list(self._responses(1))
+        inserted = TransactionStatus.objects.bulk_create_from_responses(responses, batch_size=4, ignore_conflicts=True)
+        self.assertEquals(inserted, 5)
+        self.assertEquals(TransactionStatus.objects.count(), 15)
+    
+    def testBulkCreateLargeBatch(self):
+        """
+        Test that a batch over the SQLite limit of variables per query is split.
+        """
+        
+        size = TransactionStatus.objects._get_insert_batch_size(120)
+        self.assertTrue(size * len(TransactionStatus._meta.fields) <= 999)
+        
+        inserted = TransactionStatus.objects.bulk_create_from_responses(self._responses(120), batch_size=120)
+        self.assertEquals(inserted, 120)
+        self.assertEquals(TransactionStatus.objects.count(), 120)
+
+class CurrentStatusTests(TestCase):
+    
+    def _response(self, transactionstatus, transactionnumber, **kwargs):
+        response = {
+            'status': {
+                'errorCode': 'OK', 
+                'code': 'OK', 
+                'description': 'OK', 
+                'thirdPartyError': None, 
+                'paramName': None
+            }, 
+            'transactionNumber': transactionnumber, 
+            'transactionStatus': transactionstatus, 
+        }
+        response.update(kwargs)
+        return response
+    
+    def testUpdatedOnCreate(self):
+        """
+        Test that the current status follows the latest stored status.
+        """
+        
+        self.assertEquals(CurrentStatus.objects.for_order('c59cc7c7cc0c4194b1e21c27d6ba4074'), None)
+        
+        TransactionStatus.objects.create_from_response(self._response('1', '40276785'), obj=TransactionStatus(orderref='c59cc7c7cc0c4194b1e21c27d6ba4074'))
+        latest = TransactionStatus.objects.create_from_response(self._response('0', '40276786', agreementRef='a1b2'), obj=TransactionStatus(orderref='c59cc7c7cc0c4194b1e21c27d6ba4074'))
+        
+        current = CurrentStatus.objects.for_order('c59cc7c7cc0c4194b1e21c27d6ba4074')
+        self.assertEquals(current.transactionnumber, '40276786')
+        self.assertEquals(current.state, states.SUCCESSFUL)
+        self.assertEquals(current.get_status(), latest)
+        self.assertEquals(CurrentStatus.objects.for_agreement('a1b2').status_id, latest.pk)
+        
+        # An older status does not replace the current one
+        older = TransactionStatus.objects.get(transactionnumber='40276785')
+        older.created = latest.created - datetime.timedelta(days=1)
+        TransactionStatus.objects.update_current_status([older])
+        self.assertEquals(CurrentStatus.objects.for_order('c59cc7c7cc0c4194b1e21c27d6ba4074').transactionnumber, '40276786')
+        
+        # Autopay statuses update the current status of their agreement
+        autopay = AutoPayStatus.objects.create_from_response(self._response('5', '40276787'), obj=AutoPayStatus(agreementref='a1b2'))
+        current = CurrentStatus.objects.for_agreement('a1b2')
+        self.assertEquals(current.state, states.FAILED)
+        self.assertEquals(current.get_status(), autopay)
+        self.assertEquals(CurrentStatus.objects.count(), 2)
+    
+    def testTerminalStatusKept(self):
+        """
+        Test that a late status does not replace the terminal current status 
+        of an order, unless the order can change to it.
+        """
+        
+        orderref = 'c59cc7c7cc0c4194b1e21c27d6ba4074'
+        
+        TransactionStatus.objects.create_from_response(self._response('3', '40276785'), obj=TransactionStatus(orderref=orderref))
+        TransactionStatus.objects.create_from_response(self._response('1', '40276786'), obj=TransactionStatus(orderref=orderref))
+        self.assertEquals(CurrentStatus.objects.for_order(orderref).transactionnumber, '40276785')
+        
+        error = self._response(None, None)
+        error['status']['errorCode'] = 'ERROR'
+        TransactionStatus.objects.create_from_response(error, obj=TransactionStatus(orderref=orderref))
+        self.assertEquals(CurrentStatus.objects.for_order(orderref).transactionnumber, '40276785')
+        
+        TransactionStatus.objects.create_from_response(self._response('6', '40276787'), obj=TransactionStatus(orderref=orderref))
+        current = CurrentStatus.objects.for_order(orderref)
+        self.assertEquals(current.transactionnumber, '40276787')
+        self.assertEquals(current.state, states.CAPTURED)
+        
+        # Within a batch, the statuses are applied in order
+        TransactionStatus.objects.bulk_create_from_responses([
+            self._response('1', '40276788', orderRef=orderref),
+            self._response('2', '40276789', orderRef=orderref),
+            self._response('0', '40276790', orderRef=orderref),
+        ])
+        current = CurrentStatus.objects.for_order(orderref)
+        self.assertEquals(current.transactionnumber, '40276789')
+        self.assertEquals(current.state, states.CREDITED)
+    
+    def testBulkCreateAndRebuild(self):
+        """
+        Test the current status after bulk creation, and rebuilding it.
+        """
+        
+        responses = [self._response(str(i % 2), str(40276785 + i), orderRef='%032x' % (i % 3)) for i in range(9)]
+        TransactionStatus.objects.bulk_create_from_responses(responses, batch_size=4)
+        
+        # The latest status of each order, except for the late INITIALIZE 
+        # statuses following a SALE
+        expected = {
+            '%032x' % 0: '40276791',
+            '%032x' % 1: '40276789',
+            '%032x' % 2: '40276793',
+        }
+        
+        current = dict(CurrentStatus.objects.values_list('reference', 'transactionnumber'))
+        self.assertEquals(current, expected)
+        
+        # Statuses are replaced, and those without stored statuses deleted
+        CurrentStatus.objects.update(transactionnumber='')
+        CurrentStatus.objects.update_from_status(CurrentStatus.AGREEMENT, 'a1b2', TransactionStatus.objects.latest('id'))
+        call_command('payex_rebuild_current_status', chunk_size=2, clear=True, verbosity=0)
+        
+        current = dict(CurrentStatus.objects.values_list('reference', 'transactionnumber'))
+        self.assertEquals(current, expected)
+    
+    def testStoredQueries(self):
+        """
+        Test that the stored statuses of a batch are looked up in one query 
+        per chunk of references, rather than one per reference.
+        """
+        
+        responses = [self._response('1', str(40276785 + i), orderRef='%032x' % (i % 3)) for i in range(9)]
+        TransactionStatus.objects.bulk_create_from_responses(responses)
+        objs = list(TransactionStatus.objects.all())
+        
+        with self.assertNumQueries(1):
+            stored = TransactionStatus.objects._get_stored(objs)
+        
+        self.assertEquals(sorted(status.pk for status in stored), sorted(obj.pk for obj in objs))
+
+class CallerTransactionTests(TransactionTestCase):
+    
+    def testWithinCallerTransaction(self):
+        """
+        Test that storing responses within a transaction of the caller neither 
+        commits nor rolls back the work of the caller.
+        """
+        
+        response = {
+            'status': {
+                'errorCode': 'OK', 
+                'code': 'OK', 
+                'description': 'OK', 
+                'thirdPartyError': None, 
+                'paramName': None
+            }, 
+            'transactionNumber': '40276785', 
+            'transactionStatus': '0', 
+        }
+        
+        with transaction.commit_manually():
+            try:
+                Agreement.objects.create(agreementref='a1b2')
+                TransactionStatus.objects.create_from_response(response, obj=TransactionStatus(orderref='c59cc7c7cc0c4194b1e21c27d6ba4074'))
+                TransactionStatus.objects.bulk_create_from_responses([dict(response, transactionNumber='40276786')])
+                self.assertEquals(CurrentStatus.objects.count(), 1)
+            finally:
+                transaction.rollback()
+        
+        self.assertEquals(Agreement.objects.count(), 0)
+        self.assertEquals(TransactionStatus.objects.count(), 0)
+        
+        # Outside of a transaction the responses are committed
+        TransactionStatus.objects.create_from_response(response)
+        self.assertFalse(transaction.is_dirty())
+        self.assertEquals(TransactionStatus.objects.count(), 1)
+
+class RebuildTransactionTests(TransactionTestCase):
+    
+    def testRebuildInterrupted(self):
+        """
+        Test that an interrupted rebuild with --clear keeps the current 
+        statuses it has not rebuilt yet.
+        """
+        
+        for i in range(4):
+            TransactionStatus.objects.create_from_response(completed_response('%032x' % i), obj=TransactionStatus(orderref='%032x' % i))
+        
+        update = Command.update
+        def interrupted(self, manager, statuses):
+            if statuses[0].orderref == '%032x' % 2:
+                raise RuntimeError
+            update(self, manager, statuses)
+        
+        Command.update = interrupted
+        try:
+            self.assertRaises(RuntimeError, call_command, 'payex_rebuild_current_status', chunk_size=2, clear=True, verbosity=0)
+        finally:
+            Command.update = update
+        
+        self.assertEquals(CurrentStatus.objects.count(), 4)
+
+class BenchmarkTests(TestCase):
+    
+    def testRunBenchmarks(self):
+        """
+        Test that the benchmarks run and leave no rows behind.
+        """
+        
+        from djpayex.benchmark import run_benchmarks
+        
+        results = run_benchmarks(count=20, batch_size=8)
+        self.assertEquals(results['count'], 20)
+        self.assertEquals(sorted(results['results'].keys()), ['bulk_create_from_responses', 'create_from_response', 'create_from_response_no_commit', 'get_decimal_amount'])
+        self.assertEquals(results['results']['create_from_response']['count'], 20)
+        self.assertEquals(TransactionStatus.objects.count(), 0)
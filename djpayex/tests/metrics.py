@@ -0,0 +1,66 @@
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djpayex import metrics
+from djpayex.client import ServiceRegistry
+from djpayex.models import TransactionStatus
+from djpayex.testing import complete_response
+
+
+class MetricsTests(TestCase):
+    
+    @override_settings(PAYEX_CIRCUIT_BREAKER_THRESHOLD=0)
+    def testDisabled(self):
+        """
+        Test that nothing is recorded or exported without a backend.
+        """
+        
+        self.assertEquals(metrics.get_backend(), None)
+        
+        service = ServiceRegistry().get_service('123', 'abc', False)
+        self.assertFalse('_send_request' in service.complete.__dict__)
+        
+        self.assertEquals(self.client.get(reverse('payex-metrics')).status_code, 404)
+    
+    @override_settings(PAYEX_METRICS_BACKEND='djpayex.metrics.InMemoryBackend', PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'error_rate': 1})
+    def testRecorded(self):
+        """
+        Test that calls and saves are recorded.
+        """
+        
+        backend = metrics.get_backend()
+        self.assertTrue(isinstance(backend, metrics.InMemoryBackend))
+        
+        service = ServiceRegistry().get_service('123', 'abc', False)
+        service.complete(orderRef='abc')
+        service.complete(orderRef='abc')
+        
+        TransactionStatus.objects.create_from_response(complete_response())
+        TransactionStatus.objects.bulk_create_from_responses([complete_response(), complete_response()])
+        
+        self.assertEquals(backend.counters[('payex_calls_total', (('errorcode', 'Error_Generic'), ('method', 'complete'), ))], 2)
+        self.assertEquals(backend.counters[('payex_saves_total', (('errorcode', 'OK'), ('model', 'transactionstatus'), ))], 3)
+        self.assertEquals(backend.histograms[('payex_call_seconds', (('errorcode', 'Error_Generic'), ('method', 'complete'), ))][2], 2)
+    
+    @override_settings(PAYEX_METRICS_BACKEND='djpayex.metrics.InMemoryBackend')
+    def testView(self):
+        """
+        Test the Prometheus export, only for internal IPs and staff.
+        """
+        
+        metrics.get_backend().increment('payex_calls_total', method='complete', errorcode='OK')
+        metrics.get_backend().observe('payex_call_seconds', 0.2, method='complete', errorcode='OK')
+        
+        self.assertEquals(self.client.get(reverse('payex-metrics')).status_code, 403)
+        
+        with self.settings(INTERNAL_IPS=('127.0.0.1', )):
+            response = self.client.get(reverse('payex-metrics'))
+        
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '# TYPE payex_calls_total counter')
+        self.assertContains(response, 'payex_calls_total{errorcode="OK",method="complete"} 1')
+        self.assertContains(response, 'payex_call_seconds_bucket{errorcode="OK",method="complete",le="0.1"} 0')
+        self.assertContains(response, 'payex_call_seconds_bucket{errorcode="OK",method="complete",le="0.25"} 1')
+        self.assertContains(response, 'payex_call_seconds_count{errorcode="OK",method="complete"} 1')
+        self.assertContains(response, 'payex_circuit_breaker_open 0')
@@ -0,0 +1,108 @@
+import datetime
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from djpayex import states
+from djpayex.models import InitializedPayment, TransactionStatus, PolledPayment, CurrentStatus
+from djpayex.poller import StalePaymentPoller
+from djpayex.tests.utils import StubService, completed_response
+from djpayex.utils import RateLimiter
+
+
+class StalePaymentPollerTests(TestCase):
+    
+    def setUp(self):
+        for orderref in ('a1', 'a2', 'a3', 'a4', 'recent'):
+            InitializedPayment.objects.create(errorcode='OK', orderref=orderref)
+        
+        InitializedPayment.objects.exclude(orderref='recent').update(created=timezone.now() - datetime.timedelta(hours=1))
+        
+        # a4 is completed already
+        TransactionStatus.objects.create_from_response(completed_response('a4'), obj=TransactionStatus(orderref='a4'))
+    
+    def testStaleOrders(self):
+        """
+        Test that only old orders without a terminal status are polled.
+        """
+        
+        poller = StalePaymentPoller(service=StubService())
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30), ['a1', 'a2', 'a3'])
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30, limit=2), ['a1', 'a2'])
+        self.assertEquals(poller.get_stale_orderrefs(older_than=120), [])
+        
+        # Orders initialized too long ago are no longer polled
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30, max_age=30), [])
+        
+        # The latest initialized orders are polled first
+        InitializedPayment.objects.filter(orderref='a3').update(created=timezone.now() - datetime.timedelta(minutes=45))
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30, limit=2), ['a3', 'a1'])
+    
+    def testPoll(self):
+        """
+        Test completing stale orders, with retries of failing calls.
+        """
+        
+        service = StubService(failing=('a2', ))
+        poller = StalePaymentPoller(service=service, workers=1, rate=0, max_attempts=2, backoff=0)
+        
+        result = poller.poll(older_than=30)
+        self.assertEquals(result['orders'], 3)
+        self.assertEquals(result['completed'], 2)
+        self.assertEquals(result['failed'], 1)
+        self.assertEquals(sorted(service.calls), [('complete', 'a1'), ('complete', 'a2'), ('complete', 'a2'), ('complete', 'a3')])
+        
+        self.assertEquals(TransactionStatus.objects.for_order('a1').count(), 1)
+        self.assertEquals(CurrentStatus.objects.for_order('a3').state, states.SUCCESSFUL)
+        
+        # Completed orders are not polled again, and orders still without a 
+        # terminal status are backed off
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30), [])
+        self.assertEquals(PolledPayment.objects.get().orderref, 'a2')
+        
+        PolledPayment.objects.update(next_poll=timezone.now())
+        self.assertEquals(poller.get_stale_orderrefs(older_than=30), ['a2'])
+        
+        poller.poll(older_than=30)
+        polled = PolledPayment.objects.get(orderref='a2')
+        self.assertEquals(polled.attempts, 2)
+        self.assertTrue(polled.next_poll > timezone.now() + datetime.timedelta(minutes=59))
+        
+        # Orders are forgotten once they have a terminal status
+        poller.service = StubService()
+        PolledPayment.objects.update(next_poll=timezone.now())
+        poller.poll(older_than=30)
+        self.assertEquals(PolledPayment.objects.count(), 0)
+    
+    def testCommand(self):
+        """
+        Test the management command against the configured service.
+        """
+        
+        from djpayex import poller
+        
+        service = StubService()
+        get_service, poller.get_service = poller.get_service, lambda: service
+        
+        try:
+            call_command('payex_poll_stale_payments', workers=2, rate=0, verbosity=0)
+        finally:
+            poller.get_service = get_service
+        
+        self.assertEquals(TransactionStatus.objects.count(), 4)
+
+class RateLimiterTests(TestCase):
+    
+    def testAllow(self):
+        """
+        Test that calls are limited per key.
+        """
+        
+        limiter = RateLimiter(0.001, capacity=2)
+        self.assertTrue(limiter.allow('a'))
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        self.assertTrue(limiter.allow('b'))
+        
+        self.assertTrue(RateLimiter(0).allow('a'))
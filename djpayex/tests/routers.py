@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from djpayex import views
+from djpayex.callbacks import deduplicator
+from djpayex.client import get_service
+from djpayex.models import TransactionStatus
+from djpayex.routers import PayexRouter, PayexRouterMiddleware, is_pinned, pin, unpin, use_write_db
+from djpayex.tests.utils import StubService
+
+
+@override_settings(PAYEX_DB_WRITE_ALIAS='default', PAYEX_DB_READ_ALIAS='replica')
+class PayexRouterTests(TestCase):
+    
+    def setUp(self):
+        unpin()
+        self.router = PayexRouter()
+    
+    def tearDown(self):
+        unpin()
+    
+    def testRouting(self):
+        """
+        Test that reads go to the read database until the thread writes.
+        """
+        
+        self.assertEquals(self.router.db_for_read(TransactionStatus), 'replica')
+        self.assertEquals(self.router.db_for_read(User), None)
+        self.assertEquals(self.router.db_for_write(User), None)
+        self.assertFalse(is_pinned())
+        
+        self.assertEquals(self.router.db_for_write(TransactionStatus), 'default')
+        self.assertTrue(is_pinned())
+        self.assertEquals(self.router.db_for_read(TransactionStatus), 'default')
+        
+        middleware = PayexRouterMiddleware()
+        response = HttpResponse()
+        self.assertEquals(middleware.process_response(HttpRequest(), response), response)
+        self.assertEquals(self.router.db_for_read(TransactionStatus), 'replica')
+        
+        self.assertTrue(self.router.allow_syncdb('default', TransactionStatus))
+        self.assertFalse(self.router.allow_syncdb('replica', TransactionStatus))
+        self.assertEquals(self.router.allow_syncdb('replica', User), None)
+    
+    def testUseWriteDb(self):
+        """
+        Test that decorated functions read from the write database.
+        """
+        
+        read = use_write_db(lambda: self.router.db_for_read(TransactionStatus))
+        
+        self.assertEquals(read(), 'default')
+        self.assertFalse(is_pinned())
+        
+        pin()
+        read()
+        self.assertTrue(is_pinned())
+    
+    def testCallbackPinned(self):
+        """
+        Test that callbacks read from the write database.
+        """
+        
+        deduplicator.cache.clear()
+        
+        pinned = []
+        def get_pinned_service():
+            pinned.append(is_pinned())
+            return StubService()
+        
+        views.get_service = get_pinned_service
+        try:
+            response = self.client.post(reverse('payex-callback'), {'orderRef': 'abc123'})
+        finally:
+            views.get_service = get_service
+        
+        self.assertEquals(response.content, 'OK')
+        self.assertEquals(pinned, [True])
+        self.assertFalse(is_pinned())
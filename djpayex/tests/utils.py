@@ -0,0 +1,70 @@
+"""
+Helpers for the tests.
+"""
+
+from djpayex.testing import autopay_response
+
+
+def completed_response(orderref, transactionnumber='40276785'):
+    """
+    Returns a response for a completed transaction.
+    """
+    
+    return {
+        'status': {
+            'errorCode': 'OK', 
+            'code': 'OK', 
+            'description': 'OK', 
+            'thirdPartyError': None, 
+            'paramName': None
+        }, 
+        'header': {
+            'date': '2011-10-07 12:59:30', 
+            'name': 'Payex Header v1.0', 
+            'id': 'efb64f26a27449b9bd513f949a077080'
+        }, 
+        'orderId': orderref, 
+        'transactionNumber': transactionnumber, 
+        'transactionRef': 'e4ee430eba5a4cdb85f7e81a93c2e424', 
+        'transactionStatus': '0', 
+        'orderStatus': '0', 
+        'paymentMethod': 'VISA', 
+        'amount': '5000'
+    }
+
+class StubService(object):
+    """
+    Stand-in for the PayEx service, returning canned responses.
+    
+    Calls for references in `failing` return None, like `pypayex` does on SOAP 
+    faults, and calls for references in `raising` raise an exception. Autopays 
+    for references in `declined` fail.
+    """
+    
+    def __init__(self, failing=(), raising=(), declined=()):
+        self.failing = failing
+        self.raising = raising
+        self.declined = declined
+        self.calls = []
+    
+    def complete(self, orderRef):
+        self.calls.append(('complete', orderRef))
+        
+        if orderRef in self.failing:
+            return None
+        
+        return completed_response(orderRef)
+    
+    def autopay(self, agreementRef, price, **kwargs):
+        self.calls.append(('autopay', agreementRef, price))
+        
+        if agreementRef in self.raising:
+            raise IOError('Connection reset')
+        
+        if agreementRef in self.failing:
+            return None
+        
+        if agreementRef in self.declined:
+            return autopay_response(str(len(self.calls)), '5')
+        
+        return autopay_response(str(len(self.calls)))
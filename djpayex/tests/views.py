@@ -2,8 +2,10 @@ import datetime
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import LiveServerTestCase, TestCase
+from django.test.utils import override_settings
 
+from djpayex.loadtest import percentile, run_load_test
 from djpayex.models import TransactionStatus
 
 
@@ -39,3 +41,45 @@ class CallbackTests(TestCase):
             self.assertEquals(TransactionStatus.objects.count(), 1)
             
             status = TransactionStatus.objects.get()
+
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_SERVICE_BACKEND_OPTIONS={'timeout_rate': 1})
+    def testCallbackTimeout(self):
+        """
+        Test that callbacks are answered with FAILURE when PayEx times out, so 
+        PayEx sends them again.
+        """
+        
+        response = self.client.post(reverse('payex-callback'), {
+            'transactionRef': '123',
+            'transactionNumber': '456',
+            'orderRef': 'abc123',
+        })
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, 'FAILURE')
+        self.assertEquals(TransactionStatus.objects.count(), 0)
+
+class LoadTestTests(LiveServerTestCase):
+    
+    @override_settings(PAYEX_SERVICE_BACKEND='djpayex.testing.FakePayEx', PAYEX_CALLBACK_STRICT=True)
+    def testLoadTest(self):
+        """
+        Test a load test against a live server with a fake PayEx service, and
+        strict validation of the callbacks.
+        """
+        
+        result = run_load_test(self.live_server_url + reverse('payex-callback'), requests=10, concurrency=1)
+        self.assertEquals(result['responses'], {'OK': 10})
+        self.assertEquals(result['rows_written']['transaction_statuses'], 10)
+        self.assertEquals(result['rows_written']['processed_callbacks'], 10)
+        self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+    
+    def testPercentile(self):
+        """
+        Test percentiles by nearest rank.
+        """
+        
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile([3], 95), 3)
+        self.assertEquals(percentile([], 95), None)
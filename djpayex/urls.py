@@ -2,4 +2,6 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('djpayex.views',
     url(r'^callback/$', 'callback', name='payex-callback'),
+    url(r'^callback/deferred/$', 'callback_deferred', name='payex-callback-deferred'),
+    url(r'^metrics/$', 'metrics', name='payex-metrics'),
 )
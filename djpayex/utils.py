@@ -2,6 +2,21 @@
 Various utilities.
 """
 
+import datetime
+import decimal
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from django.db import connections, transaction
+from django.utils.encoding import smart_unicode
+
 
 def generate_client_identifier(request):
     """
@@ -11,3 +26,290 @@ def generate_client_identifier(request):
     user_agent = request.META.get('HTTP_USER_AGENT', '')
     
     return 'useragent=%(user_agent)s' % {'user_agent': user_agent}
+
+def close_connections():
+    """
+    Closes the database connections of the current thread.
+    """
+    
+    for connection in connections.all():
+        connection.close()
+
+@contextmanager
+def write_transaction(using):
+    """
+    Runs a block in a transaction on the `using` database, committed if the 
+    block succeeds. Within a transaction managed by the caller (e.g. by 
+    TransactionMiddleware), the block runs in a savepoint instead, so the 
+    work of the caller is neither committed nor rolled back with it.
+    """
+    
+    if not transaction.is_managed(using=using):
+        with transaction.commit_on_success(using=using):
+            yield
+        return
+    
+    sid = transaction.savepoint(using=using)
+    
+    try:
+        yield
+    except Exception:
+        transaction.savepoint_rollback(sid, using=using)
+        raise
+    
+    transaction.savepoint_commit(sid, using=using)
+
+def run_concurrently(func, items, workers=1):
+    """
+    Calls `func` for each item with a pool of `workers` threads, and returns the 
+    results in the order of the items.
+    
+    With a single worker the items are processed in the calling thread. Database 
+    connections opened by the worker threads are closed when they are done. The 
+    first exception raised by `func` is re-raised when all items are processed.
+    """
+    
+    items = list(items)
+    
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    
+    results = [None] * len(items)
+    errors = []
+    
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+    
+    def worker():
+        try:
+            while True:
+                try:
+                    index, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                
+                try:
+                    results[index] = func(item)
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            close_connections()
+    
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if errors:
+        raise errors[0]
+    
+    return results
+
+class LRUCache(object):
+    """
+    A thread safe mapping holding at most `maxsize` keys, evicting the least 
+    recently used key when full.
+    """
+    
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+    
+    def get(self, key, default=None):
+        """
+        Returns the value for a key and marks it as recently used.
+        """
+        
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            
+            self._data[key] = value
+            return value
+    
+    def set(self, key, value):
+        """
+        Sets the value for a key, evicting the least recently used key if full.
+        """
+        
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def delete(self, key):
+        """
+        Removes a key, if present.
+        """
+        
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        """
+        Removes all keys.
+        """
+        
+        with self._lock:
+            self._data.clear()
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket, refilled with `rate` tokens per second up to 
+    `capacity` tokens (by default one second worth of tokens).
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(self.rate, 1)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    
+    def consume(self):
+        """
+        Takes a token if one is available. Returns False otherwise.
+        """
+        
+        with self._lock:
+            self._refill()
+            
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            
+            return False
+    
+    def wait(self):
+        """
+        Takes a token, waiting for one to be available.
+        """
+        
+        while True:
+            with self._lock:
+                self._refill()
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                delay = (1 - self.tokens) / self.rate
+            
+            time.sleep(delay)
+
+class RateLimiter(object):
+    """
+    Limits calls to `rate` per second for each key (e.g. a host), with a token 
+    bucket per key. Buckets of at most `maxsize` keys are kept, the least 
+    recently used are discarded. A rate of None or 0 disables the limit.
+    """
+    
+    def __init__(self, rate, capacity=None, maxsize=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+    
+    def get_bucket(self, key):
+        """
+        Returns the token bucket for a key, creating it on first use.
+        """
+        
+        bucket = self.buckets.get(key)
+        
+        if bucket is None:
+            with self._lock:
+                bucket = self.buckets.get(key)
+                
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.capacity)
+                    self.buckets.set(key, bucket)
+        
+        return bucket
+    
+    def allow(self, key=None):
+        """
+        Checks if a call for the key is allowed now, counting it if it is.
+        """
+        
+        if not self.rate:
+            return True
+        
+        return self.get_bucket(key).consume()
+    
+    def wait(self, key=None):
+        """
+        Waits until a call for the key is allowed.
+        """
+        
+        if self.rate:
+            self.get_bucket(key).wait()
+
+def chunked_queryset(queryset, chunk_size=1000):
+    """
+    Yields the objects of a queryset in lists of `chunk_size` objects, ordered 
+    by primary key, with one query per chunk.
+    
+    Unlike iterating over a large queryset, which makes most database drivers 
+    fetch every row at once, only one chunk is held in memory at a time.
+    """
+    
+    queryset = queryset.order_by('pk')
+    chunk = list(queryset[:chunk_size])
+    
+    while chunk:
+        yield chunk
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size])
+
+def chunked_values(queryset, fields, chunk_size=1000):
+    """
+    Yields the values of `fields` of the rows of a queryset as dictionaries, 
+    ordered by primary key, like `chunked_queryset` but one row at a time.
+    """
+    
+    pk = queryset.model._meta.pk.attname
+    queryset = queryset.order_by('pk').values(pk, *[field for field in fields if field != pk])
+    last = None
+    
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        count = 0
+        
+        for row in chunk[:chunk_size].iterator():
+            count += 1
+            last = row[pk]
+            yield row
+        
+        if count < chunk_size:
+            return
+
+def encode_value(value):
+    """
+    Encodes a value JSON does not support, as the `default` of `json.dumps`.
+    """
+    
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    
+    return smart_unicode(value)
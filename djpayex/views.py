@@ -1,20 +1,25 @@
 import logging
+import time
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseNotAllowed
-from payex.service import PayEx
+from django.db import router, transaction
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, HttpResponseNotFound
+from django.views.decorators.csrf import csrf_exempt
 
-from djpayex.models import TransactionStatus
+from djpayex.callbacks import complete_deferred, complete_order, deduplicator, get_executor
+from djpayex.client import TRANSPORT_ERRORS, CircuitBreaker, get_circuit_breaker, get_service
+from djpayex.exceptions import PayexError
+from djpayex.firewall import filter_callback
+from djpayex.log import log_callback
+from djpayex.metrics import get_backend as get_metrics_backend
+from djpayex.models import QueuedCallback
+from djpayex.routers import use_write_db
 
 logger = logging.getLogger(__name__)
 
-# Initialize PayEx service
-service = PayEx(
-    merchant_number=settings.PAYEX_MERCHANT_NUMBER, 
-    encryption_key=settings.PAYEX_ENCRYPTION_KEY, 
-    production=settings.PAYEX_IN_PRODUCTION
-)
-
+@csrf_exempt
+@filter_callback
+@use_write_db
 def callback(request):
     """
     NOTE Not fully implemented yet.
@@ -29,23 +34,148 @@ def callback(request):
     
     Documentation:
     http://www.payexpim.com/quick-guide/9-transaction-callback/
+    
+    Repeated callbacks for a transaction that has been processed are answered 
+    with "OK" right away.
+    
+    If PAYEX_CALLBACK_QUEUED is set, the callback is only queued and the order 
+    is completed by the `payex_callback_worker` management command.
+    
+    Callbacks are logged to the `djpayex.audit` logger, see `djpayex.log`. 
+    Callbacks that can't be from PayEx are rejected first, see 
+    `djpayex.firewall`.
+    """
+    
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST',])
+    
+    started = time.time()
+    result = process_callback(request)
+    log_callback(request, result, time.time() - started)
+    
+    return HttpResponse(result)
+
+@csrf_exempt
+@filter_callback
+@use_write_db
+def callback_deferred(request):
     """
+    Callback view that answers PayEx before the order is completed, so that 
+    the request does not wait for the call to PayEx.
     
-    logger.info('Got PayEx callback: %(raw_post_data)s\n%(meta)s\n%(post_data)s' % {
-        'raw_post_data': request.raw_post_data,
-        'meta': request.META,
-        'post_data': request.POST,
-    })
+    The callback is stored as a claimed QueuedCallback, and the order is 
+    completed by a bounded pool of threads in the process, see 
+    `djpayex.callbacks.get_executor`. When the pool is saturated, "FAILURE" is 
+    answered so PayEx retries the callback later. Callbacks that fail, or are 
+    lost with the process, are retried by the `payex_callback_worker` 
+    management command, which should be run as well.
+    """
     
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST',])
     
+    started = time.time()
+    result = process_callback_deferred(request)
+    log_callback(request, result, time.time() - started)
+    
+    return HttpResponse(result)
+
+def process_callback(request):
+    """
+    Processes a callback, and returns the response to PayEx.
+    """
+    
     orderref = request.POST.get('orderRef', None)
+    transactionnumber = request.POST.get('transactionNumber', '')
     
     if orderref:
-        response = service.complete(orderRef=orderref)
-        status = TransactionStatus.objects.create_from_response(response)
         
-        return HttpResponse('OK')
+        # Ignore callbacks we have processed already
+        if deduplicator.is_processed(orderref, transactionnumber):
+            return 'OK'
+        
+        # Leave the PayEx request to a worker
+        if getattr(settings, 'PAYEX_CALLBACK_QUEUED', False):
+            QueuedCallback.objects.enqueue(
+                orderref=orderref, 
+                transactionref=request.POST.get('transactionRef', ''), 
+                transactionnumber=transactionnumber
+            )
+            
+            return 'OK'
+        
+        # Answered with FAILURE, so PayEx sends the callback again
+        try:
+            complete_order(orderref, get_service())
+        except (PayexError, ) + TRANSPORT_ERRORS:
+            logger.exception('Could not complete orderRef %s.', orderref)
+            return 'FAILURE'
+        
+        deduplicator.mark_processed(orderref, transactionnumber)
+        
+        return 'OK'
+    
+    return 'FAILURE'
+
+def process_callback_deferred(request):
+    """
+    Stores a callback and hands it to the executor, and returns the response 
+    to PayEx.
+    """
+    
+    orderref = request.POST.get('orderRef', None)
+    transactionnumber = request.POST.get('transactionNumber', '')
+    
+    if not orderref:
+        return 'FAILURE'
+    
+    if deduplicator.is_processed(orderref, transactionnumber):
+        return 'OK'
+    
+    executor = get_executor()
+    
+    # Refused before storing anything when saturated
+    if executor.is_full():
+        return 'FAILURE'
+    
+    # Committed before the executor reads it
+    with transaction.commit_on_success(using=router.db_for_write(QueuedCallback)):
+        item = QueuedCallback.objects.enqueue(
+            orderref=orderref, 
+            transactionref=request.POST.get('transactionRef', ''), 
+            transactionnumber=transactionnumber, 
+            claimed=True
+        )
+    
+    if not executor.submit(complete_deferred, item):
+        item.delete()
+        return 'FAILURE'
+    
+    return 'OK'
+
+def metrics(request):
+    """
+    Returns the metrics of the in-memory metrics backend and the state of the 
+    circuit breaker in the Prometheus text format, to staff users and requests 
+    from INTERNAL_IPS.
+    """
+    
+    backend = get_metrics_backend()
+    
+    if not hasattr(backend, 'render'):
+        return HttpResponseNotFound()
+    
+    user = getattr(request, 'user', None)
+    
+    if not (user is not None and user.is_staff) and request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+    
+    content = backend.render()
+    breaker = get_circuit_breaker()
+    
+    if breaker is not None:
+        state = breaker.get_state()
+        content += '# TYPE payex_circuit_breaker_open gauge\npayex_circuit_breaker_open %s\n' % int(state['state'] != CircuitBreaker.CLOSED)
+        content += '# TYPE payex_circuit_breaker_failures gauge\npayex_circuit_breaker_failures %s\n' % state['failures']
     
-    return HttpResponse('FAILURE')
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
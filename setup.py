@@ -19,7 +19,8 @@ setup(
     author='Funkbit',
     author_email='post@funkbit.no',
     url='https://github.com/funkbit/django-payex',
-    packages=['djpayex', ],
+    packages=['djpayex', 'djpayex.management', 'djpayex.management.commands', ],
+    package_data={'djpayex': ['sql/*.sql', ]},
     license='BSD',
     classifiers=(
         "Development Status :: 3 - Alpha",